@@ -1,49 +1,47 @@
+"""
+Streamlit front end for LENAH.
+
+This module only draws the UI and keeps the session's state; every turn is
+run by the conversation engine in src/engine.py, the same code the HTTP API
+(src/api.py) serves.
+"""
 from __future__ import annotations
 
+import time
+
 import streamlit as st
 
-from src.config import APP_TITLE, CREDENTIALS_PATH, TOKEN_PATH, GMAIL_SCOPES
+from src.config import APP_TITLE, HISTORY_RENDER_WINDOW, HISTORY_SEARCH_LIMIT, POLL_INTERVAL_S, POLLER_IN_APP
+from src.engine import Conversation, load_state
 from src.gmail_client import GmailClient
-from src.llm import (
-    ToolCall,
-    chat,
-    classify_draft_response,
-    draft_agent_email,
-    draft_reply_to_agent,
-    draft_summary_email,
-    refine_draft,
-    summarise_agent_reply,
-)
-from src.session import UserStore
-from src.utils import extract_first_email, is_valid_email, normalise_email
+from src.mailboxes import make_client
+from src.poller import ReplyPoller
+from src.recall import forget
+from src.recorder import record_turn
+from src.search import delete_history, search_history
+from src.session import UserStore, discard_pending, open_user_store
+from src.tracing import span
+from src.utils import is_valid_email, normalise_email
 
 
 # ---------------------------------------------------------------------------
-# Gmail client — cached for the lifetime of the Streamlit server process
+# Gmail clients — cached for the lifetime of the Streamlit server process
 # ---------------------------------------------------------------------------
 
 @st.cache_resource
-def _get_gmail_client() -> GmailClient:
-    return GmailClient(
-        credentials_path=str(CREDENTIALS_PATH),
-        token_path=str(TOKEN_PATH),
-        scopes=GMAIL_SCOPES,
-    )
+def _mailbox_client(name: str) -> GmailClient:
+    """One client per central mailbox shard (see src/mailboxes.py)."""
+    return make_client(name)
 
 
-def _send_email(
-    *,
-    to: str,
-    subject: str,
-    body: str,
-    cc: list[str] | None = None,
-    reply_to: str | None = None,
-    thread_id: str | None = None,
-) -> tuple[str, str]:
-    return _get_gmail_client().send_email(
-        to=to, subject=subject, body=body,
-        cc=cc, reply_to=reply_to, thread_id=thread_id,
-    )
+@st.cache_resource
+def _get_poller() -> ReplyPoller | None:
+    """One background poller per server process, if configured."""
+    if POLL_INTERVAL_S <= 0 or not POLLER_IN_APP:
+        return None
+    poller = ReplyPoller(_mailbox_client, POLL_INTERVAL_S)
+    poller.start()
+    return poller
 
 
 # ---------------------------------------------------------------------------
@@ -53,11 +51,25 @@ def _send_email(
 def _init_state() -> None:
     st.session_state.setdefault("messages", [])
     st.session_state.setdefault("user_email", None)
+    # the login address the state is saved under; user_email can change
+    st.session_state.setdefault("owner_email", None)
     st.session_state.setdefault("pending_email", None)
     # agent_email -> Gmail thread_id
     st.session_state.setdefault("agent_threads", {})
     # agent_email -> last Gmail message_id we sent (reply-detection cursor)
     st.session_state.setdefault("agent_last_message_id", {})
+    # how many of the oldest messages live in the store's cold archive
+    st.session_state.setdefault("archived_count", 0)
+    # reply message_id -> reply queued by the poller, not yet surfaced
+    st.session_state.setdefault("ready_replies", {})
+    # agent_email -> {"last": epoch of latest message, "replies": n}
+    st.session_state.setdefault("agent_activity", {})
+    # central mailbox shard this user's mail goes through
+    st.session_state.setdefault("mailbox", None)
+    # "{reply id}:{n}" -> listing extracted from an agent reply
+    st.session_state.setdefault("listings", {})
+    # agent_email -> running digest of that thread
+    st.session_state.setdefault("agent_digests", {})
 
 
 def _login_screen() -> bool:
@@ -80,7 +92,7 @@ def _login_screen() -> bool:
     with col2:
         clear_clicked = False
         if email_input and is_valid_email(normalise_email(email_input)):
-            store_preview = UserStore(email_input)
+            store_preview = open_user_store(email_input)
             if store_preview.exists:
                 clear_clicked = st.button("Clear saved data", use_container_width=True)
 
@@ -88,15 +100,18 @@ def _login_screen() -> bool:
         if not email_input or not is_valid_email(normalise_email(email_input)):
             st.error("Please enter a valid email address.")
             return False
-        store = UserStore(email_input)
+        store = open_user_store(email_input)
         _clear_user_state()            # wipe any stale data before loading
-        st.session_state.update(store.load())
-        st.session_state.user_email = store.email
+        st.session_state.update(load_state(store))
         st.session_state["_user_store"] = store
         st.rerun()
 
     if clear_clicked:
-        UserStore(email_input).delete()
+        store = open_user_store(email_input)
+        discard_pending(store.user_id)
+        store.delete()
+        delete_history(store.email)
+        forget(store.email)
         st.success("Saved data cleared. Reload the page to start fresh.")
         return False
 
@@ -108,326 +123,98 @@ def _clear_user_state() -> None:
     st.session_state["_user_store"] = None
     st.session_state.messages = []
     st.session_state.user_email = None
+    st.session_state.owner_email = None
     st.session_state.pending_email = None
     st.session_state.agent_threads = {}
     st.session_state.agent_last_message_id = {}
+    st.session_state.archived_count = 0
+    st.session_state.ready_replies = {}
+    st.session_state.agent_activity = {}
+    st.session_state.mailbox = None
+    st.session_state.listings = {}
+    st.session_state.agent_digests = {}
+    st.session_state["_render_count"] = HISTORY_RENDER_WINDOW
+    st.session_state["_earlier_cache"] = None
 
 
 def _save_state() -> None:
-    """Persist current session state to disk for the logged-in user."""
+    """Queue the current session state for persistence (no-op if unchanged)."""
     store: UserStore | None = st.session_state.get("_user_store")
     if isinstance(store, UserStore):
-        store.save(st.session_state)
-
-
-def _add(role: str, content: str) -> None:
-    st.session_state.messages.append({"role": role, "content": content})
+        store.spill_cold(st.session_state)
+        store.schedule_save(st.session_state)
 
 
-def _render_history() -> None:
-    for m in st.session_state.messages:
-        with st.chat_message(m["role"]):
-            st.markdown(m["content"])
+def _refresh_state() -> None:
+    """Pick up agent threads / reply cursors another tab of this user saved."""
+    store: UserStore | None = st.session_state.get("_user_store")
+    if isinstance(store, UserStore):
+        store.refresh(st.session_state)
 
 
-# ---------------------------------------------------------------------------
-# Email parsing / detection
-# ---------------------------------------------------------------------------
+def _add(role: str, content: str) -> None:
+    _conversation().add(role, content)
 
-def _extract_email(text: str) -> str | None:
-    found = extract_first_email(text or "")
-    if found and is_valid_email(found):
-        return normalise_email(found)
-    return None
 
+def _earlier_messages(start: int, end: int) -> list[dict]:
+    """Archived messages [start, end), cached until the requested range moves."""
+    cached = st.session_state.get("_earlier_cache")
+    if cached and cached[:2] == (start, end):
+        return cached[2]
+    messages = st.session_state["_user_store"].load_archive(start, end)
+    st.session_state["_earlier_cache"] = (start, end, messages)
+    return messages
 
-def _sniff_own_email(text: str) -> str | None:
-    """
-    Return an email address only when the user explicitly indicates it is theirs.
-    Intentionally strict to avoid capturing an agent's address mid-flow.
-    """
-    t = (text or "").lower()
-    cues = [
-        "my email is", "my email:",
-        "email me at", "send it to me at", "send it to my email",
-        "cc me at", "cc me on",
-        "you can cc me at", "you can email me at",
-    ]
-    if not any(c in t for c in cues):
-        return None
-    return _extract_email(text)
 
+def _load_earlier() -> None:
+    st.session_state["_render_count"] += HISTORY_RENDER_WINDOW
 
-# ---------------------------------------------------------------------------
-# Agent-reply polling
-# ---------------------------------------------------------------------------
 
-def _check_agent_replies() -> None:
+def _render_history() -> None:
     """
-    Poll every known agent thread for new inbound messages.
-
-    Surfaces one reply at a time to keep the UX manageable:
-      1. Summarises the reply for the user.
-      2. Drafts a suggested response.
-      3. Enters 'review_draft' pending state so the user can approve or refine.
-
-    The last-seen message cursor is advanced *before* LLM processing so a
-    processing failure never causes the same message to be surfaced twice.
+    Draw only the latest ``_render_count`` messages. "Load earlier" widens
+    the window a page at a time, reaching into the cold archive once the
+    in-memory history is exhausted.
     """
-    agent_threads: dict[str, str] = st.session_state.agent_threads
-
-    if not agent_threads:
-        _add("assistant", "I haven't emailed any agents yet — there's nothing to check.")
-        return
-
-    client = _get_gmail_client()
-
-    for agent_email, thread_id in agent_threads.items():
-        after_id = st.session_state.agent_last_message_id.get(agent_email)
-
-        try:
-            replies = client.get_new_replies(thread_id=thread_id, after_message_id=after_id)
-        except Exception as exc:  # noqa: BLE001
-            _add("assistant", f"Couldn't check replies from **{agent_email}**: `{exc}`")
-            continue
-
-        if not replies:
-            continue
-
-        latest = replies[-1]
-        reply_body: str = latest["body"]
-        reply_from: str = latest["from"]
-
-        # Advance cursor before processing — prevents re-surfacing on failure.
-        st.session_state.agent_last_message_id[agent_email] = latest["id"]
-
-        try:
-            summary = summarise_agent_reply(
-                reply_body=reply_body,
-                chat_history=st.session_state.messages,
-            )
-            draft_subject, draft_body = draft_reply_to_agent(
-                reply_body=reply_body,
-                chat_history=st.session_state.messages,
-                user_request="",
-            )
-        except Exception as exc:  # noqa: BLE001
-            _add("assistant", f"Got a reply from **{agent_email}** but couldn't process it: `{exc}`")
-            return
-
-        _add(
-            "assistant",
-            f"**{reply_from}** replied to your enquiry:\n\n"
-            f"> {summary}\n\n"
-            f"Here's a suggested reply:\n\n"
-            f"---\n{draft_body}\n---\n\n"
-            "Say **'send it'** to send this as-is, or tell me how to change it "
-            "(e.g. *'make it more formal'*, *'ask about parking'*, *'keep it shorter'*).",
+    messages = st.session_state.messages
+    archived = st.session_state.get("archived_count") or 0
+    total = archived + len(messages)
+    shown = min(st.session_state.setdefault("_render_count", HISTORY_RENDER_WINDOW), total)
+
+    if shown < total:
+        st.button(
+            f"⬆️ Load earlier messages ({total - shown} more)",
+            use_container_width=True,
+            on_click=_load_earlier,
         )
 
-        st.session_state.pending_email = {
-            "action": "review_draft",
-            "agent_email": agent_email,
-            "thread_id": thread_id,
-            "draft_subject": draft_subject,
-            "draft_body": draft_body,
-        }
-        return  # one reply at a time
+    visible = messages[max(len(messages) - shown, 0):]
+    if shown > len(messages):
+        visible = _earlier_messages(total - shown, archived) + visible
 
-    _add("assistant", "No new replies from any agents yet.")
+    for m in visible:
+        with st.chat_message(m["role"]):
+            st.markdown(m["content"])
 
 
 # ---------------------------------------------------------------------------
-# Pending-email state machine
+# Conversation engine (src/engine.py) over this session's state
 # ---------------------------------------------------------------------------
 
-def _run_pending(user_text: str) -> None:
-    """
-    Advance whichever email flow is currently in st.session_state.pending_email.
+def _conversation() -> Conversation:
+    return Conversation(st.session_state, _mailbox_client)
 
-    pending_email dict keys:
-        action        : "summary" | "agent" | "review_draft"
-
-        review_draft  : agent_email, thread_id, draft_subject, draft_body
-        agent         : agent_email (str | None), user_request (str)
-        summary       : (no extra keys)
-    """
-    p = st.session_state.pending_email
-    t = (user_text or "").strip()
-    found = _extract_email(t) if t else None
-
-    # ------------------------------------------------------------------ #
-    # review_draft — user approves or refines the suggested reply         #
-    # ------------------------------------------------------------------ #
-    if p["action"] == "review_draft":
-        if not t:
-            # Prompt already shown by _check_agent_replies; wait for input.
-            return
-
-        if classify_draft_response(t) == "approve":
-            _send_draft_reply(p)
-            return
-
-        # Anything else is a refinement instruction.
-        try:
-            new_subject, new_body = refine_draft(
-                draft_subject=p["draft_subject"],
-                draft_body=p["draft_body"],
-                instruction=t,
-            )
-        except Exception as exc:  # noqa: BLE001
-            _add("assistant", f"Couldn't refine the draft: `{exc}`")
-            return
-
-        p["draft_subject"] = new_subject
-        p["draft_body"] = new_body
-        _add(
-            "assistant",
-            f"Here's the updated draft:\n\n---\n{new_body}\n---\n\n"
-            "Say **'send it'** to send, or keep refining.",
-        )
-        return
-
-    # ------------------------------------------------------------------ #
-    # summary — send chat transcript to the user                          #
-    # ------------------------------------------------------------------ #
-    if p["action"] == "summary":
-        if not st.session_state.user_email:
-            if not found:
-                _add("assistant", "What email address should I send it to?")
-                return
-            st.session_state.user_email = found
-
-        try:
-            subject, body = draft_summary_email(chat_history=st.session_state.messages)
-            _send_email(to=st.session_state.user_email, subject=subject, body=body)
-            _add("assistant", f"Done — summary sent to **{st.session_state.user_email}**.")
-        except Exception as exc:  # noqa: BLE001
-            _add("assistant", f"Sorry — couldn't send the summary: `{exc}`")
-
-        st.session_state.pending_email = None
-        return
-
-    # ------------------------------------------------------------------ #
-    # agent — send a fresh enquiry email to an estate agent               #
-    # ------------------------------------------------------------------ #
-    if p["action"] == "agent":
-        # Step 1: collect agent email.
-        if not p.get("agent_email"):
-            if not found:
-                _add("assistant", "Sure — what's the estate agent's email address?")
-                return
-            if st.session_state.user_email and found == st.session_state.user_email:
-                _add("assistant", "That looks like your email — what's the estate agent's address?")
-                return
-            p["agent_email"] = found
-            found = None  # don't re-use as the user's own address
-
-        # Step 2: collect user CC address.
-        if not st.session_state.user_email:
-            if not found:
-                _add("assistant", "What email should I CC you on?")
-                return
-            if found == p["agent_email"]:
-                _add("assistant", "That looks like the agent's email — what email should I CC you on?")
-                return
-            st.session_state.user_email = found
-
-        # Step 3: send.
-        try:
-            subject, body = draft_agent_email(
-                chat_history=st.session_state.messages,
-                user_request=p.get("user_request", ""),
-            )
-            thread_id = st.session_state.agent_threads.get(p["agent_email"])
-            _msg_id, new_thread_id = _send_email(
-                to=p["agent_email"],
-                subject=subject,
-                body=body,
-                cc=[st.session_state.user_email],
-                # No reply_to — agent replies must land in LENAH's Gmail
-                # so get_new_replies() can find them. User stays in loop via CC.
-                thread_id=thread_id,
-            )
-            st.session_state.agent_threads[p["agent_email"]] = new_thread_id
-            st.session_state.agent_last_message_id[p["agent_email"]] = _msg_id
-            _add(
-                "assistant",
-                f"Done — emailed **{p['agent_email']}** and CC'd you "
-                f"at **{st.session_state.user_email}**.",
-            )
-        except Exception as exc:  # noqa: BLE001
-            _add("assistant", f"Sorry — couldn't send the email: `{exc}`")
-
-        st.session_state.pending_email = None
-        return
-
-    # Unknown action — clear to avoid getting stuck.
-    _add("assistant", "Sorry — I don't recognise that email action.")
-    st.session_state.pending_email = None
 
+def _check_agent_replies() -> None:
+    _conversation().check_replies()
 
-def _send_draft_reply(p: dict) -> None:
-    """Send the approved draft reply and update thread / cursor state."""
-    try:
-        _msg_id, new_thread_id = _send_email(
-            to=p["agent_email"],
-            subject=p["draft_subject"],
-            body=p["draft_body"],
-            cc=[st.session_state.user_email] if st.session_state.user_email else None,
-            # No reply_to — keep replies coming back to LENAH's Gmail.
-            thread_id=p["thread_id"],
-        )
-        st.session_state.agent_threads[p["agent_email"]] = new_thread_id
-        st.session_state.agent_last_message_id[p["agent_email"]] = _msg_id
-        _add("assistant", f"Sent — replied to **{p['agent_email']}**.")
-    except Exception as exc:  # noqa: BLE001
-        _add("assistant", f"Sorry — couldn't send the reply: `{exc}`")
-    finally:
-        st.session_state.pending_email = None
 
+def _surface_ready_reply() -> bool:
+    return _conversation().surface_ready_reply()
 
-# ---------------------------------------------------------------------------
-# Main message dispatcher
-# ---------------------------------------------------------------------------
 
 def _handle_message(user_text: str) -> None:
-    # Only sniff for the user's own email when not mid-flow — inside a pending
-    # flow the disambiguation logic in _run_pending takes precedence.
-    if st.session_state.pending_email is None:
-        own_email = _sniff_own_email(user_text)
-        if own_email:
-            st.session_state.user_email = own_email
-
-    if st.session_state.pending_email is not None:
-        _run_pending(user_text)
-        return
-
-    result = chat(
-        chat_history=st.session_state.messages,
-        user_text=user_text,
-        user_email=st.session_state.user_email,
-    )
-
-    if isinstance(result, str):
-        _add("assistant", result)
-        return
-
-    # ToolCall — set pending state then immediately kick off the flow with an
-    # empty string so any first missing-info prompt is shown right away.
-    if result.name == "send_summary_to_user":
-        st.session_state.pending_email = {
-            "action": "summary",
-            "agent_email": None,
-        }
-    elif result.name == "send_email_to_agent":
-        st.session_state.pending_email = {
-            "action": "agent",
-            "user_request": user_text,
-            "agent_email": result.args.get("agent_email") or None,
-        }
-
-    _run_pending("")
+    _conversation().handle_message(user_text)
 
 
 # ---------------------------------------------------------------------------
@@ -443,29 +230,71 @@ def main() -> None:
     if not _login_screen():
         return
 
-    # -- Sidebar: reply checker + active thread list ------------------------
+    # Page load: show a reply the poller queued while the user was away.
+    _get_poller()
+    _refresh_state()
+    if st.session_state.pending_email is None and _surface_ready_reply():
+        _save_state()
+
     with st.sidebar:
-        st.header("Agent replies")
-        if st.button("🔍 Check for new replies", use_container_width=True):
-            with st.spinner("Checking inboxes…"):
+        _sidebar()
+    _chat_pane()
+
+
+# Both panes are fragments: a reply check or a new message reruns only the
+# pane it touched, and escalates to a full rerun only when the other pane's
+# data changed too (new chat messages, new agent threads).
+
+@st.fragment
+def _sidebar() -> None:
+    st.header("Agent replies")
+    poller = _get_poller()
+    if poller is not None and poller.last_run:
+        st.caption(f"Inboxes checked {int(time.time() - poller.last_run) // 60} min ago")
+    if st.button("🔍 Check for new replies", use_container_width=True):
+        before = len(st.session_state.messages)
+        with st.spinner("Checking inboxes…"), span("turn", kind="check_replies"):
+            _refresh_state()
+            with record_turn("check_replies", None, st.session_state):
                 _check_agent_replies()
             _save_state()
+        if len(st.session_state.messages) != before:
             st.rerun()
 
-        if st.session_state.agent_threads:
-            st.divider()
-            st.caption("Active threads")
-            for email in st.session_state.agent_threads:
-                st.caption(f"• {email}")
-
+    if st.session_state.agent_threads:
         st.divider()
-        if st.button("🆕 New chat", use_container_width=True):
-            st.session_state.messages = []
-            st.session_state.pending_email = None
-            _save_state()
-            st.rerun()
+        st.caption("Active threads")
+        for email in st.session_state.agent_threads:
+            st.caption(f"• {email}")
+
+    st.divider()
+    _search_box()
+
+    st.divider()
+    if st.button("🆕 New chat", use_container_width=True):
+        _conversation().new_chat()
+        st.session_state["_render_count"] = HISTORY_RENDER_WINDOW
+        st.session_state["_earlier_cache"] = None
+        st.session_state["_user_store"].clear_archive()
+        _save_state()
+        st.rerun()
 
-    # -- Main chat area -----------------------------------------------------
+
+def _search_box() -> None:
+    """Ranked snippets from the user's chat and agent emails (see src/search.py)."""
+    query = st.text_input("🔎 Search conversations and emails", key="_search_query")
+    if not query.strip():
+        return
+    hits = search_history(st.session_state.owner_email, query, limit=HISTORY_SEARCH_LIMIT)
+    if not hits:
+        st.caption("No matches.")
+    for hit in hits:
+        when = time.strftime("%d %b %Y", time.localtime(hit.ts))
+        st.markdown(f"**{hit.title}** · {when}\n\n{hit.snippet}")
+
+
+@st.fragment
+def _chat_pane() -> None:
     _render_history()
 
     user_text = st.chat_input("Message LENAH…")
@@ -478,11 +307,17 @@ def main() -> None:
         placeholder = st.empty()
         placeholder.write("Thinking…")
 
-    _handle_message(user_text)
+    threads_before = set(st.session_state.agent_threads)
+    with span("turn", kind="message"):
+        _refresh_state()
+        with record_turn("message", user_text, st.session_state):
+            _handle_message(user_text)
+        _save_state()
 
     placeholder.empty()
-    _save_state()
-    st.rerun()
+    if set(st.session_state.agent_threads) != threads_before:
+        st.rerun()
+    st.rerun(scope="fragment")
 
 
 if __name__ == "__main__":
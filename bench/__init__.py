@@ -0,0 +1,8 @@
+"""
+Offline benchmarks for LENAH.
+
+Everything here runs the real app / src code paths against in-process fake
+OpenAI and Gmail backends, so no credentials or network access are needed.
+
+    python -m bench.turn_latency
+"""
@@ -0,0 +1,523 @@
+"""
+In-process stand-ins for the OpenAI client and the Gmail API service.
+
+Both fakes mimic only the object shapes LENAH actually touches, count every
+"network" call per session and can inject a fixed latency per call so that
+benchmarks can model a slow upstream without hitting one.
+"""
+from __future__ import annotations
+
+import base64
+import contextvars
+import itertools
+import json
+import re
+import threading
+import time
+from collections import Counter
+from email import message_from_bytes
+from email.policy import default
+from types import SimpleNamespace
+from typing import Any, Callable
+
+from src.utils import EMAIL_RE
+
+
+# ---------------------------------------------------------------------------
+# Call accounting
+# ---------------------------------------------------------------------------
+
+class CallCounter:
+    """
+    Per-session counters so concurrent sessions don't see each other's calls.
+
+    Kept in a context variable rather than a thread-local so calls a turn
+    fans out to a thread pool (bulk drafting) are still counted against it.
+    """
+
+    def __init__(self) -> None:
+        self._var: contextvars.ContextVar[Counter | None] = contextvars.ContextVar(
+            f"call_counter_{id(self)}", default=None
+        )
+        self._lock = threading.Lock()
+
+    @property
+    def counts(self) -> Counter:
+        counts = self._var.get()
+        if counts is None:
+            counts = Counter()
+            self._var.set(counts)
+        return counts
+
+    def hit(self, name: str, n: int = 1) -> None:
+        counts = self.counts
+        with self._lock:
+            counts[name] += n
+
+    def snapshot(self) -> Counter:
+        return Counter(self.counts)
+
+
+class InstrumentedLock:
+    """A mutex that records how often, and for how long, callers had to wait."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.acquisitions = 0
+        self.contended = 0
+        self.wait_seconds = 0.0
+
+    def __enter__(self) -> "InstrumentedLock":
+        if self._lock.acquire(blocking=False):
+            waited = 0.0
+            contended = False
+        else:
+            start = time.perf_counter()
+            self._lock.acquire()
+            waited = time.perf_counter() - start
+            contended = True
+        with self._stats_lock:
+            self.acquisitions += 1
+            self.contended += contended
+            self.wait_seconds += waited
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._lock.release()
+
+    def stats(self) -> dict[str, float]:
+        with self._stats_lock:
+            return {
+                "acquisitions": self.acquisitions,
+                "contended": self.contended,
+                "contention_ratio": round(self.contended / self.acquisitions, 4) if self.acquisitions else 0.0,
+                "wait_seconds": round(self.wait_seconds, 4),
+            }
+
+
+# ---------------------------------------------------------------------------
+# OpenAI
+# ---------------------------------------------------------------------------
+
+_FILLER = (
+    "Thank you for getting back to me. I am looking for a two bedroom flat "
+    "close to good transport links, ideally with outdoor space, and would be "
+    "grateful for any suitable listings, pricing details and viewing slots."
+)
+
+
+_LISTING_RE = re.compile(
+    r"(\d+)-bed in ([A-Z][\w ]+?) at £([\d,]+) (pcm|pw)(?:,? available (now|from [\w ]+?))?[,.]"
+)
+
+
+def _fake_listings(text: str) -> list[dict]:
+    """What a careful model would pull out of AGENT_REPLY_BODY-style text."""
+    return [
+        {
+            "address": "",
+            "area": area,
+            "price": int(price.replace(",", "")),
+            "period": period,
+            "bedrooms": int(beds),
+            "available": "now" if when == "now" else None,
+            "notes": "",
+        }
+        for beds, area, price, period, when in _LISTING_RE.findall(text)
+    ]
+
+
+class PrefixCache:
+    """
+    The provider's automatic prompt caching, approximately: a prompt reuses
+    the longest run of leading messages (tools included) seen in a recent
+    request, counted in 128-token blocks and only from 1024 tokens up.
+    """
+
+    MIN_TOKENS = 1024
+    BLOCK = 128
+
+    def __init__(self, capacity: int = 50_000) -> None:
+        self.capacity = capacity
+        self._seen: dict[int, None] = {}
+        self._lock = threading.Lock()
+
+    def cached_tokens(self, tools: Any, messages: list[dict]) -> int:
+        h = hash(json.dumps(tools, sort_keys=True)) if tools else 0
+        chars = hit_chars = 0
+        prefixes: list[int] = []
+        for m in messages:
+            text = str(m.get("content") or "")
+            h = hash((h, m.get("role"), text))
+            chars += len(text)
+            prefixes.append(h)
+            with self._lock:
+                if h in self._seen:
+                    hit_chars = chars
+        with self._lock:
+            for h in prefixes:
+                self._seen[h] = None
+            while len(self._seen) > self.capacity:
+                del self._seen[next(iter(self._seen))]
+        tokens = hit_chars // 4
+        return tokens // self.BLOCK * self.BLOCK if tokens >= self.MIN_TOKENS else 0
+
+
+def _usage(messages: list[dict], completion: str) -> SimpleNamespace:
+    prompt_tokens = sum(len(str(m.get("content") or "")) for m in messages) // 4
+    return SimpleNamespace(
+        prompt_tokens=prompt_tokens,
+        completion_tokens=len(completion) // 4,
+        total_tokens=prompt_tokens + len(completion) // 4,
+        prompt_tokens_details=SimpleNamespace(cached_tokens=0),
+    )
+
+
+def _response(messages: list[dict], content: str | None, tool_calls=None) -> SimpleNamespace:
+    message = SimpleNamespace(content=content, tool_calls=tool_calls)
+    return SimpleNamespace(
+        choices=[SimpleNamespace(message=message)],
+        usage=_usage(messages, content or ""),
+    )
+
+
+class _FakeCompletions:
+    def __init__(self, owner: "FakeOpenAI") -> None:
+        self._owner = owner
+
+    def create(self, **kwargs: Any) -> SimpleNamespace:
+        return self._owner._create(**kwargs)
+
+
+class FakeOpenAI:
+    """
+    Rule-based replacement for ``openai.OpenAI``.
+
+    The behaviour is keyed off the request shape rather than exact prompt
+    text so it keeps working as prompts evolve:
+      - ``tools`` present          → conversational ``chat`` call
+      - "classifier" in system     → approve / refine label
+      - JSON-only system prompt    → drafted ``{"subject", "body"}``
+      - anything else              → plain-text summary
+    """
+
+    def __init__(self, *, latency_s: float = 0.0, counter: CallCounter | None = None) -> None:
+        self.latency_s = latency_s
+        self.counter = counter or CallCounter()
+        self.prefix_cache = PrefixCache()
+        self.chat = SimpleNamespace(completions=_FakeCompletions(self))
+
+    def _create(self, **kwargs: Any) -> SimpleNamespace:
+        self.counter.hit("llm")
+        if self.latency_s:
+            time.sleep(self.latency_s)
+        resp = self._respond(**kwargs)
+        resp.usage.prompt_tokens_details.cached_tokens = min(
+            resp.usage.prompt_tokens,
+            self.prefix_cache.cached_tokens(kwargs.get("tools"), kwargs.get("messages") or []),
+        )
+        self.counter.hit("llm.prompt_tokens", resp.usage.prompt_tokens)
+        self.counter.hit("llm.cached_tokens", resp.usage.prompt_tokens_details.cached_tokens)
+        return resp
+
+    def _respond(self, **kwargs: Any) -> SimpleNamespace:
+        messages: list[dict] = kwargs.get("messages") or []
+        system = " ".join(
+            str(m.get("content") or "") for m in messages if m.get("role") == "system"
+        )
+        last_user = next(
+            (str(m.get("content") or "") for m in reversed(messages) if m.get("role") == "user"),
+            "",
+        )
+
+        if kwargs.get("tools"):
+            return self._chat(messages, last_user)
+        if "classifier" in system:
+            text = last_user.strip().lower()
+            approve = any(w in text for w in ("send it", "send them", "yes", "looks good", "go ahead"))
+            return _response(messages, "approve" if approve else "refine")
+        if "Extract every property listing" in system:
+            return _response(messages, json.dumps({"listings": _fake_listings(last_user)}))
+        if "Return ONLY valid JSON" in system:
+            body = f"Hello,\n\n{_FILLER}\n\n{last_user[:200]}\n\nLENAH – AI Assistant"
+            return _response(messages, json.dumps({"subject": "Property enquiry", "body": body}))
+        return _response(messages, "The agent has two flats available and offered viewings on Saturday.")
+
+    def _chat(self, messages: list[dict], last_user: str) -> SimpleNamespace:
+        text = last_user.lower()
+        name: str | None = None
+        args: dict[str, Any] = {}
+        if "summary" in text or "email me" in text:
+            name = "send_summary_to_user"
+        elif "agent" in text or "contact" in text or "enquir" in text:
+            name = "send_email_to_agent"
+            found = EMAIL_RE.search(last_user)
+            if found:
+                args["agent_email"] = found.group(0)
+
+        if name is None:
+            words = max(20, min(300, len(last_user.split()) * 8))
+            return _response(messages, " ".join(itertools.islice(itertools.cycle(_FILLER.split()), words)))
+
+        tool_call = SimpleNamespace(
+            function=SimpleNamespace(name=name, arguments=json.dumps(args)),
+        )
+        return _response(messages, None, tool_calls=[tool_call])
+
+
+# ---------------------------------------------------------------------------
+# Gmail
+# ---------------------------------------------------------------------------
+
+def _b64(text: str) -> str:
+    return base64.urlsafe_b64encode(text.encode("utf-8")).decode("ascii")
+
+
+class _Request:
+    def __init__(self, service: "FakeGmailService", endpoint: str, fn) -> None:
+        self._service = service
+        self._endpoint = endpoint
+        self._fn = fn
+
+    def execute(self) -> dict:
+        self._service.counter.hit("gmail")
+        self._service.counter.hit(f"gmail.{self._endpoint}")
+        lock = self._service.request_lock
+        if lock is None:
+            return self._call()
+        with lock:
+            return self._call()
+
+    def _call(self) -> dict:
+        if self._service.latency_s:
+            time.sleep(self._service.latency_s)
+        return self._fn()
+
+
+class _Batch:
+    """``new_batch_http_request()``: one round trip for all added requests."""
+
+    def __init__(self, service: "FakeGmailService", callback) -> None:
+        self._service = service
+        self._callback = callback
+        self._requests: list[tuple[str, _Request]] = []
+
+    def add(self, request: _Request, callback=None, request_id: str | None = None) -> None:
+        self._requests.append((request_id or str(len(self._requests)), request))
+
+    def execute(self) -> None:
+        def run() -> list[tuple[str, Any, Exception | None]]:
+            out = []
+            for request_id, request in self._requests:
+                try:
+                    out.append((request_id, request._fn(), None))
+                except Exception as exc:  # noqa: BLE001
+                    out.append((request_id, None, exc))
+            return out
+
+        for request_id, response, exc in _Request(self._service, "batch", run).execute():
+            self._callback(request_id, response, exc)
+
+
+class _Resource:
+    def __init__(self, **methods) -> None:
+        self.__dict__.update(methods)
+
+
+class FakeGmailService:
+    """
+    Minimal Gmail ``users()`` resource tree backed by an in-memory mailbox.
+
+    Outbound sends land in a thread labelled ``SENT``; benchmarks simulate the
+    agent side with :meth:`inject_reply`.
+
+    With ``serialise=True`` every request holds one process-wide lock for its
+    duration, modelling the single non-thread-safe HTTP connection behind the
+    ``st.cache_resource`` GmailClient singleton.
+    """
+
+    def __init__(
+        self,
+        *,
+        latency_s: float = 0.0,
+        counter: CallCounter | None = None,
+        serialise: bool = False,
+    ) -> None:
+        self.latency_s = latency_s
+        self.counter = counter or CallCounter()
+        self.request_lock: InstrumentedLock | None = InstrumentedLock() if serialise else None
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self.threads: dict[str, list[dict]] = {}
+        # (historyId, message) for every message added, oldest first.
+        self.history: list[tuple[int, dict]] = []
+        # users.watch: Pub/Sub topic and expiry (epoch ms) while watching, and
+        # what to call with (emailAddress, historyId) on each inbound message —
+        # e.g. src.push.simulate, to post the notification Gmail would.
+        self.watching: dict[str, Any] | None = None
+        self.on_push: Callable[[str, int], None] | None = None
+        # (message id, attachmentId) -> content
+        self.attachments: dict[tuple[str, str], bytes] = {}
+
+    # -- mailbox -----------------------------------------------------------
+
+    def _next_id(self) -> str:
+        return f"{next(self._ids):016x}"
+
+    def _message(self, thread_id: str, *, sender: str, to: str, subject: str,
+                 body: str, labels: list[str], headers: dict[str, str] | None = None) -> dict:
+        msg_id = self._next_id()
+        all_headers = {
+            "From": sender,
+            "To": to,
+            "Subject": subject,
+            "Message-Id": f"<{msg_id}@fake.mail>",
+            **(headers or {}),
+        }
+        msg = {
+            "id": msg_id,
+            "threadId": thread_id,
+            "labelIds": labels,
+            "internalDate": str(int(time.time() * 1000)),
+            "payload": {
+                "mimeType": "text/plain",
+                "headers": [{"name": k, "value": v} for k, v in all_headers.items()],
+                "body": {"data": _b64(body), "size": len(body)},
+            },
+        }
+        self.history.append((len(self.history) + 1, msg))
+        return msg
+
+    def inject_reply(self, thread_id: str, *, sender: str, body: str,
+                     attachments: list[tuple[str, str, bytes]] | None = None) -> str:
+        """
+        Append an inbound agent message to ``thread_id``; returns its id.
+        ``attachments`` are (filename, mime type, content) triples.
+        """
+        with self._lock:
+            thread = self.threads.setdefault(thread_id, [])
+            subject = "Re: Property enquiry"
+            msg = self._message(thread_id, sender=sender, to="lenah@fake.mail",
+                                subject=subject, body=body, labels=["INBOX", "UNREAD"])
+            if attachments:
+                text_part = {**msg["payload"], "partId": "0", "filename": ""}
+                parts = [text_part]
+                for n, (filename, mime, content) in enumerate(attachments, 1):
+                    attachment_id = f"att-{self._next_id()}"
+                    self.attachments[(msg["id"], attachment_id)] = content
+                    parts.append({
+                        "partId": str(n), "mimeType": mime, "filename": filename, "headers": [],
+                        "body": {"attachmentId": attachment_id, "size": len(content)},
+                    })
+                msg["payload"] = {"mimeType": "multipart/mixed", "headers": text_part["headers"], "parts": parts}
+            thread.append(msg)
+            history_id = len(self.history)
+        if self.watching is not None and self.on_push is not None:
+            self.on_push("lenah@fake.mail", history_id)
+        return msg["id"]
+
+    # -- API surface -------------------------------------------------------
+
+    def new_batch_http_request(self, callback=None) -> _Batch:
+        return _Batch(self, callback)
+
+    def users(self) -> _Resource:
+        return _Resource(
+            messages=lambda: _Resource(
+                send=self._send,
+                get=self._get_message,
+                attachments=lambda: _Resource(get=self._get_attachment),
+            ),
+            threads=lambda: _Resource(get=self._get_thread),
+            history=lambda: _Resource(list=self._list_history),
+            getProfile=self._get_profile,
+            watch=self._watch,
+            stop=self._stop_watch,
+        )
+
+    def _send(self, *, userId: str, body: dict) -> _Request:
+        def run() -> dict:
+            parsed = message_from_bytes(base64.urlsafe_b64decode(body["raw"]), policy=default)
+            with self._lock:
+                thread_id = body.get("threadId") or self._next_id()
+                msg = self._message(
+                    thread_id,
+                    sender="lenah@fake.mail",
+                    to=str(parsed.get("To", "")),
+                    subject=str(parsed.get("Subject", "")),
+                    body=parsed.get_content(),
+                    labels=["SENT"],
+                )
+                self.threads.setdefault(thread_id, []).append(msg)
+            return {"id": msg["id"], "threadId": thread_id, "labelIds": ["SENT"]}
+
+        return _Request(self, "messages.send", run)
+
+    def _get_message(self, *, userId: str, id: str, **_: Any) -> _Request:
+        def run() -> dict:
+            for thread in self.threads.values():
+                for msg in thread:
+                    if msg["id"] == id:
+                        return msg
+            raise KeyError(id)
+
+        return _Request(self, "messages.get", run)
+
+    def _get_attachment(self, *, userId: str, messageId: str, id: str) -> _Request:
+        def run() -> dict:
+            content = self.attachments[(messageId, id)]
+            return {"size": len(content), "data": base64.urlsafe_b64encode(content).decode("ascii")}
+
+        return _Request(self, "messages.attachments.get", run)
+
+    def _get_thread(self, *, userId: str, id: str, format: str = "full", **_: Any) -> _Request:
+        def run() -> dict:
+            with self._lock:
+                messages = [dict(m) for m in self.threads.get(id, [])]
+            if format == "metadata":
+                for m in messages:
+                    m["payload"] = {**m["payload"], "body": {}}
+            return {"id": id, "messages": messages}
+
+        return _Request(self, "threads.get", run)
+
+    def _get_profile(self, *, userId: str) -> _Request:
+        def run() -> dict:
+            with self._lock:
+                return {"emailAddress": "lenah@fake.mail", "historyId": str(len(self.history))}
+
+        return _Request(self, "getProfile", run)
+
+    def _watch(self, *, userId: str, body: dict) -> _Request:
+        def run() -> dict:
+            with self._lock:
+                expiration = int((time.time() + 7 * 24 * 3600) * 1000)
+                self.watching = {"topic": body["topicName"], "expiration": expiration}
+                return {"historyId": str(len(self.history)), "expiration": str(expiration)}
+
+        return _Request(self, "watch", run)
+
+    def _stop_watch(self, *, userId: str) -> _Request:
+        def run() -> dict:
+            with self._lock:
+                self.watching = None
+            return {}
+
+        return _Request(self, "stop", run)
+
+    def _list_history(self, *, userId: str, startHistoryId: str, labelId: str | None = None,
+                      pageToken: str | None = None, **_: Any) -> _Request:
+        def run() -> dict:
+            with self._lock:
+                start = int(startHistoryId)
+                records = [
+                    {"id": str(hid), "messagesAdded": [{"message": {
+                        "id": m["id"], "threadId": m["threadId"], "labelIds": m["labelIds"],
+                    }}]}
+                    for hid, m in self.history[start:]
+                    if labelId is None or labelId in m["labelIds"]
+                ]
+                return {"history": records, "historyId": str(len(self.history))}
+
+        return _Request(self, "history.list", run)
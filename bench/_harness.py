@@ -0,0 +1,252 @@
+"""
+Headless driver for app.py.
+
+``install()`` swaps Streamlit's ``st`` module reference in app.py for a
+small shim whose ``session_state`` is a plain attribute-dict bound to the
+current thread, points ``src.llm`` at :class:`FakeOpenAI` and the Gmail
+client at :class:`FakeGmailService`, and redirects ``UserStore`` files to a
+scratch directory. A :class:`HeadlessSession` then replays the exact call
+sequence ``main()`` performs for each kind of user action.
+"""
+from __future__ import annotations
+
+import json
+import os
+import subprocess
+import tempfile
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any
+
+# src.llm refuses to import without a key; the fake client never uses it.
+os.environ.setdefault("OPENAI_API_KEY", "bench-placeholder")
+
+import app  # noqa: E402
+import src.llm  # noqa: E402
+import src.recall  # noqa: E402
+import src.search  # noqa: E402
+import src.session  # noqa: E402
+import src.thread_index  # noqa: E402
+from src.gmail_client import GmailClient  # noqa: E402
+from src.recorder import record_turn  # noqa: E402
+from src.session import UserStore, flush_pending, open_user_store  # noqa: E402
+
+from bench._fakes import CallCounter, FakeGmailService, FakeOpenAI  # noqa: E402
+from bench.conversations import AGENT_REPLY_BODY, Step  # noqa: E402
+
+
+# ---------------------------------------------------------------------------
+# Streamlit shim
+# ---------------------------------------------------------------------------
+
+class SessionState(dict):
+    """Attribute-access dict, enough of ``st.session_state`` for app.py."""
+
+    def __getattr__(self, name: str) -> Any:
+        try:
+            return self[name]
+        except KeyError as exc:
+            raise AttributeError(name) from exc
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        self[name] = value
+
+
+class _StreamlitShim:
+    """Stands in for the ``st`` module inside app.py; one session per thread."""
+
+    def __init__(self) -> None:
+        self._local = threading.local()
+
+    @property
+    def session_state(self) -> SessionState:
+        return self._local.state
+
+    def bind(self, state: SessionState) -> None:
+        self._local.state = state
+
+
+@dataclass
+class Backends:
+    llm: Any
+    gmail: Any
+    counter: CallCounter
+    users_dir: Path
+    shim: _StreamlitShim
+
+
+def install(
+    *,
+    llm_latency_s: float = 0.0,
+    gmail_latency_s: float = 0.0,
+    serialise_gmail: bool = False,
+    users_dir: Path | None = None,
+    llm: Any = None,
+    gmail: Any = None,
+) -> Backends:
+    """
+    Patch app.py / src for headless runs and return the fake backends.
+
+    ``llm`` / ``gmail`` override the default rule-based fakes (the replay
+    tool passes backends that serve recorded responses instead).
+    """
+    counter = CallCounter()
+    if llm is None:
+        llm = FakeOpenAI(latency_s=llm_latency_s, counter=counter)
+    if gmail is None:
+        gmail = FakeGmailService(latency_s=gmail_latency_s, counter=counter, serialise=serialise_gmail)
+
+    client = GmailClient(credentials_path="", token_path="", scopes=())
+    object.__setattr__(client, "_service", gmail)
+
+    users_dir = users_dir or Path(tempfile.mkdtemp(prefix="lenah-bench-"))
+    shim = _StreamlitShim()
+
+    src.llm._client = llm
+    src.session.USERS_DIR = users_dir
+    src.thread_index._index = src.thread_index.SqliteThreadIndex(users_dir / "thread_index.sqlite")
+    src.search.SEARCH_DIR = users_dir / "search"
+    src.recall.EMBED_DIR = users_dir / "recall"
+    app.st = shim
+    # Every mailbox shard shares the one fake mailbox.
+    app._mailbox_client = lambda name: client
+
+    return Backends(llm=llm, gmail=gmail, counter=counter, users_dir=users_dir, shim=shim)
+
+
+# ---------------------------------------------------------------------------
+# Session driver
+# ---------------------------------------------------------------------------
+
+@dataclass
+class TurnResult:
+    kind: str
+    seconds: float
+    calls: dict[str, int]
+    bytes_persisted: int
+
+
+@dataclass
+class HeadlessSession:
+    """One logged-in user, driven the same way ``main()`` drives the app."""
+
+    backends: Backends
+    email: str
+    state: SessionState = field(default_factory=SessionState)
+
+    def __post_init__(self) -> None:
+        self.backends.shim.bind(self.state)
+        app._init_state()
+        store = open_user_store(self.email)
+        self.state.update(store.load())
+        store.spill_cold(self.state)
+        if not self.state.user_email:
+            self.state.user_email = store.email
+        self.state["_user_store"] = store
+
+    def seed(self, messages: list[dict]) -> None:
+        """Start from an existing, already persisted history."""
+        self.backends.shim.bind(self.state)
+        self.state.messages = messages
+        app._save_state()
+        flush_pending(self.store.user_id)
+
+    @property
+    def store(self) -> UserStore:
+        return self.state["_user_store"]
+
+    def _measure(self, kind: str, fn) -> TurnResult:
+        self.backends.shim.bind(self.state)
+        before = self.backends.counter.snapshot()
+        written = self.store.bytes_written
+        start = time.perf_counter()
+        app._refresh_state()
+        fn()
+        app._save_state()
+        elapsed = time.perf_counter() - start
+        # Write-behind saves land after the turn returns; settle them (off
+        # the clock) so their bytes are attributed to this turn.
+        flush_pending(self.store.user_id)
+        calls = self.backends.counter.snapshot() - before
+        return TurnResult(
+            kind=kind,
+            seconds=elapsed,
+            calls=dict(calls),
+            bytes_persisted=self.store.bytes_written - written,
+        )
+
+    def say(self, text: str, kind: str = "chat") -> TurnResult:
+        """Chat-input path: append, dispatch, persist."""
+        def run() -> None:
+            app._add("user", text)
+            with record_turn("message", text, self.state):
+                app._handle_message(text)
+
+        return self._measure(kind, run)
+
+    def check_replies(self, kind: str = "check_replies") -> TurnResult:
+        """Sidebar "Check for new replies" path."""
+        def run() -> None:
+            with record_turn("check_replies", None, self.state):
+                app._check_agent_replies()
+
+        return self._measure(kind, run)
+
+    def new_chat(self) -> TurnResult:
+        """Sidebar "New chat" path."""
+        def run() -> None:
+            self.state.messages = []
+            self.state.archived_count = 0
+            self.state.pending_email = None
+            self.store.clear_archive()
+
+        return self._measure("new_chat", run)
+
+    def play(self, steps: list[Step]) -> list[TurnResult]:
+        """Run a scripted conversation (see bench.conversations)."""
+        results: list[TurnResult] = []
+        for op, arg, kind in steps:
+            if op == "say":
+                results.append(self.say(arg or "", kind=kind))
+            elif op == "check":
+                results.append(self.check_replies(kind=kind))
+            elif op == "new_chat":
+                results.append(self.new_chat())
+            elif op == "reply":
+                thread_id = self.state.agent_threads.get(arg)
+                if thread_id:
+                    self.backends.gmail.inject_reply(thread_id, sender=arg or "", body=AGENT_REPLY_BODY)
+        return results
+
+
+# ---------------------------------------------------------------------------
+# Reporting
+# ---------------------------------------------------------------------------
+
+def percentile(values: list[float], pct: float) -> float:
+    """Linear-interpolated percentile; ``pct`` in [0, 100]."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * pct / 100
+    lo = int(rank)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (rank - lo)
+
+
+def git_revision() -> str:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return out.stdout.strip() or "unknown"
+
+
+def write_results(path: Path, payload: dict) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(payload, indent=2, sort_keys=True), encoding="utf-8")
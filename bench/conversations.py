@@ -0,0 +1,90 @@
+"""
+Scripted multi-turn conversations for the benchmarks.
+
+A conversation is a list of steps. Each step is ``(op, arg, kind)``:
+    ("say", text, kind)         — user sends a chat message
+    ("reply", agent_email, "")  — the agent answers in their Gmail thread
+    ("check", None, kind)       — user clicks "Check for new replies"
+    ("new_chat", None, "")      — user clicks "New chat"
+
+``kind`` is the label the turn is reported under.
+"""
+from __future__ import annotations
+
+import json
+from pathlib import Path
+
+Step = tuple[str, "str | None", str]
+
+FOXTONS = "lettings@foxtons.example.com"
+KFH = "sales@kfh.example.com"
+
+AGENT_REPLY_BODY = (
+    "Hi,\n\nThanks for your enquiry. We currently have two flats that may suit: "
+    "a 2-bed in Dalston at £1,950 pcm available from 1 March, and a 2-bed in "
+    "Hackney Central at £2,100 pcm available now. Would Saturday morning work "
+    "for viewings? Please also confirm your move-in date and whether you have "
+    "a guarantor.\n\nKind regards,\nSam"
+)
+
+ENQUIRY_WITH_REFINE: list[Step] = [
+    ("say", "Hi, I'm looking for a 2 bed flat in Hackney under £2,000 a month.", "chat"),
+    ("say", "How is the commute from there to Liverpool Street?", "chat"),
+    ("say", f"Please contact the agent at {FOXTONS} about this.", "agent_enquiry"),
+    ("check", None, "check_replies_miss"),
+    ("reply", FOXTONS, ""),
+    ("check", None, "check_replies_hit"),
+    ("say", "Make it a bit more formal.", "refine"),
+    ("say", "Also ask whether parking is included.", "refine"),
+    ("say", "send it", "approve_send"),
+    ("say", "Can you email me a summary of what we've discussed?", "summary"),
+]
+
+ENQUIRY_ASK_FOR_ADDRESS: list[Step] = [
+    ("say", "Any good schools near Stoke Newington?", "chat"),
+    ("say", "Can you email the agent for me?", "agent_prompt"),
+    ("say", f"Sure, it's {KFH}", "agent_enquiry"),
+    ("reply", KFH, ""),
+    ("check", None, "check_replies_hit"),
+    ("say", "yes looks good, send it", "approve_send"),
+    ("new_chat", None, ""),
+]
+
+SCRIPTED: dict[str, list[Step]] = {
+    "enquiry_with_refine": ENQUIRY_WITH_REFINE,
+    "enquiry_ask_for_address": ENQUIRY_ASK_FOR_ADDRESS,
+}
+
+
+def from_user_files(users_dir: Path) -> dict[str, list[Step]]:
+    """Replay the user side of each saved ``data/users/*.json`` history."""
+    conversations: dict[str, list[Step]] = {}
+    for path in sorted(users_dir.glob("*.json")):
+        try:
+            data = json.loads(path.read_text(encoding="utf-8"))
+        except (json.JSONDecodeError, OSError):
+            continue
+        steps: list[Step] = [
+            ("say", m["content"], "recorded")
+            for m in data.get("messages") or []
+            if m.get("role") == "user" and m.get("content")
+        ]
+        if steps:
+            conversations[f"recorded:{path.stem}"] = steps
+    return conversations
+
+
+def synthetic_history(n: int) -> list[dict]:
+    """``n`` alternating user / assistant messages of realistic length."""
+    user = "What about two bed flats near the Overground with a garden?"
+    assistant = (
+        "Here are a few things to weigh up:\n\n"
+        "1. **Area** — Dalston and Hackney Central both have Overground stations.\n"
+        "2. **Budget** — expect £1,900–£2,300 pcm for a 2-bed with outdoor space.\n"
+        "3. **Commute** — about 15 minutes to Liverpool Street.\n\n"
+        "Would you like me to contact an agent about any of these?"
+    )
+    return [
+        {"role": "user", "content": user} if i % 2 == 0 else {"role": "assistant", "content": assistant}
+        for i in range(n)
+    ]
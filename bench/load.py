@@ -0,0 +1,152 @@
+"""
+Multi-user concurrent load generator.
+
+Simulates N simultaneous LENAH sessions in one process, each with its own
+``UserStore``, all sharing the process-wide singletons the real app shares
+(the OpenAI client and the ``st.cache_resource`` GmailClient). Every
+virtual user plays the scripted chat → agent enquiry → reply check →
+refine → send flow against fake backends with configurable latency.
+
+For each concurrency level it reports throughput, tail latency, memory per
+session and contention on the shared Gmail client:
+
+    python -m bench.load --concurrency 1,4,16,64 --rounds 3 --llm-latency-ms 400
+"""
+from __future__ import annotations
+
+import argparse
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from bench._harness import (
+    HeadlessSession,
+    TurnResult,
+    git_revision,
+    install,
+    percentile,
+    write_results,
+)
+from bench.conversations import ENQUIRY_WITH_REFINE
+
+RESULTS_DIR = Path("bench/results")
+
+
+def _virtual_user(backends, index: int, rounds: int) -> tuple[list[TurnResult], HeadlessSession]:
+    session = HeadlessSession(backends=backends, email=f"load-{index}@example.com")
+    results: list[TurnResult] = []
+    for _ in range(rounds):
+        results.extend(session.play(ENQUIRY_WITH_REFINE))
+    return results, session
+
+
+def run_level(
+    concurrency: int,
+    *,
+    rounds: int,
+    llm_latency_s: float,
+    gmail_latency_s: float,
+    serialise_gmail: bool,
+    track_memory: bool,
+) -> dict:
+    backends = install(
+        llm_latency_s=llm_latency_s,
+        gmail_latency_s=gmail_latency_s,
+        serialise_gmail=serialise_gmail,
+    )
+
+    if track_memory:
+        tracemalloc.start()
+        mem_before, _ = tracemalloc.get_traced_memory()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = [pool.submit(_virtual_user, backends, i, rounds) for i in range(concurrency)]
+        outcomes = [f.result() for f in futures]
+    wall = time.perf_counter() - started
+
+    mem_per_session = None
+    if track_memory:
+        mem_after, mem_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        mem_per_session = {
+            "retained_bytes": round((mem_after - mem_before) / concurrency),
+            "peak_bytes": round((mem_peak - mem_before) / concurrency),
+        }
+
+    turns = [r for results, _session in outcomes for r in results]
+    ms = [r.seconds * 1000 for r in turns]
+    lock = backends.gmail.request_lock
+    return {
+        "concurrency": concurrency,
+        "turns": len(turns),
+        "wall_seconds": round(wall, 3),
+        "throughput_turns_per_s": round(len(turns) / wall, 2) if wall else 0.0,
+        "p50_ms": round(percentile(ms, 50), 3),
+        "p95_ms": round(percentile(ms, 95), 3),
+        "p99_ms": round(percentile(ms, 99), 3),
+        "max_ms": round(max(ms), 3) if ms else 0.0,
+        "memory_per_session": mem_per_session,
+        "gmail_lock": lock.stats() if lock else None,
+    }
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", default="1,2,4,8,16,32",
+                        help="comma-separated numbers of simultaneous sessions")
+    parser.add_argument("--rounds", type=int, default=2, help="flows played per session")
+    parser.add_argument("--llm-latency-ms", type=float, default=50.0)
+    parser.add_argument("--gmail-latency-ms", type=float, default=20.0)
+    parser.add_argument("--no-serialise-gmail", action="store_true",
+                        help="let Gmail requests overlap instead of sharing one connection")
+    parser.add_argument("--no-memory", action="store_true", help="skip tracemalloc accounting")
+    parser.add_argument("--out", type=Path, default=None, help="results JSON path")
+    args = parser.parse_args(argv)
+
+    levels = [int(x) for x in args.concurrency.split(",") if x.strip()]
+    rows = []
+    header = f"{'users':>6}{'turns/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'KiB/sess':>10}{'lock wait s':>13}{'contended':>11}"
+    print(header)
+    print("-" * len(header))
+    for n in levels:
+        row = run_level(
+            n,
+            rounds=args.rounds,
+            llm_latency_s=args.llm_latency_ms / 1000,
+            gmail_latency_s=args.gmail_latency_ms / 1000,
+            serialise_gmail=not args.no_serialise_gmail,
+            track_memory=not args.no_memory,
+        )
+        rows.append(row)
+        mem = row["memory_per_session"] or {}
+        lock = row["gmail_lock"] or {}
+        print(
+            f"{n:>6}{row['throughput_turns_per_s']:>10.1f}{row['p50_ms']:>10.1f}"
+            f"{row['p95_ms']:>10.1f}{row['p99_ms']:>10.1f}"
+            f"{mem.get('retained_bytes', 0) / 1024:>10.1f}"
+            f"{lock.get('wait_seconds', 0.0):>13.3f}{lock.get('contention_ratio', 0.0):>11.1%}"
+        )
+
+    revision = git_revision()
+    out = args.out or RESULTS_DIR / f"load-{revision}.json"
+    write_results(out, {
+        "benchmark": "load",
+        "revision": revision,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "params": {
+            "rounds": args.rounds,
+            "llm_latency_ms": args.llm_latency_ms,
+            "gmail_latency_ms": args.gmail_latency_ms,
+            "serialise_gmail": not args.no_serialise_gmail,
+        },
+        "levels": rows,
+    })
+    print(f"\nwrote {out}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
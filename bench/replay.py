@@ -0,0 +1,194 @@
+"""
+Deterministic replay of a recorded session trace.
+
+Record a session by running the app with ``LENAH_RECORD_DIR`` set; each turn
+lands as one JSON line (see src/recorder.py). This tool re-runs every turn
+against the current code, feeding back the recorded OpenAI and Gmail
+responses in order, and reports per-turn timings next to the recorded
+ones plus whether the resulting state still matches:
+
+    python -m bench.replay data/traces/80c019bd4cda9204-20261019T101500.jsonl
+    python -m bench.replay trace.jsonl --repeat 20 --out bench/results/replay.json
+
+A turn "diverges" when the current code makes a different sequence of
+calls than the recording, or ends in a different state.
+"""
+from __future__ import annotations
+
+import argparse
+import copy
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any
+
+from bench._harness import (  # must precede app: sets a placeholder API key
+    HeadlessSession,
+    git_revision,
+    install,
+    percentile,
+    write_results,
+)
+import app  # noqa: E402
+from src.recorder import read_trace
+from src.session import _STATE_KEYS
+from src.utils import frozen_clock
+
+
+class ReplayDivergence(Exception):
+    """The code under replay asked for something the recording doesn't have."""
+
+
+def _namespace(value: Any) -> Any:
+    if isinstance(value, dict):
+        return SimpleNamespace(**{k: _namespace(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return [_namespace(v) for v in value]
+    return value
+
+
+class _Tape:
+    """The recorded calls of one turn, consumed strictly in order."""
+
+    def __init__(self) -> None:
+        self.calls: list[dict] = []
+
+    def load(self, calls: list[dict]) -> None:
+        self.calls = list(calls)
+
+    def next(self, kind: str, endpoint: str | None = None) -> dict:
+        if not self.calls:
+            raise ReplayDivergence(f"unexpected extra {kind} call {endpoint or ''}".strip())
+        call = self.calls.pop(0)
+        if call["type"] != kind or (endpoint and call.get("endpoint") != endpoint):
+            raise ReplayDivergence(
+                f"expected {call['type']} {call.get('endpoint') or ''}, got {kind} {endpoint or ''}"
+            )
+        return call["response"]
+
+
+class ReplayOpenAI:
+    def __init__(self, tape: _Tape) -> None:
+        self._tape = tape
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _create(self, **_kwargs: Any) -> Any:
+        return _namespace(self._tape.next("llm"))
+
+
+class _ReplayRequest:
+    def __init__(self, tape: _Tape, endpoint: str) -> None:
+        self._tape = tape
+        self._endpoint = endpoint
+
+    def execute(self) -> dict:
+        return self._tape.next("gmail", self._endpoint)
+
+
+class _ReplayResource:
+    """``service.users().threads().get(...)`` → request for ``threads.get``."""
+
+    def __init__(self, tape: _Tape, path: tuple[str, ...] = ()) -> None:
+        self._tape = tape
+        self._path = path
+
+    def __getattr__(self, name: str):
+        def method(**kwargs: Any):
+            if kwargs:
+                return _ReplayRequest(self._tape, ".".join((*self._path, name)))
+            return _ReplayResource(self._tape, (*self._path, name))
+        return method
+
+
+class ReplayGmailService:
+    def __init__(self, tape: _Tape) -> None:
+        self._tape = tape
+
+    def users(self) -> _ReplayResource:
+        return _ReplayResource(self._tape)
+
+
+def replay(path: Path, repeat: int) -> dict:
+    turns = read_trace(path)
+    tape = _Tape()
+    backends = install(llm=ReplayOpenAI(tape), gmail=ReplayGmailService(tape))
+
+    rows: list[dict] = []
+    for index, turn in enumerate(turns):
+        timings: list[float] = []
+        error: str | None = None
+        state_matches = True
+        for _ in range(repeat):
+            before = turn["state_before"]
+            session = HeadlessSession(
+                backends=backends,
+                email=before.get("owner_email") or before.get("user_email") or "replay@example.com",
+            )
+            # Keys a trace predates keep what the session loaded.
+            recorded = [k for k in _STATE_KEYS if k in before]
+            session.state.update(copy.deepcopy({k: before[k] for k in recorded}))
+            backends.shim.bind(session.state)
+            tape.load(turn["calls"])
+
+            start = time.perf_counter()
+            try:
+                with frozen_clock(turn["ts"]):
+                    if turn["kind"] == "check_replies":
+                        app._check_agent_replies()
+                    else:
+                        app._handle_message(turn["user_text"] or "")
+                app._save_state()
+            except ReplayDivergence as exc:
+                error = str(exc)
+                break
+            timings.append(time.perf_counter() - start)
+
+            if tape.calls:
+                error = f"{len(tape.calls)} recorded call(s) not made"
+                break
+            after = {k: session.state.get(k) for k in recorded}
+            state_matches = after == {k: turn["state_after"].get(k) for k in recorded}
+
+        ms = [t * 1000 for t in timings]
+        rows.append({
+            "turn": index,
+            "kind": turn["kind"],
+            "recorded_ms": turn.get("duration_ms"),
+            "replay_p50_ms": round(percentile(ms, 50), 3),
+            "replay_p95_ms": round(percentile(ms, 95), 3),
+            "calls": len(turn["calls"]),
+            "diverged": bool(error) or not state_matches,
+            "error": error,
+        })
+    return {"trace": str(path), "turns": rows}
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("trace", type=Path, help="session trace JSONL")
+    parser.add_argument("--repeat", type=int, default=5, help="replays per turn")
+    parser.add_argument("--out", type=Path, default=None, help="results JSON path")
+    args = parser.parse_args(argv)
+
+    result = replay(args.trace, args.repeat)
+
+    print(f"{'turn':>5}  {'kind':<14}{'calls':>6}{'recorded ms':>13}{'replay p50':>12}{'replay p95':>12}  status")
+    for row in result["turns"]:
+        status = "DIVERGED" if row["diverged"] else "ok"
+        if row["error"]:
+            status += f" ({row['error']})"
+        print(
+            f"{row['turn']:>5}  {row['kind']:<14}{row['calls']:>6}{row['recorded_ms'] or 0:>13.2f}"
+            f"{row['replay_p50_ms']:>12.2f}{row['replay_p95_ms']:>12.2f}  {status}"
+        )
+
+    revision = git_revision()
+    out = args.out or Path("bench/results") / f"replay-{args.trace.stem}-{revision}.json"
+    write_results(out, {"benchmark": "replay", "revision": revision, "repeat": args.repeat, **result})
+    print(f"\nwrote {out}")
+    return 1 if any(r["diverged"] for r in result["turns"]) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
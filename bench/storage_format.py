@@ -0,0 +1,123 @@
+"""
+User state encoding benchmark.
+
+Saves and loads synthetic histories through the file-backed UserStore in
+each snapshot format and reports per format and history size:
+
+    save / load time (median of --repeat runs), bytes on disk, ratio vs json
+
+    python -m bench.storage_format
+    python -m bench.storage_format --sizes 100 1000 10000 --repeat 9 --formats json zlib
+
+zstd is skipped (with a note) unless the zstandard package is installed.
+"""
+from __future__ import annotations
+
+import argparse
+import random
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from bench._harness import git_revision, write_results  # must precede src: sets a placeholder API key
+from bench.conversations import synthetic_history
+import src.session  # noqa: E402
+from src.session import FORMATS, UserStore  # noqa: E402
+
+_WORDS = (
+    "flat garden overground budget viewing deposit landlord commute station "
+    "furnished bills council tax garden parking balcony survey offer agent"
+).split()
+
+
+def _history(n: int, seed: int = 7) -> list[dict]:
+    """synthetic_history with varied wording so compression is not flattered."""
+    rng = random.Random(seed)
+    messages = synthetic_history(n)
+    for i, m in enumerate(messages):
+        m["content"] = f"{m['content']} ({i}: {' '.join(rng.choices(_WORDS, k=12))})"
+    return messages
+
+
+def _state(messages: list[dict]) -> dict:
+    return {
+        "messages": messages,
+        "user_email": "bench@example.com",
+        "pending_email": None,
+        "agent_threads": {f"agent{i}@example.com": f"thread{i}" for i in range(20)},
+        "agent_last_message_id": {f"agent{i}@example.com": f"msg{i}" for i in range(20)},
+        "archived_count": 0,
+    }
+
+
+def measure(fmt: str, size: int, repeat: int) -> dict:
+    state = _state(_history(size))
+    saves: list[float] = []
+    loads: list[float] = []
+    nbytes = 0
+    for _ in range(repeat):
+        store = UserStore("bench@example.com")
+        store.format = fmt
+        start = time.perf_counter()
+        store.save(state)
+        saves.append(time.perf_counter() - start)
+        nbytes = store._path.stat().st_size
+
+        start = time.perf_counter()
+        loaded = UserStore("bench@example.com").load()
+        loads.append(time.perf_counter() - start)
+        assert len(loaded["messages"]) == size
+        store.delete()
+    return {
+        "format": fmt,
+        "messages": size,
+        "save_ms": round(statistics.median(saves) * 1000, 3),
+        "load_ms": round(statistics.median(loads) * 1000, 3),
+        "bytes": nbytes,
+    }
+
+
+def _available(fmt: str) -> bool:
+    try:
+        src.session.encode_state({}, fmt)
+    except RuntimeError as exc:
+        print(f"skipping {fmt}: {exc}")
+        return False
+    return True
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1_000, 10_000])
+    parser.add_argument("--formats", nargs="+", choices=FORMATS, default=list(FORMATS))
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--out", type=Path, default=None, help="results JSON path")
+    args = parser.parse_args(argv)
+
+    src.session.USERS_DIR = Path(tempfile.mkdtemp(prefix="lenah-bench-"))
+    formats = [f for f in args.formats if _available(f)]
+
+    rows = [measure(fmt, size, args.repeat) for size in args.sizes for fmt in formats]
+    baseline = {r["messages"]: r["bytes"] for r in rows if r["format"] == "json"}
+
+    print(f"{'messages':>9}  {'format':<7}{'save ms':>10}{'load ms':>10}{'bytes':>13}{'vs json':>9}")
+    print("-" * 60)
+    for r in rows:
+        ratio = r["bytes"] / baseline[r["messages"]] if r["messages"] in baseline else float("nan")
+        r["ratio_vs_json"] = round(ratio, 4)
+        print(
+            f"{r['messages']:>9}  {r['format']:<7}{r['save_ms']:>10.2f}{r['load_ms']:>10.2f}"
+            f"{r['bytes']:>13,}{ratio:>9.3f}"
+        )
+
+    revision = git_revision()
+    out = args.out or Path("bench/results") / f"storage_format-{revision}.json"
+    write_results(out, {"benchmark": "storage_format", "revision": revision, "repeat": args.repeat, "rows": rows})
+    print(f"\nwrote {out}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
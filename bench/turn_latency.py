@@ -0,0 +1,152 @@
+"""
+End-to-end per-turn latency benchmark.
+
+Replays scripted (and optionally recorded) conversations through the real
+``_handle_message`` / ``_run_pending`` / ``_check_agent_replies`` code with
+fake LLM and Gmail backends, then reports per turn type:
+
+    p50 / p95 / p99 latency, network calls per turn, bytes persisted per turn,
+    share of prompt tokens the provider would serve from its prefix cache
+
+Results are written as JSON keyed by git revision so two runs can be diffed:
+
+    python -m bench.turn_latency --iterations 50 --history 400
+    python -m bench.turn_latency --compare bench/results/turn_latency-abc1234.json
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import platform
+import sys
+import time
+from collections import defaultdict
+from pathlib import Path
+
+from bench._harness import (
+    HeadlessSession,
+    TurnResult,
+    git_revision,
+    install,
+    percentile,
+    write_results,
+)
+from bench.conversations import SCRIPTED, Step, from_user_files, synthetic_history
+
+RESULTS_DIR = Path("bench/results")
+
+
+def _run_conversation(backends, email: str, steps: list[Step], history: int) -> list[TurnResult]:
+    session = HeadlessSession(backends=backends, email=email)
+    if history:
+        session.seed(synthetic_history(history))
+    return session.play(steps)
+
+
+def summarise(results: list[TurnResult]) -> dict[str, dict]:
+    by_kind: dict[str, list[TurnResult]] = defaultdict(list)
+    for r in results:
+        by_kind[r.kind].append(r)
+
+    report: dict[str, dict] = {}
+    for kind, rows in sorted(by_kind.items()):
+        ms = [r.seconds * 1000 for r in rows]
+        calls: dict[str, float] = defaultdict(float)
+        for r in rows:
+            for name, n in r.calls.items():
+                calls[name] += n
+        report[kind] = {
+            "turns": len(rows),
+            "p50_ms": round(percentile(ms, 50), 3),
+            "p95_ms": round(percentile(ms, 95), 3),
+            "p99_ms": round(percentile(ms, 99), 3),
+            "mean_ms": round(sum(ms) / len(ms), 3),
+            "calls_per_turn": {k: round(v / len(rows), 2) for k, v in sorted(calls.items())},
+            "bytes_persisted_per_turn": round(sum(r.bytes_persisted for r in rows) / len(rows)),
+            "cached_token_ratio": round(calls["llm.cached_tokens"] / calls["llm.prompt_tokens"], 3)
+            if calls["llm.prompt_tokens"] else 0.0,
+        }
+    return report
+
+
+def _print_report(report: dict[str, dict], baseline: dict[str, dict] | None) -> None:
+    header = (
+        f"{'turn type':<22}{'n':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+        f"{'llm':>6}{'gmail':>7}{'bytes':>10}{'cached':>8}"
+    )
+    print(header)
+    print("-" * len(header))
+    for kind, row in report.items():
+        calls = row["calls_per_turn"]
+        line = (
+            f"{kind:<22}{row['turns']:>6}{row['p50_ms']:>10.2f}{row['p95_ms']:>10.2f}"
+            f"{row['p99_ms']:>10.2f}{calls.get('llm', 0):>6.1f}{calls.get('gmail', 0):>7.1f}"
+            f"{row['bytes_persisted_per_turn']:>10}{row.get('cached_token_ratio', 0):>8.0%}"
+        )
+        if baseline and kind in baseline:
+            old = baseline[kind]["p95_ms"]
+            if old:
+                line += f"   p95 {100 * (row['p95_ms'] - old) / old:+.1f}%"
+        print(line)
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=20, help="replays of each conversation")
+    parser.add_argument("--history", type=int, default=0, help="pre-existing messages per session")
+    parser.add_argument("--llm-latency-ms", type=float, default=0.0)
+    parser.add_argument("--gmail-latency-ms", type=float, default=0.0)
+    parser.add_argument("--recorded", type=Path, default=None,
+                        help="also replay user turns from this data/users directory")
+    parser.add_argument("--out", type=Path, default=None, help="results JSON path")
+    parser.add_argument("--compare", type=Path, default=None, help="earlier results JSON to diff against")
+    args = parser.parse_args(argv)
+
+    conversations = dict(SCRIPTED)
+    if args.recorded:
+        conversations.update(from_user_files(args.recorded))
+
+    backends = install(
+        llm_latency_s=args.llm_latency_ms / 1000,
+        gmail_latency_s=args.gmail_latency_ms / 1000,
+    )
+
+    results: list[TurnResult] = []
+    started = time.perf_counter()
+    for i in range(args.iterations):
+        for n, steps in enumerate(conversations.values()):
+            email = f"bench-{i}-{n}@example.com"
+            results.extend(_run_conversation(backends, email, steps, args.history))
+    wall = time.perf_counter() - started
+
+    report = summarise(results)
+    baseline = None
+    if args.compare:
+        baseline = json.loads(args.compare.read_text(encoding="utf-8")).get("turns")
+
+    _print_report(report, baseline)
+
+    revision = git_revision()
+    out = args.out or RESULTS_DIR / f"turn_latency-{revision}.json"
+    write_results(out, {
+        "benchmark": "turn_latency",
+        "revision": revision,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "params": {
+            "iterations": args.iterations,
+            "history": args.history,
+            "llm_latency_ms": args.llm_latency_ms,
+            "gmail_latency_ms": args.gmail_latency_ms,
+            "conversations": sorted(conversations),
+        },
+        "wall_seconds": round(wall, 3),
+        "turns": report,
+    })
+    print(f"\nwrote {out}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
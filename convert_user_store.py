@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Re-encode saved user state snapshots (data/users/*.json) in another format.
+
+Usage:
+    python convert_user_store.py --format zlib
+    python convert_user_store.py --format json --dir data/users --dry-run
+
+Loading auto-detects the format, so converting is optional: files are
+rewritten in LENAH_USER_STORE_FORMAT the next time each user saves anyway.
+This just does it for everyone at once (or reverts it). Each file is
+rewritten atomically under the same lock the app takes, so it is safe to
+run while LENAH is serving.
+"""
+from __future__ import annotations
+
+import argparse
+import sys
+import zlib
+from pathlib import Path
+
+from src.session import FORMATS, USERS_DIR, _atomic_write, _file_lock, decode_state, detect_format, encode_state
+
+
+def convert(users_dir: Path, fmt: str, dry_run: bool) -> int:
+    files = sorted(users_dir.glob("*.json"))
+    if not files:
+        print(f"No snapshots found in {users_dir}/. Nothing to convert.")
+        return 0
+
+    converted = skipped = failed = 0
+    before_total = after_total = 0
+    for path in files:
+        with _file_lock(path.with_name(f"{path.stem}.lock")):
+            try:
+                raw = path.read_bytes()
+                current = detect_format(raw)
+                if current == fmt:
+                    skipped += 1
+                    continue
+                data = encode_state(decode_state(raw), fmt)
+            except (ValueError, zlib.error, OSError, RuntimeError) as exc:
+                print(f"  FAIL {path.name}: {exc}")
+                failed += 1
+                continue
+            if not dry_run:
+                _atomic_write(path, data)
+
+        before_total += len(raw)
+        after_total += len(data)
+        converted += 1
+        print(f"  {'WOULD' if dry_run else 'OK   '} {path.name}: {current} → {fmt}  {len(raw):,} → {len(data):,} bytes")
+
+    saved = 100 * (1 - after_total / before_total) if before_total else 0.0
+    print(
+        f"\nDone. {converted} converted, {skipped} already {fmt}, {failed} failed. "
+        f"{before_total:,} → {after_total:,} bytes ({saved:.1f}% smaller)."
+    )
+    return 1 if failed else 0
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--format", required=True, choices=FORMATS, help="target encoding")
+    parser.add_argument("--dir", type=Path, default=USERS_DIR, help="user state directory")
+    parser.add_argument("--dry-run", action="store_true", help="report sizes without writing")
+    args = parser.parse_args(argv)
+    return convert(args.dir, args.format, args.dry_run)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,104 +1,361 @@
 #!/usr/bin/env python3
 """
-One-off migration: upsert data/users/*.json files into MongoDB.
+Bulk migration: upsert data/users/* into MongoDB.
 
 Usage:
     python migrate_to_mongo.py
+    python migrate_to_mongo.py --workers 8 --batch-size 500
+    python migrate_to_mongo.py --dry-run
+    python migrate_to_mongo.py --verify
 
 Reads MONGO_URI and MONGO_DB_NAME from the environment (or .env file).
-Files missing a user_email field are skipped.
+Snapshots in any store format are read, with journal entries folded in and
+cold-archive messages copied to the user_archive collection. Each document
+is keyed by the address the file belongs to (owner_email, or for older files
+a user_email that still matches the file name); files where neither
+applies are skipped, as are rows the database rejects (e.g. a duplicate
+email).
+
+Files are parsed by a pool of worker processes and written with unordered
+bulk_write batches. Progress is checkpointed after every batch; a rerun
+skips users whose files have not changed since they were migrated
+(--restart ignores the checkpoint). --verify re-reads every file and
+compares document counts and per-user state checksums with the database.
 """
 from __future__ import annotations
 
+import argparse
 import hashlib
 import json
 import sys
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timezone
 from pathlib import Path
+from typing import Any, Iterator
 
 from dotenv import load_dotenv
 
 load_dotenv()
 
 # Import config after load_dotenv so env overrides are picked up.
-from src.config import MONGO_DB_NAME, MONGO_URI  # noqa: E402
-from pymongo import MongoClient  # noqa: E402
-
-_STATE_KEYS = (
-    "messages",
-    "user_email",
-    "pending_email",
-    "agent_threads",
-    "agent_last_message_id",
-)
+from pymongo import UpdateOne  # noqa: E402
+from pymongo.errors import BulkWriteError  # noqa: E402
 
-_DEFAULTS: dict = {
-    "messages": [],
-    "user_email": None,
-    "pending_email": None,
-    "agent_threads": {},
-    "agent_last_message_id": {},
-}
+from src.mongo_store import archive_collection, users_collection  # noqa: E402
+from src.session import (  # noqa: E402
+    _STATE_KEYS,
+    USERS_DIR,
+    _atomic_write,
+    _stat,
+    _user_id,
+    decode_state,
+    read_archive,
+    replay_journal,
+    state_owner,
+)
 
+CHECKPOINT_PATH = Path("data/migrate_checkpoint.json")
 
-def _user_id(email: str) -> str:
-    return hashlib.sha256(email.strip().lower().encode()).hexdigest()[:16]
 
+# ---------------------------------------------------------------------------
+# Reading (runs in worker processes)
+# ---------------------------------------------------------------------------
 
-def migrate() -> None:
-    users_dir = Path("data/users")
+def _user_files(users_dir: Path) -> list[Path]:
+    """One snapshot path per user, including journal-only users with no snapshot yet."""
     if not users_dir.exists():
-        print("No data/users directory found. Nothing to migrate.")
+        return []
+    stems = {p.stem for p in users_dir.glob("*.json")}
+    stems |= {p.name[: -len(".journal.jsonl")] for p in users_dir.glob("*.journal.jsonl")}
+    return [users_dir / f"{stem}.json" for stem in sorted(stems)]
+
+
+def _companions(path: Path) -> tuple[Path, Path]:
+    return path.with_name(f"{path.stem}.journal.jsonl"), path.with_name(f"{path.stem}.archive.jsonl")
+
+
+def _signature(path: Path) -> list:
+    """Changes whenever the snapshot, journal or archive of a user changes."""
+    return [list(sig) if sig else None for sig in map(_stat, (path, *_companions(path)))]
+
+
+def checksum(payload: dict[str, Any]) -> str:
+    """Order-independent digest of one user's state keys."""
+    text = json.dumps({k: payload.get(k) for k in _STATE_KEYS}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def read_user(path: Path) -> dict[str, Any]:
+    """
+    Parse one user's files. Returns a dict with ``name``, ``sig`` and either
+    ``error`` or ``uid`` / ``email`` / ``payload`` / ``archive`` / ``bytes``.
+    """
+    result: dict[str, Any] = {"name": path.name, "sig": _signature(path)}
+    journal, archive_path = _companions(path)
+    try:
+        raw = path.read_bytes() if path.exists() else b"{}"
+        payload, _seq, _entries, _torn = replay_journal(decode_state(raw), journal)
+        archive = read_archive(archive_path)
+        size = len(raw) + (journal.stat().st_size if journal.exists() else 0)
+    except (ValueError, zlib.error, OSError, RuntimeError) as exc:
+        result["error"] = f"could not read ({exc})"
+        return result
+
+    # Not user_email alone: that is the CC address, which the user can change.
+    email = state_owner(payload, path.stem)
+    if not email:
+        result["error"] = "no owner_email, and user_email doesn't match the file name"
+        return result
+    payload["owner_email"] = email.strip().lower()
+
+    result.update(
+        uid=_user_id(email),
+        email=email.strip().lower(),
+        payload=payload,
+        archive=sorted(archive.items()),
+        bytes=size,
+    )
+    return result
+
+
+def _read_all(files: list[Path], workers: int) -> Iterator[dict[str, Any]]:
+    if workers <= 1:
+        yield from map(read_user, files)
         return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        yield from pool.map(read_user, files, chunksize=16)
+
+
+# ---------------------------------------------------------------------------
+# Checkpoint
+# ---------------------------------------------------------------------------
+
+def _load_checkpoint(path: Path) -> dict[str, Any]:
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, json.JSONDecodeError):
+        return {"files": {}}
+
+
+def _save_checkpoint(path: Path, checkpoint: dict[str, Any]) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    _atomic_write(path, json.dumps(checkpoint, indent=2).encode("utf-8"))
+
+
+# ---------------------------------------------------------------------------
+# Migration
+# ---------------------------------------------------------------------------
+
+def _operations(row: dict[str, Any], now: datetime) -> tuple[list[UpdateOne], list[UpdateOne]]:
+    uid = row["uid"]
+    user_ops = [UpdateOne(
+        {"_id": uid},
+        {
+            "$set": {**row["payload"], "email": row["email"], "last_active": now},
+            "$setOnInsert": {"created_at": now},
+            # Live MongoUserStore sessions see a new version and merge.
+            "$inc": {"_version": 1},
+        },
+        upsert=True,
+    )]
+    archive_ops = [
+        UpdateOne(
+            {"_id": f"{uid}:{i}"},
+            {"$set": {"user_id": uid, "i": i, "m": m}},
+            upsert=True,
+        )
+        for i, m in row["archive"]
+    ]
+    return user_ops, archive_ops
+
+
+def _write(collection: Any, ops: list[UpdateOne], names: list[str]) -> dict[str, str]:
+    """Run ``ops`` as one unordered bulk_write. Returns {file name: error} for rows that failed."""
+    if not ops:
+        return {}
+    try:
+        collection.bulk_write(ops, ordered=False)
+    except BulkWriteError as exc:
+        errors = exc.details.get("writeErrors") or []
+        if not errors:  # e.g. a write concern error: nothing says which rows landed
+            return {name: str(exc) for name in names}
+        return {names[e["index"]]: e.get("errmsg", "write failed") for e in errors}
+    return {}
+
+
+class _Progress:
+    def __init__(self, total: int) -> None:
+        self.total = total
+        self.done = 0
+        self.bytes = 0
+        self.start = time.perf_counter()
+
+    def update(self, files: int, nbytes: int) -> None:
+        self.done += files
+        self.bytes += nbytes
 
-    files = sorted(users_dir.glob("*.json"))
+    def line(self) -> str:
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+        return (
+            f"  {self.done}/{self.total} files  "
+            f"{self.done / elapsed:,.0f} files/s  {self.bytes / elapsed / 1e6:,.2f} MB/s"
+        )
+
+
+def migrate(args: argparse.Namespace) -> int:
+    users_dir: Path = args.dir
+    files = _user_files(users_dir)
     if not files:
-        print("No JSON files found in data/users/. Nothing to migrate.")
-        return
+        print(f"No user files found in {users_dir}/. Nothing to migrate.")
+        return 0
+
+    checkpoint = {"files": {}} if args.restart else _load_checkpoint(args.checkpoint)
+    done = checkpoint["files"]
+    todo = [p for p in files if done.get(p.name) != _signature(p)]
+    print(f"{len(files)} user files, {len(files) - len(todo)} already migrated, {len(todo)} to go.")
+    if not todo:
+        return 0
 
-    client = MongoClient(MONGO_URI)
-    collection = client[MONGO_DB_NAME]["users"]
-    collection.create_index("email", unique=True)
+    users = archive = None
+    if not args.dry_run:
+        users = users_collection()
+        users.create_index("email", unique=True)
+        archive = archive_collection()
 
-    migrated = 0
-    skipped = 0
+    migrated = skipped = 0
+    archived = 0
+    user_ops: list[UpdateOne] = []
+    archive_ops: list[UpdateOne] = []
+    # File name of each op, in op order, to report rows the database rejects.
+    user_op_names: list[str] = []
+    archive_op_names: list[str] = []
+    batch_names: dict[str, list] = {}
+    progress = _Progress(len(todo))
     now = datetime.now(timezone.utc)
 
-    for path in files:
-        try:
-            data = json.loads(path.read_text(encoding="utf-8"))
-        except (json.JSONDecodeError, OSError) as exc:
-            print(f"  SKIP {path.name}: could not read ({exc})")
-            skipped += 1
-            continue
+    def flush() -> None:
+        nonlocal migrated, skipped
+        if not args.dry_run:
+            failed = {
+                **_write(archive, archive_ops, archive_op_names),
+                **_write(users, user_ops, user_op_names),
+            }
+            for name, error in failed.items():
+                # Left out of the checkpoint, so a rerun tries them again.
+                print(f"  SKIP {name}: {error}")
+                batch_names.pop(name, None)
+            migrated -= len(failed)
+            skipped += len(failed)
+            done.update(batch_names)
+            _save_checkpoint(args.checkpoint, checkpoint)
+        user_ops.clear()
+        archive_ops.clear()
+        user_op_names.clear()
+        archive_op_names.clear()
+        batch_names.clear()
+        print(progress.line())
 
-        email = data.get("user_email")
-        if not email:
-            print(f"  SKIP {path.name}: missing user_email field")
+    for row in _read_all(todo, args.workers):
+        if "error" in row:
+            print(f"  SKIP {row['name']}: {row['error']}")
             skipped += 1
+            progress.update(1, 0)
             continue
 
-        uid = _user_id(email)
-        payload = {k: data.get(k, _DEFAULTS[k]) for k in _STATE_KEYS}
-
-        collection.update_one(
-            {"_id": uid},
-            {
-                "$set": {
-                    **payload,
-                    "email": email.strip().lower(),
-                    "last_active": now,
-                },
-                "$setOnInsert": {"created_at": now},
-            },
-            upsert=True,
-        )
-        print(f"  OK   {path.name} → _id={uid} ({email})")
+        ops, extra = _operations(row, now)
+        user_ops.extend(ops)
+        archive_ops.extend(extra)
+        user_op_names.extend([row["name"]] * len(ops))
+        archive_op_names.extend([row["name"]] * len(extra))
+        batch_names[row["name"]] = row["sig"]
         migrated += 1
+        archived += len(extra)
+        progress.update(1, row["bytes"])
+        if args.verbose:
+            print(f"  {'WOULD' if args.dry_run else 'OK   '} {row['name']} → _id={row['uid']} ({row['email']})")
+        if len(user_ops) + len(archive_ops) >= args.batch_size:
+            flush()
+    flush()
+
+    verb = "would be migrated" if args.dry_run else "migrated"
+    print(f"\nDone. {migrated} {verb} ({archived} archived messages), {skipped} skipped. {progress.line().strip()}")
+    return 0
+
+
+# ---------------------------------------------------------------------------
+# Verification
+# ---------------------------------------------------------------------------
+
+def verify(args: argparse.Namespace) -> int:
+    files = _user_files(args.dir)
+    users = users_collection()
+    archive = archive_collection()
+
+    expected: dict[str, dict[str, Any]] = {}
+    for row in _read_all(files, args.workers):
+        if "error" not in row:
+            expected[row["uid"]] = row
+
+    mismatched: list[str] = []
+    missing: list[str] = []
+    archive_mismatch: list[str] = []
+    uids = list(expected)
+    projection = {k: 1 for k in _STATE_KEYS}
+    for start in range(0, len(uids), args.batch_size):
+        chunk = uids[start:start + args.batch_size]
+        found = {doc["_id"]: doc for doc in users.find({"_id": {"$in": chunk}}, projection)}
+        counts = {
+            row["_id"]: row["n"]
+            for row in archive.aggregate([
+                {"$match": {"user_id": {"$in": chunk}}},
+                {"$group": {"_id": "$user_id", "n": {"$sum": 1}}},
+            ])
+        }
+        for uid in chunk:
+            row = expected[uid]
+            doc = found.get(uid)
+            if doc is None:
+                missing.append(row["name"])
+            elif checksum(doc) != checksum(row["payload"]):
+                mismatched.append(row["name"])
+            if counts.get(uid, 0) != len(row["archive"]):
+                archive_mismatch.append(row["name"])
+
+    total_docs = users.count_documents({})
+    print(f"files with user state : {len(expected)}")
+    print(f"documents in Mongo    : {total_docs}")
+    print(f"missing documents     : {len(missing)}")
+    print(f"checksum mismatches   : {len(mismatched)}")
+    print(f"archive count mismatch: {len(archive_mismatch)}")
+    for label, names in (("MISSING", missing), ("DIFFERS", mismatched), ("ARCHIVE", archive_mismatch)):
+        for name in names:
+            print(f"  {label} {name}")
+    ok = not (missing or mismatched or archive_mismatch)
+    if ok:
+        print("\nOK — Mongo matches data/users.")
+    else:
+        print("\nVerification FAILED. Rerun with --restart to re-migrate every user.")
+    return 0 if ok else 1
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dir", type=Path, default=USERS_DIR, help="user state directory")
+    parser.add_argument("--workers", type=int, default=4, help="parser processes (1 = in-process)")
+    parser.add_argument("--batch-size", type=int, default=500, help="operations per bulk_write")
+    parser.add_argument("--checkpoint", type=Path, default=CHECKPOINT_PATH, help="progress file")
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint and migrate everything")
+    parser.add_argument("--dry-run", action="store_true", help="read and report, write nothing")
+    parser.add_argument("--verify", action="store_true", help="compare Mongo against the files and exit")
+    parser.add_argument("-v", "--verbose", action="store_true", help="print every file")
+    args = parser.parse_args(argv)
 
-    client.close()
-    print(f"\nDone. {migrated} migrated, {skipped} skipped.")
+    if args.verify:
+        return verify(args)
+    return migrate(args)
 
 
 if __name__ == "__main__":
-    migrate()
+    sys.exit(main())
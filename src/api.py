@@ -0,0 +1,350 @@
+"""
+HTTP API over the conversation engine (src/engine.py).
+
+A plain ASGI application with no framework dependency. Every request loads
+the user's state from the configured UserStore, runs the turn in a worker
+thread and saves before it finishes, so the process keeps no per-user state
+and any number of replicas can sit behind a load balancer (use the mongo
+backend, or a shared data/ directory, so they see the same users).
+
+    GET  /healthz
+    GET  /users/{email}/state                  pending flow, threads, latest messages
+    GET  /users/{email}/messages?start=&end=   history by absolute index, archive included
+    GET  /users/{email}/search?q=&limit=        ranked snippets from chat and agent emails
+    GET  /users/{email}/listings?max_price=&min_bedrooms=&sort=…   listings from agent replies
+    POST /users/{email}/messages               {"text": "..."} — runs a chat turn
+    POST /users/{email}/check-replies          surfaces the next agent reply
+    POST /users/{email}/new-chat
+
+The two turn endpoints stream newline-delimited JSON: one
+``{"type": "message", "message": {...}}`` line per assistant message as
+the engine produces it, then ``{"type": "done", ...}`` with the resulting
+pending flow and threads (or ``{"type": "error", ...}``).
+
+Run with uvicorn (``pip install uvicorn``):
+
+    python -m src.api --port 8000 --workers 4
+
+Replies are fetched by the background poller, run apart as
+``python -m src.poller``; with LENAH_POLL_INTERVAL_S=0 check-replies polls
+live instead, as in the Streamlit app.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import hmac
+import ipaddress
+import json
+import re
+import sys
+import weakref
+from functools import lru_cache
+from typing import Any, Awaitable, Callable
+from urllib.parse import parse_qs
+
+from src.config import API_TOKEN, HISTORY_RENDER_WINDOW
+from src.engine import Conversation, load_user, save_user
+from src.gmail_client import GmailClient
+from src.listings import ListingFilter, index_for
+from src.mailboxes import make_client
+from src.recorder import record_turn
+from src.search import search_history
+from src.tracing import span
+from src.utils import is_valid_email, normalise_email
+
+Scope = dict[str, Any]
+Receive = Callable[[], Awaitable[dict]]
+Send = Callable[[dict], Awaitable[None]]
+
+_USER_ROUTE = re.compile(
+    r"^/users/(?P<email>[^/]+)/(?P<action>state|messages|search|listings|check-replies|new-chat)$"
+)
+
+_DONE = object()
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+# ---------------------------------------------------------------------------
+# Responses
+# ---------------------------------------------------------------------------
+
+def _line(payload: dict) -> bytes:
+    return json.dumps(payload, ensure_ascii=False).encode("utf-8") + b"\n"
+
+
+async def _send_json(send: Send, status: int, payload: dict) -> None:
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _read_json(receive: Receive) -> dict:
+    chunks: list[bytes] = []
+    while True:
+        event = await receive()
+        chunks.append(event.get("body", b""))
+        if not event.get("more_body"):
+            break
+    raw = b"".join(chunks)
+    if not raw:
+        return {}
+    try:
+        body = json.loads(raw)
+    except ValueError:
+        raise HTTPError(400, "Request body is not valid JSON.") from None
+    if not isinstance(body, dict):
+        raise HTTPError(400, "Request body must be a JSON object.")
+    return body
+
+
+def _summary(state: dict[str, Any]) -> dict:
+    return {
+        "user_email": state["user_email"],
+        "mailbox": state["mailbox"],
+        "pending": (state["pending_email"] or {}).get("action"),
+        "agent_threads": sorted(state["agent_threads"]),
+        "ready_replies": len(state["ready_replies"]),
+        "listings": len(state["listings"]),
+        "total_messages": (state["archived_count"] or 0) + len(state["messages"]),
+    }
+
+
+# ---------------------------------------------------------------------------
+# Application
+# ---------------------------------------------------------------------------
+
+class LenahAPI:
+    """
+    The ASGI application. ``client_for`` maps a mailbox shard name to its
+    GmailClient; by default one client per shard is built and kept.
+    """
+
+    def __init__(self, client_for: Callable[[str], GmailClient] | None = None) -> None:
+        self.client_for = client_for or lru_cache(maxsize=None)(make_client)
+        # Turns of the same user are serialised within this process; across
+        # replicas the store's merge rules apply (see README).
+        self._user_locks: weakref.WeakValueDictionary[str, asyncio.Lock] = weakref.WeakValueDictionary()
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+        try:
+            await self._dispatch(scope, receive, send)
+        except HTTPError as exc:
+            await _send_json(send, exc.status, {"error": str(exc)})
+
+    async def _lifespan(self, receive: Receive, send: Send) -> None:
+        while True:
+            event = await receive()
+            if event["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif event["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _dispatch(self, scope: Scope, receive: Receive, send: Send) -> None:
+        method, path = scope["method"], scope["path"]
+        if path == "/healthz":
+            await _send_json(send, 200, {"ok": True})
+            return
+
+        if API_TOKEN:
+            headers = dict(scope.get("headers") or [])
+            given = headers.get(b"authorization", b"").decode("latin-1")
+            if not hmac.compare_digest(given, f"Bearer {API_TOKEN}"):
+                raise HTTPError(401, "Missing or wrong API token.")
+
+        match = _USER_ROUTE.match(path)
+        if match is None:
+            raise HTTPError(404, f"No route for {path}.")
+        email = normalise_email(match["email"])
+        if not is_valid_email(email):
+            raise HTTPError(400, f"{match['email']!r} is not a valid email address.")
+        action = match["action"]
+        query = {k: v[-1] for k, v in parse_qs(scope.get("query_string", b"").decode()).items()}
+
+        if (method, action) == ("GET", "state"):
+            await _send_json(send, 200, await asyncio.to_thread(self._state, email))
+        elif (method, action) == ("GET", "messages"):
+            await _send_json(send, 200, await asyncio.to_thread(self._messages, email, query))
+        elif (method, action) == ("GET", "search"):
+            await _send_json(send, 200, await asyncio.to_thread(self._search, email, query))
+        elif (method, action) == ("GET", "listings"):
+            await _send_json(send, 200, await asyncio.to_thread(self._listings, email, query))
+        elif (method, action) == ("POST", "messages"):
+            text = (await _read_json(receive)).get("text")
+            if not isinstance(text, str) or not text.strip():
+                raise HTTPError(400, 'Send {"text": "..."} with a non-empty message.')
+            await self._stream_turn(send, email, "message", text)
+        elif (method, action) == ("POST", "check-replies"):
+            await self._stream_turn(send, email, "check_replies", None)
+        elif (method, action) == ("POST", "new-chat"):
+            async with self._lock(email):
+                await _send_json(send, 200, await asyncio.to_thread(self._new_chat, email))
+        else:
+            raise HTTPError(405, f"{method} is not allowed on {path}.")
+
+    def _lock(self, email: str) -> asyncio.Lock:
+        lock = self._user_locks.get(email)
+        if lock is None:
+            lock = self._user_locks[email] = asyncio.Lock()
+        return lock
+
+    # ------------------------------------------------------------------
+    # Reads
+    # ------------------------------------------------------------------
+
+    def _state(self, email: str) -> dict:
+        _store, state = load_user(email)
+        return {**_summary(state), "messages": state["messages"][-HISTORY_RENDER_WINDOW:]}
+
+    def _messages(self, email: str, query: dict[str, str]) -> dict:
+        store, state = load_user(email)
+        archived = state["archived_count"] or 0
+        total = archived + len(state["messages"])
+        try:
+            start = max(0, int(query.get("start", max(total - HISTORY_RENDER_WINDOW, 0))))
+            end = min(total, int(query.get("end", total)))
+        except ValueError:
+            raise HTTPError(400, "start and end must be integers.") from None
+        messages: list[dict] = []
+        if start < min(end, archived):
+            messages = store.load_archive(start, min(end, archived))
+        messages += state["messages"][max(start - archived, 0):max(end - archived, 0)]
+        return {"start": start, "end": max(start, end), "total": total, "messages": messages}
+
+    def _search(self, email: str, query: dict[str, str]) -> dict:
+        try:
+            limit = min(int(query.get("limit", 20)), 100)
+        except ValueError:
+            raise HTTPError(400, "limit must be an integer.") from None
+        return {"hits": [hit._asdict() for hit in search_history(email, query.get("q", ""), limit)]}
+
+    def _listings(self, email: str, query: dict[str, str]) -> dict:
+        _store, state = load_user(email)
+        f = ListingFilter()
+        try:
+            for name in ("min_price", "max_price"):
+                if name in query:
+                    setattr(f, name, float(query[name]))
+            for name in ("min_bedrooms", "max_bedrooms", "limit"):
+                if name in query:
+                    setattr(f, name, int(query[name]))
+        except ValueError:
+            raise HTTPError(400, "Price, bedroom and limit filters must be numbers.") from None
+        f.available_by = query.get("available_by")
+        f.area = query.get("area")
+        f.agent = query.get("agent")
+        f.sort = query.get("sort", f.sort)
+        try:
+            matches = index_for(state).query(f)
+        except ValueError:
+            raise HTTPError(400, "available_by must be YYYY-MM-DD.") from None
+        return {"total": len(state["listings"]), "listings": matches}
+
+    # ------------------------------------------------------------------
+    # Turns
+    # ------------------------------------------------------------------
+
+    def _new_chat(self, email: str) -> dict:
+        store, state = load_user(email)
+        with span("turn", kind="new_chat"):
+            Conversation(state, self.client_for).new_chat()
+            store.clear_archive()
+            save_user(store, state)
+        return _summary(state)
+
+    def _run_turn(
+        self, email: str, kind: str, user_text: str | None, on_message: Callable[[dict], None]
+    ) -> dict:
+        store, state = load_user(email)
+        conversation = Conversation(state, self.client_for)
+        if user_text is not None:
+            conversation.add("user", user_text)
+        conversation.on_message = on_message  # stream only LENAH's side
+        with span("turn", kind=kind):
+            with record_turn(kind, user_text, state, store):
+                if kind == "check_replies":
+                    conversation.check_replies()
+                else:
+                    conversation.handle_message(user_text or "")
+            save_user(store, state)
+        return _summary(state)
+
+    async def _stream_turn(self, send: Send, email: str, kind: str, user_text: str | None) -> None:
+        """Run one turn in a worker thread, streaming its messages as they are added."""
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+
+        def on_message(message: dict) -> None:
+            loop.call_soon_threadsafe(queue.put_nowait, message)
+
+        async with self._lock(email):
+            await send({
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [(b"content-type", b"application/x-ndjson")],
+            })
+            task = asyncio.ensure_future(asyncio.to_thread(self._run_turn, email, kind, user_text, on_message))
+            task.add_done_callback(lambda _task: queue.put_nowait(_DONE))
+            try:
+                while (message := await queue.get()) is not _DONE:
+                    body = _line({"type": "message", "message": message})
+                    await send({"type": "http.response.body", "body": body, "more_body": True})
+                try:
+                    final = {"type": "done", **task.result()}
+                except Exception as exc:  # noqa: BLE001
+                    final = {"type": "error", "error": str(exc)}
+                await send({"type": "http.response.body", "body": _line(final)})
+            finally:
+                # A client that hung up doesn't stop the turn; let it finish
+                # and save before the next turn for this user starts.
+                await asyncio.wait({task})
+
+
+app = LenahAPI()
+
+
+def _is_loopback(host: str) -> bool:
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=1, help="server processes")
+    args = parser.parse_args(argv)
+    if not API_TOKEN and not _is_loopback(args.host):
+        # Without a token anyone who can reach the port can read any user's state.
+        print(f"LENAH API: refusing to listen on {args.host} without LENAH_API_TOKEN set.", file=sys.stderr)
+        return 1
+    try:
+        import uvicorn  # noqa: PLC0415
+    except ImportError:
+        print("The LENAH API needs an ASGI server: pip install uvicorn", file=sys.stderr)
+        return 1
+    uvicorn.run("src.api:app", host=args.host, port=args.port, workers=args.workers)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
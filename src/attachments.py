@@ -0,0 +1,248 @@
+"""
+Text from the files agents attach to their replies.
+
+Brochures and floorplans usually arrive as PDFs that the message body only
+mentions. When the poller processes a reply (src/poller.py), its attachments
+are read and their text appended to the body, so the summary, the draft,
+listing extraction and search all see them:
+
+- nothing is fetched for a reply until it is processed, and nothing whose
+  declared size is over LENAH_ATTACHMENT_MAX_BYTES is fetched at all;
+- downloads stream to LENAH_ATTACHMENT_DIR and are abandoned at the cap;
+- text is extracted in a separate worker process that is killed after
+  LENAH_ATTACHMENT_TIMEOUT_S, so a hostile or broken file can't hang or
+  crash the poller;
+- the result (or why there is none) is cached per attachment, and the
+  downloaded file deleted. Gmail's attachmentId changes each time a
+  message is fetched, so the cache key is the message id and MIME part id,
+  which are stable.
+
+PDF text uses pypdf when it is installed (``pip install pypdf``). Without
+it, a small built-in reader handles the plain text operators most
+generated brochures use. Word documents (.docx), plain text, CSV and HTML
+need nothing extra.
+"""
+from __future__ import annotations
+
+import base64
+import json
+import multiprocessing
+import os
+import re
+import zipfile
+import zlib
+from pathlib import Path
+from typing import Any
+
+from src.config import ATTACHMENT_DIR, ATTACHMENT_MAX_BYTES, ATTACHMENT_MAX_CHARS, ATTACHMENT_TIMEOUT_S
+from src.gmail_client import AttachmentTooLarge, GmailClient
+from src.tracing import span
+
+_KINDS = {
+    "application/pdf": "pdf",
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document": "docx",
+    "text/plain": "text",
+    "text/csv": "text",
+    "text/html": "html",
+}
+_EXTENSIONS = {".pdf": "pdf", ".docx": "docx", ".txt": "text", ".csv": "text", ".htm": "html", ".html": "html"}
+
+
+def _kind(part: dict) -> str | None:
+    """What extractor a part needs; agents often send PDFs as octet-stream."""
+    return _KINDS.get(part["mime_type"].lower()) or _EXTENSIONS.get(Path(part["filename"]).suffix.lower())
+
+
+# ---------------------------------------------------------------------------
+# Extraction (runs in the worker process)
+# ---------------------------------------------------------------------------
+
+_PDF_STREAM = re.compile(rb"stream\r?\n(.*?)\r?\nendstream", re.DOTALL)
+_PDF_TEXT_BLOCK = re.compile(rb"BT(.*?)ET", re.DOTALL)
+_PDF_STRING = re.compile(rb"(\((?:\\.|[^\\)])*\)|\[(?:[^\]\\]|\\.)*\])\s*(Tj|TJ|'|\")|T\*|T[dDm]\b")
+_PDF_ESCAPES = {b"n": b"\n", b"r": b"\r", b"t": b"\t", b"b": b"", b"f": b"", b"(": b"(", b")": b")", b"\\": b"\\"}
+
+
+def _pdf_unescape(m: re.Match) -> bytes:
+    code = m.group(1)
+    return bytes([int(code, 8) & 0xFF]) if code[:1].isdigit() else _PDF_ESCAPES.get(code, b"")
+
+
+def _pdf_string(raw: bytes) -> str:
+    return re.sub(rb"\\([0-7]{1,3}|.)", _pdf_unescape, raw).decode("latin-1")
+
+
+def _naive_pdf_text(data: bytes) -> str:
+    """Strings shown by Tj/TJ in (Flate-compressed or plain) content streams."""
+    lines: list[str] = []
+    for stream in _PDF_STREAM.findall(data):
+        try:
+            stream = zlib.decompress(stream)
+        except zlib.error:
+            pass
+        for block in _PDF_TEXT_BLOCK.findall(stream):
+            line = ""
+            for m in _PDF_STRING.finditer(block):
+                shown, op = m.groups()
+                if op in (None, b"'", b'"'):  # T*, Td, TD, Tm, ' and " move to a new line
+                    lines.append(line)
+                    line = ""
+                if shown is None:
+                    continue
+                if shown.startswith(b"("):
+                    line += _pdf_string(shown[1:-1])
+                else:
+                    line += "".join(_pdf_string(s[1:-1]) for s in re.findall(rb"\((?:\\.|[^\\)])*\)", shown))
+            lines.append(line)
+    return "\n".join(line.strip() for line in lines if line.strip())
+
+
+def _pdf_text(path: str) -> str:
+    try:
+        import pypdf  # noqa: PLC0415
+    except ImportError:
+        return _naive_pdf_text(Path(path).read_bytes())
+    reader = pypdf.PdfReader(path)
+    return "\n".join(page.extract_text() or "" for page in reader.pages)
+
+
+def _docx_text(path: str) -> str:
+    with zipfile.ZipFile(path) as zf:
+        xml = zf.read("word/document.xml").decode("utf-8", errors="replace")
+    xml = re.sub(r"</w:p>", "\n", xml)
+    return re.sub(r"<[^>]+>", "", xml)
+
+
+def _extract(path: str, kind: str) -> str:
+    if kind == "pdf":
+        return _pdf_text(path)
+    if kind == "docx":
+        return _docx_text(path)
+    text = Path(path).read_text(encoding="utf-8", errors="replace")
+    return re.sub(r"<[^>]+>", " ", text) if kind == "html" else text
+
+
+def _worker(path: str, kind: str, conn: Any) -> None:
+    try:
+        text = _extract(path, kind)
+        conn.send(("ok", re.sub(r"[ \t]+", " ", text).strip()[:ATTACHMENT_MAX_CHARS]))
+    except Exception as exc:  # noqa: BLE001
+        conn.send(("error", f"{type(exc).__name__}: {exc}"))
+    finally:
+        conn.close()
+
+
+_context = None
+
+
+def _mp():
+    """forkserver where available: forking the threaded server itself isn't safe."""
+    global _context
+    if _context is None:
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        _context = multiprocessing.get_context(method)
+        if method == "forkserver":
+            _context.set_forkserver_preload([__name__])
+    return _context
+
+
+def extract_text(path: Path, kind: str, timeout: float = ATTACHMENT_TIMEOUT_S) -> str:
+    """Text of the file at ``path``, from a worker process. TimeoutError if it takes too long."""
+    ctx = _mp()
+    recv, send = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=_worker, args=(str(path), kind, send), daemon=True)
+    proc.start()
+    send.close()
+    try:
+        if not recv.poll(timeout):
+            raise TimeoutError(f"no text after {timeout:g}s")
+        status, result = recv.recv()
+    except EOFError:
+        proc.join(5)
+        raise RuntimeError(f"extractor exited with code {proc.exitcode}") from None
+    finally:
+        recv.close()
+        if proc.is_alive():
+            proc.kill()
+        proc.join(5)
+    if status != "ok":
+        raise RuntimeError(result)
+    return result
+
+
+# ---------------------------------------------------------------------------
+# Fetch and cache
+# ---------------------------------------------------------------------------
+
+def _cache_path(mailbox: str, message_id: str, part_id: str) -> Path:
+    return ATTACHMENT_DIR / mailbox / f"{message_id}-{part_id or '0'}.json"
+
+
+def attachment_text(client: GmailClient, mailbox: str, message_id: str, part: dict) -> dict:
+    """
+    {"filename", "status", "text"} for one attachment of ``message_id``,
+    fetching and extracting it unless cached. ``status`` is "ok",
+    "unsupported", "too_large" or "failed"; only "ok" carries text.
+    """
+    cache = _cache_path(mailbox, message_id, part["part_id"])
+    if cache.exists():
+        return json.loads(cache.read_text(encoding="utf-8"))
+
+    record = {"filename": part["filename"], "status": "ok", "text": ""}
+    kind = _kind(part)
+    if kind is None:
+        record["status"] = "unsupported"
+    elif part["size"] > ATTACHMENT_MAX_BYTES:
+        record["status"] = "too_large"
+    else:
+        cache.parent.mkdir(parents=True, exist_ok=True)
+        blob = cache.with_suffix(".part")
+        try:
+            with span("attachments.fetch", kind=kind, size=part["size"]):
+                if part.get("attachment_id"):
+                    client.download_attachment(
+                        message_id, part["attachment_id"], blob, max_bytes=ATTACHMENT_MAX_BYTES
+                    )
+                else:  # small enough that Gmail sent it inline
+                    data = part["data"]
+                    blob.write_bytes(base64.urlsafe_b64decode(data + "=" * (-len(data) % 4)))
+        except AttachmentTooLarge:
+            record["status"] = "too_large"
+        except Exception as exc:  # noqa: BLE001
+            # Not cached: a download that failed may well work next time.
+            print(f"LENAH attachments: couldn't fetch {part['filename']!r} on message {message_id}: {exc}")
+            blob.unlink(missing_ok=True)
+            return {**record, "status": "failed"}
+        else:
+            try:
+                with span("attachments.extract", kind=kind):
+                    record["text"] = extract_text(blob, kind)
+            except Exception as exc:  # noqa: BLE001
+                # Cached: a file that defeats the extractor once will again.
+                print(f"LENAH attachments: couldn't read {part['filename']!r} on message {message_id}: {exc}")
+                record["status"] = "failed"
+        finally:
+            blob.unlink(missing_ok=True)
+
+    cache.parent.mkdir(parents=True, exist_ok=True)
+    tmp = cache.with_suffix(f".{os.getpid()}.tmp")
+    tmp.write_text(json.dumps(record, ensure_ascii=False), encoding="utf-8")
+    tmp.replace(cache)
+    return record
+
+
+def with_attachments(client: GmailClient, mailbox: str, reply: dict) -> dict:
+    """``reply`` with the text of its attachments appended to its body."""
+    parts = reply.get("attachments") or []
+    if not parts:
+        return reply
+    sections = []
+    for part in parts:
+        record = attachment_text(client, mailbox, reply["id"], part)
+        if record["status"] == "ok" and record["text"]:
+            sections.append(f"ATTACHMENT {record['filename']}:\n{record['text']}")
+        elif record["status"] == "too_large":
+            sections.append(f"ATTACHMENT {record['filename']}: (too large to read)")
+    if not sections:
+        return reply
+    return {**reply, "body": reply["body"].rstrip() + "\n\n" + "\n\n".join(sections)}
@@ -12,6 +12,11 @@ PROJECT_ROOT = Path(__file__).resolve().parents[1]
 CREDENTIALS_PATH = Path(os.getenv("GMAIL_CREDENTIALS_PATH", PROJECT_ROOT / "credentials.json"))
 TOKEN_PATH = Path(os.getenv("GMAIL_TOKEN_PATH", PROJECT_ROOT / "token.json"))
 
+# Several central mailboxes (shards), each with its own credentials and
+# token: a JSON file listing them (see src/mailboxes.py). Unset means the
+# single mailbox above.
+GMAIL_SHARDS_PATH = Path(os.environ["LENAH_GMAIL_SHARDS"]) if os.getenv("LENAH_GMAIL_SHARDS") else None
+
 GMAIL_SCOPES = [
     "https://www.googleapis.com/auth/gmail.send",
     "https://www.googleapis.com/auth/gmail.modify",
@@ -23,3 +28,121 @@ DEFAULT_FROM_NAME = "LENAH"
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
 
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o")
+
+# Tracing — comma-separated exporters: "jsonl", "prometheus", "otel".
+# Empty (the default) disables tracing entirely.
+TRACE_EXPORTERS = os.getenv("LENAH_TRACE_EXPORTERS", "")
+TRACE_JSONL_PATH = Path(os.getenv("LENAH_TRACE_JSONL_PATH", PROJECT_ROOT / "data" / "traces.jsonl"))
+TRACE_PROMETHEUS_PORT = int(os.getenv("LENAH_TRACE_PROMETHEUS_PORT", "0"))
+
+# Session trace recording (for replaying slow sessions) — off unless a
+# directory is given. Email addresses are pseudonymised by default.
+RECORD_DIR = Path(os.environ["LENAH_RECORD_DIR"]) if os.getenv("LENAH_RECORD_DIR") else None
+RECORD_REDACT_EMAILS = os.getenv("LENAH_RECORD_REDACT_EMAILS", "1") != "0"
+
+# User state persistence backend: "file" (one JSON document rewritten per
+# save), "journal" (append-only log, compacted every N entries) or "mongo".
+USER_STORE_BACKEND = os.getenv("LENAH_USER_STORE", "file").strip().lower()
+JOURNAL_COMPACT_EVERY = int(os.getenv("LENAH_JOURNAL_COMPACT_EVERY", "50"))
+
+# On-disk encoding of user state snapshots: "json" (pretty-printed), "zlib"
+# or "zstd" (compact JSON, compressed; zstd needs the zstandard package).
+# Loading auto-detects the format, so this can be changed at any time.
+USER_STORE_FORMAT = os.getenv("LENAH_USER_STORE_FORMAT", "json").strip().lower()
+
+MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017")
+MONGO_DB_NAME = os.getenv("MONGO_DB_NAME", "lenah")
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "50"))
+
+# Saves are handed to a background flusher and written at most this many
+# seconds later, coalescing quick successive turns. 0 saves synchronously.
+WRITE_BEHIND_DELAY_S = float(os.getenv("LENAH_WRITE_BEHIND_DELAY_S", "0.5"))
+
+# Chat history kept in session memory; older messages move to a per-user
+# cold archive once the window overflows by HISTORY_SPILL_CHUNK.
+HISTORY_HOT_WINDOW = int(os.getenv("LENAH_HISTORY_HOT_WINDOW", "200"))
+HISTORY_SPILL_CHUNK = int(os.getenv("LENAH_HISTORY_SPILL_CHUNK", "50"))
+
+# The history each model call sends starts on a multiple of this many
+# messages, so its beginning (and the provider's cached prompt prefix) stays
+# the same for that many turns. Keep it a divisor of HISTORY_SPILL_CHUNK.
+HISTORY_WINDOW_CHUNK = int(os.getenv("LENAH_HISTORY_WINDOW_CHUNK", "10"))
+
+# Messages drawn per page of the chat pane; "Load earlier" adds another page.
+HISTORY_RENDER_WINDOW = int(os.getenv("LENAH_HISTORY_RENDER_WINDOW", "50"))
+
+# Background reply poller (src/poller.py). Every POLL_INTERVAL_S seconds it
+# checks all users' agent threads and queues summarised replies with a
+# suggested draft; 0 disables it and the "Check for new replies" button
+# polls live instead. POLLER_IN_APP runs it as a thread inside the
+# Streamlit server; turn it off when running `python -m src.poller` apart.
+POLL_INTERVAL_S = float(os.getenv("LENAH_POLL_INTERVAL_S", "0"))
+POLLER_IN_APP = os.getenv("LENAH_POLLER_IN_APP", "true").strip().lower() in ("1", "true", "yes")
+
+# Per-thread polling schedule (src/poll_schedule.py): threads are re-checked
+# between POLL_INTERVAL_S and POLL_MAX_INTERVAL_S apart depending on how
+# recently they were active, never more than POLL_QUOTA_PER_MIN checks a
+# minute across all users. New users and threads are picked up every
+# POLL_DISCOVER_S seconds.
+POLL_MAX_INTERVAL_S = float(os.getenv("LENAH_POLL_MAX_INTERVAL_S", "21600"))
+POLL_QUOTA_PER_MIN = float(os.getenv("LENAH_POLL_QUOTA_PER_MIN", "120"))
+POLL_DISCOVER_S = float(os.getenv("LENAH_POLL_DISCOVER_S", "300"))
+
+# thread_id -> owner index for routing inbound mail (src/thread_index.py);
+# SQLite for the file and journal backends, a collection for mongo.
+# POLL_MODE "inbox" syncs the central mailbox's history once per cycle and
+# routes new messages through the index; "threads" polls each thread.
+THREAD_INDEX_PATH = Path(os.getenv("LENAH_THREAD_INDEX_PATH", PROJECT_ROOT / "data" / "thread_index.sqlite"))
+POLL_MODE = os.getenv("LENAH_POLL_MODE", "inbox").strip().lower()
+
+# Push notifications (src/push.py). Gmail users.watch publishes each
+# mailbox's changes to the Cloud Pub/Sub topic PUSH_TOPIC
+# ("projects/<project>/topics/<topic>"), whose push subscription posts to
+# the receiver at PUSH_HOST:PUSH_PORT, path /gmail/push?token=PUSH_TOKEN.
+# Watches are renewed once they are within PUSH_RENEW_BEFORE_S of expiring.
+# Every mailbox is still synced every PUSH_FALLBACK_INTERVAL_S in case a
+# notification went missing.
+PUSH_TOPIC = os.getenv("LENAH_PUSH_TOPIC", "")
+PUSH_HOST = os.getenv("LENAH_PUSH_HOST", "127.0.0.1")
+PUSH_PORT = int(os.getenv("LENAH_PUSH_PORT", "8085"))
+PUSH_TOKEN = os.getenv("LENAH_PUSH_TOKEN", "")
+PUSH_RENEW_BEFORE_S = float(os.getenv("LENAH_PUSH_RENEW_BEFORE_S", "86400"))
+PUSH_FALLBACK_INTERVAL_S = float(os.getenv("LENAH_PUSH_FALLBACK_INTERVAL_S", "900"))
+
+# Attachments on agent replies (src/attachments.py): fetched only when a
+# reply is processed, streamed to ATTACHMENT_DIR and abandoned beyond
+# ATTACHMENT_MAX_BYTES. Text is extracted in a worker process that is
+# killed after ATTACHMENT_TIMEOUT_S, and cached there per message part, so
+# a document is downloaded and parsed once. At most ATTACHMENT_MAX_CHARS of
+# each document reach the model.
+ATTACHMENT_DIR = Path(os.getenv("LENAH_ATTACHMENT_DIR", PROJECT_ROOT / "data" / "attachments"))
+ATTACHMENT_MAX_BYTES = int(os.getenv("LENAH_ATTACHMENT_MAX_BYTES", str(10 * 1024 * 1024)))
+ATTACHMENT_TIMEOUT_S = float(os.getenv("LENAH_ATTACHMENT_TIMEOUT_S", "20"))
+ATTACHMENT_MAX_CHARS = int(os.getenv("LENAH_ATTACHMENT_MAX_CHARS", "6000"))
+
+# Bulk enquiries (one message naming several agents): how many drafts are
+# written at once, and the most agents one message may fan out to.
+BULK_DRAFT_CONCURRENCY = int(os.getenv("LENAH_BULK_DRAFT_CONCURRENCY", "8"))
+BULK_MAX_AGENTS = int(os.getenv("LENAH_BULK_MAX_AGENTS", "25"))
+
+# HTTP API (src/api.py). When API_TOKEN is set, every request except
+# /healthz must send "Authorization: Bearer <token>". Without one the API
+# only listens on a loopback address.
+API_TOKEN = os.getenv("LENAH_API_TOKEN", "")
+
+# Per-user full-text search databases (src/search.py): SQLite FTS5 over chat
+# messages and agent emails, one file per user. The sidebar search box
+# shows the best HISTORY_SEARCH_LIMIT hits.
+SEARCH_DIR = Path(os.getenv("LENAH_SEARCH_DIR", PROJECT_ROOT / "data" / "search"))
+HISTORY_SEARCH_LIMIT = int(os.getenv("LENAH_HISTORY_SEARCH_LIMIT", "10"))
+
+# Long-range recall (src/recall.py): past chat messages and agent replies are
+# embedded into a per-user vector index, and the RECALL_K most similar older
+# snippets (cosine >= RECALL_MIN_SCORE) go into chat and drafting prompts
+# next to the recent history window. EMBEDDER is "hashing" (local, no
+# network) or "openai" (EMBED_MODEL); changing it re-starts each index.
+EMBEDDER = os.getenv("LENAH_EMBEDDER", "hashing").strip().lower()
+EMBED_MODEL = os.getenv("LENAH_EMBED_MODEL", "text-embedding-3-small")
+EMBED_DIR = Path(os.getenv("LENAH_EMBED_DIR", PROJECT_ROOT / "data" / "recall"))
+RECALL_K = int(os.getenv("LENAH_RECALL_K", "5"))
+RECALL_MIN_SCORE = float(os.getenv("LENAH_RECALL_MIN_SCORE", "0.25"))
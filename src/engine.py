@@ -0,0 +1,659 @@
+"""
+LENAH's conversation engine, independent of any UI.
+
+A :class:`Conversation` runs one user's turns — chat, the pending-email
+flows, reply checks — against an explicit state mapping with the keys a
+``UserStore`` loads and saves (``messages``, ``pending_email``,
+``agent_threads``, …). It never touches Streamlit, so the same code serves
+the Streamlit app (which passes ``st.session_state``), the HTTP API in
+src/api.py (which loads state per request) and the benchmarks.
+
+    store, state = load_user("me@example.com")
+    Conversation(state, make_client).handle_message("hi")
+    save_user(store, state)
+
+Mail goes through the user's mailbox shard; ``client_for(name)`` returns
+the GmailClient for a shard and is expected to cache one per shard.
+"""
+from __future__ import annotations
+
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, MutableMapping
+
+from src.config import BULK_DRAFT_CONCURRENCY, BULK_MAX_AGENTS, POLL_INTERVAL_S
+from src.gmail_client import GmailClient
+from src.listings import listing_context
+from src.llm import (
+    CHAT_HISTORY_WINDOW,
+    DRAFT_HISTORY_WINDOW,
+    chat,
+    classify_draft_response,
+    draft_agent_email,
+    draft_summary_email,
+    history_window,
+    refine_draft,
+)
+from src.mailboxes import ensure_mailbox
+from src.poll_schedule import note_activity
+from src.poller import poll_user
+from src.recall import recall, remember
+from src.search import index_email, index_message
+from src.session import UserStore, flush_pending, open_user_store
+from src.thread_digest import note_outbound
+from src.thread_index import register_thread
+from src.tracing import current, span, traced
+from src.utils import extract_all_emails, extract_first_email, is_valid_email, normalise_email
+
+State = MutableMapping[str, Any]
+
+
+# ---------------------------------------------------------------------------
+# Loading and saving
+# ---------------------------------------------------------------------------
+
+def load_state(store: UserStore) -> dict[str, Any]:
+    """
+    A user's persisted state, ready for a turn (mailbox assigned). The hot
+    window is bounded when the state is saved, not here: spilling on a
+    read that never saves would archive the same messages again next time.
+    """
+    flush_pending(store.user_id)  # another session may have a save queued
+    state = store.load()
+    # CC the login address until the user gives another ("my email is …"),
+    # which then sticks across requests.
+    if not state.get("user_email"):
+        state["user_email"] = store.email
+    ensure_mailbox(state)
+    return state
+
+
+def load_user(email: str) -> tuple[UserStore, dict[str, Any]]:
+    store = open_user_store(email)
+    return store, load_state(store)
+
+
+def save_user(store: UserStore, state: State) -> None:
+    """Persist ``state`` now (no write-behind), so the next request can run anywhere."""
+    store.spill_cold(state)
+    store.save(state)
+
+
+# ---------------------------------------------------------------------------
+# Email parsing / detection
+# ---------------------------------------------------------------------------
+
+def extract_email(text: str) -> str | None:
+    found = extract_first_email(text or "")
+    if found and is_valid_email(found):
+        return normalise_email(found)
+    return None
+
+
+def sniff_own_email(text: str) -> str | None:
+    """
+    Return an email address only when the user explicitly indicates it is theirs.
+    Intentionally strict to avoid capturing an agent's address mid-flow.
+    """
+    t = (text or "").lower()
+    cues = [
+        "my email is", "my email:",
+        "email me at", "send it to me at", "send it to my email",
+        "cc me at", "cc me on",
+        "you can cc me at", "you can email me at",
+    ]
+    if not any(c in t for c in cues):
+        return None
+    return extract_email(text)
+
+
+def _listings_note(count: int) -> str:
+    if not count:
+        return ""
+    noun = "listing" if count == 1 else f"{count} listings"
+    return (
+        f"\n\nI've saved the {noun} from this email — ask me things like "
+        "*'which ones are under £2,000?'* any time."
+    )
+
+
+def _fan_out(fn, items: list) -> list:
+    """
+    ``fn(item)`` for every item on a small thread pool, results in order.
+    Each call gets a copy of the caller's context so its spans and recorded
+    calls land in the current turn.
+    """
+    if len(items) <= 1:
+        return [fn(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(BULK_DRAFT_CONCURRENCY, len(items))) as pool:
+        futures = [pool.submit(contextvars.copy_context().run, fn, item) for item in items]
+        return [f.result() for f in futures]
+
+
+# ---------------------------------------------------------------------------
+# Conversation
+# ---------------------------------------------------------------------------
+
+class Conversation:
+    """
+    One user's conversation over ``state``, which is updated in place.
+
+    ``on_message`` is called with every message the engine appends, as it
+    is appended, so a caller can stream a turn's output. Persisting the
+    state afterwards is the caller's job.
+    """
+
+    def __init__(
+        self,
+        state: State,
+        client_for: Callable[[str], GmailClient],
+        *,
+        on_message: Callable[[dict], None] | None = None,
+    ) -> None:
+        self.state = state
+        self.client_for = client_for
+        self.on_message = on_message
+
+    @property
+    def owner(self) -> str | None:
+        """
+        The address the state is saved under. Unlike ``user_email`` (where the
+        user is CC'd, which they can change mid-chat), it never changes.
+        """
+        return self.state.get("owner_email")
+
+    def add(self, role: str, content: str) -> None:
+        message = {"role": role, "content": content}
+        self.state["messages"].append(message)
+        index_message(self.owner, message)
+        remember(self.owner, role, content)
+        if self.on_message is not None:
+            self.on_message(message)
+
+    def _recall(self, query: str, window: int) -> list[str]:
+        """Older messages relevant to ``query``; the history window is sent as-is."""
+        return recall(self.owner, query, recent=history_window(self.state["messages"], window))
+
+    def _listing_context(self, user_text: str) -> str | None:
+        """Saved listings answering ``user_text``; a failure just leaves them out of the turn."""
+        try:
+            return listing_context(self.state, user_text)
+        except Exception as exc:  # noqa: BLE001
+            print(f"LENAH listings: couldn't query listings for this turn: {exc}")
+            return None
+
+    def new_chat(self) -> None:
+        """Forget the conversation; agent threads and queued replies stay."""
+        self.state["messages"] = []
+        self.state["archived_count"] = 0
+        self.state["pending_email"] = None
+
+    def _client(self) -> GmailClient:
+        """The client for the user's mailbox, assigning one on first use."""
+        return self.client_for(ensure_mailbox(self.state))
+
+    def _send_email(
+        self,
+        *,
+        to: str,
+        subject: str,
+        body: str,
+        cc: list[str] | None = None,
+        reply_to: str | None = None,
+        thread_id: str | None = None,
+    ) -> tuple[str, str]:
+        return self._client().send_email(
+            to=to, subject=subject, body=body,
+            cc=cc, reply_to=reply_to, thread_id=thread_id,
+        )
+
+    def _record_send(self, agent_email: str, msg_id: str, thread_id: str, subject: str, body: str) -> None:
+        s = self.state
+        s["agent_threads"][agent_email] = thread_id
+        s["agent_last_message_id"][agent_email] = msg_id
+        note_activity(s, agent_email)
+        note_outbound(s, agent_email, subject=subject, body=body)
+        register_thread(s["mailbox"], thread_id, self.owner, agent_email)
+        index_email(
+            self.owner, inbound=False, agent_email=agent_email, subject=subject, body=body, message_id=msg_id
+        )
+
+    # ------------------------------------------------------------------
+    # Agent-reply polling
+    # ------------------------------------------------------------------
+
+    @traced("turn.check_replies")
+    def check_replies(self) -> None:
+        """
+        Surface the next agent reply the poller has already fetched, summarised
+        and drafted a response to (see src/poller.py).
+
+        Without a background poller the threads are polled right here first,
+        through the same code path.
+        """
+        if not self.state["agent_threads"]:
+            self.add("assistant", "I haven't emailed any agents yet — there's nothing to check.")
+            return
+
+        if POLL_INTERVAL_S <= 0:
+            _replied, errors = poll_user(self.state, self._client())
+            for agent_email, exc in errors:
+                self.add("assistant", f"Couldn't check replies from **{agent_email}**: `{exc}`")
+
+        if not self.surface_ready_reply():
+            self.add("assistant", "No new replies from any agents yet.")
+
+    def surface_ready_reply(self) -> bool:
+        """
+        Show the oldest queued reply and enter 'review_draft' so the user can
+        approve or refine the suggested response. One reply at a time keeps the
+        UX manageable. Returns False if nothing was queued.
+        """
+        ready: dict[str, dict] = self.state["ready_replies"]
+        if not ready:
+            return False
+
+        reply_id = min(ready, key=lambda k: ready[k]["queued_at"])
+        item = ready.pop(reply_id)
+        agent_email = item["agent_email"]
+
+        if item.get("error"):
+            self.add("assistant", f"Got a reply from **{agent_email}** but couldn't process it: `{item['error']}`")
+            return True
+
+        self.add(
+            "assistant",
+            f"**{item['from']}** replied to your enquiry:\n\n"
+            f"> {item['summary']}\n\n"
+            f"Here's a suggested reply:\n\n"
+            f"---\n{item['draft_body']}\n---\n\n"
+            "Say **'send it'** to send this as-is, or tell me how to change it "
+            "(e.g. *'make it more formal'*, *'ask about parking'*, *'keep it shorter'*)."
+            + _listings_note(item.get("listings") or 0),
+        )
+
+        self.state["pending_email"] = {
+            "action": "review_draft",
+            "agent_email": agent_email,
+            "thread_id": item["thread_id"],
+            "draft_subject": item["draft_subject"],
+            "draft_body": item["draft_body"],
+        }
+        return True
+
+    # ------------------------------------------------------------------
+    # Pending-email state machine
+    # ------------------------------------------------------------------
+
+    def _run_pending(self, user_text: str) -> None:
+        """
+        Advance whichever email flow is currently in state["pending_email"].
+
+        pending_email dict keys:
+            action        : "summary" | "agent" | "bulk_agent" | "review_draft"
+
+            review_draft  : agent_email, thread_id, draft_subject, draft_body
+            agent         : agent_email (str | None), user_request (str)
+            bulk_agent    : agents (list[str]), user_request (str),
+                            drafts ({agent_email: {subject, body}} | None)
+            summary       : (no extra keys)
+        """
+        s = self.state
+        p = s["pending_email"]
+        t = (user_text or "").strip()
+        found = extract_email(t) if t else None
+
+        # -------------------------------------------------------------- #
+        # review_draft — user approves or refines the suggested reply     #
+        # -------------------------------------------------------------- #
+        if p["action"] == "review_draft":
+            if not t:
+                # Prompt already shown by check_replies; wait for input.
+                return
+
+            if classify_draft_response(t) == "approve":
+                self._send_draft_reply(p)
+                return
+
+            # Anything else is a refinement instruction.
+            try:
+                new_subject, new_body = refine_draft(
+                    draft_subject=p["draft_subject"],
+                    draft_body=p["draft_body"],
+                    instruction=t,
+                )
+            except Exception as exc:  # noqa: BLE001
+                self.add("assistant", f"Couldn't refine the draft: `{exc}`")
+                return
+
+            p["draft_subject"] = new_subject
+            p["draft_body"] = new_body
+            self.add(
+                "assistant",
+                f"Here's the updated draft:\n\n---\n{new_body}\n---\n\n"
+                "Say **'send it'** to send, or keep refining.",
+            )
+            return
+
+        # -------------------------------------------------------------- #
+        # summary — send chat transcript to the user                      #
+        # -------------------------------------------------------------- #
+        if p["action"] == "summary":
+            if not s["user_email"]:
+                if not found:
+                    self.add("assistant", "What email address should I send it to?")
+                    return
+                s["user_email"] = found
+
+            try:
+                subject, body = draft_summary_email(chat_history=s["messages"])
+                self._send_email(to=s["user_email"], subject=subject, body=body)
+                self.add("assistant", f"Done — summary sent to **{s['user_email']}**.")
+            except Exception as exc:  # noqa: BLE001
+                self.add("assistant", f"Sorry — couldn't send the summary: `{exc}`")
+
+            s["pending_email"] = None
+            return
+
+        # -------------------------------------------------------------- #
+        # agent — send a fresh enquiry email to an estate agent           #
+        # -------------------------------------------------------------- #
+        if p["action"] == "agent":
+            # Step 1: collect agent email.
+            if not p.get("agent_email"):
+                if not found:
+                    self.add("assistant", "Sure — what's the estate agent's email address?")
+                    return
+                if s["user_email"] and found == s["user_email"]:
+                    self.add("assistant", "That looks like your email — what's the estate agent's address?")
+                    return
+                p["agent_email"] = found
+                found = None  # don't re-use as the user's own address
+
+            # Step 2: collect user CC address.
+            if not s["user_email"]:
+                if not found:
+                    self.add("assistant", "What email should I CC you on?")
+                    return
+                if found == p["agent_email"]:
+                    self.add("assistant", "That looks like the agent's email — what email should I CC you on?")
+                    return
+                s["user_email"] = found
+
+            # Step 3: send.
+            try:
+                subject, body = draft_agent_email(
+                    chat_history=s["messages"],
+                    user_request=p.get("user_request", ""),
+                    recalled=self._recall(p.get("user_request", ""), DRAFT_HISTORY_WINDOW),
+                )
+                msg_id, new_thread_id = self._send_email(
+                    to=p["agent_email"],
+                    subject=subject,
+                    body=body,
+                    cc=[s["user_email"]],
+                    # No reply_to — agent replies must land in LENAH's Gmail
+                    # so get_new_replies() can find them. User stays in loop via CC.
+                    thread_id=s["agent_threads"].get(p["agent_email"]),
+                )
+                self._record_send(p["agent_email"], msg_id, new_thread_id, subject, body)
+                self.add(
+                    "assistant",
+                    f"Done — emailed **{p['agent_email']}** and CC'd you "
+                    f"at **{s['user_email']}**.",
+                )
+            except Exception as exc:  # noqa: BLE001
+                self.add("assistant", f"Sorry — couldn't send the email: `{exc}`")
+
+            s["pending_email"] = None
+            return
+
+        # -------------------------------------------------------------- #
+        # bulk_agent — one enquiry, personalised, to each of several agents
+        # -------------------------------------------------------------- #
+        if p["action"] == "bulk_agent":
+            self._run_bulk(p, t, found)
+            return
+
+        # Unknown action — clear to avoid getting stuck.
+        self.add("assistant", "Sorry — I don't recognise that email action.")
+        s["pending_email"] = None
+
+    def _send_draft_reply(self, p: dict) -> None:
+        """Send the approved draft reply and update thread / cursor state."""
+        user_email = self.state["user_email"]
+        try:
+            msg_id, new_thread_id = self._send_email(
+                to=p["agent_email"],
+                subject=p["draft_subject"],
+                body=p["draft_body"],
+                cc=[user_email] if user_email else None,
+                # No reply_to — keep replies coming back to LENAH's Gmail.
+                thread_id=p["thread_id"],
+            )
+            self._record_send(p["agent_email"], msg_id, new_thread_id, p["draft_subject"], p["draft_body"])
+            self.add("assistant", f"Sent — replied to **{p['agent_email']}**.")
+        except Exception as exc:  # noqa: BLE001
+            self.add("assistant", f"Sorry — couldn't send the reply: `{exc}`")
+        finally:
+            self.state["pending_email"] = None
+
+    # ------------------------------------------------------------------
+    # Bulk enquiries
+    # ------------------------------------------------------------------
+
+    def _bulk_recipients(self, user_text: str) -> list[str]:
+        """Agent addresses in the message — everything but the user's own."""
+        own = self.state["user_email"]
+        return [e for e in extract_all_emails(user_text) if is_valid_email(e) and e != own]
+
+    def _draft_bulk(self, agents: list[str], user_request: str) -> dict[str, dict]:
+        """One personalised enquiry per agent, drafted concurrently."""
+        history = list(self.state["messages"])
+        recalled = self._recall(user_request, DRAFT_HISTORY_WINDOW)
+
+        def draft(agent_email: str) -> dict:
+            try:
+                subject, body = draft_agent_email(
+                    chat_history=history, user_request=user_request, agent_email=agent_email,
+                    recalled=recalled,
+                )
+            except Exception as exc:  # noqa: BLE001
+                return {"error": str(exc)}
+            return {"subject": subject, "body": body}
+
+        with span("bulk.draft", agents=len(agents)):
+            return dict(zip(agents, _fan_out(draft, agents)))
+
+    def _show_bulk_drafts(self, p: dict, intro: str) -> None:
+        drafts = p["drafts"]
+        parts = [intro]
+        for n, (agent_email, d) in enumerate(drafts.items(), 1):
+            parts.append(f"**{n}. {agent_email}** — *{d['subject']}*\n\n---\n{d['body']}\n---")
+        parts.append(
+            f"Say **'send them'** to send all {len(drafts)}, name an address to leave it out "
+            "(*'drop info@agency.com'*), or tell me how to change them "
+            "(*'mention I have a dog'*, *'keep them shorter'*)."
+        )
+        self.add("assistant", "\n\n".join(parts))
+
+    def _run_bulk(self, p: dict, t: str, found: str | None) -> None:
+        s = self.state
+        # Step 1: collect user CC address.
+        if not s["user_email"]:
+            if not found:
+                self.add("assistant", f"I'll email all {len(p['agents'])} agents — what email should I CC you on?")
+                return
+            if found in p["agents"]:
+                self.add("assistant", "That's one of the agents' addresses — what email should I CC you on?")
+                return
+            s["user_email"] = found
+            t = ""  # the address was the whole answer, not a review instruction
+
+        # Step 2: draft for everyone at once and ask for one approval.
+        if p.get("drafts") is None:
+            drafts = self._draft_bulk(p["agents"], p.get("user_request", ""))
+            failed = [a for a, d in drafts.items() if "error" in d]
+            p["drafts"] = {a: d for a, d in drafts.items() if "error" not in d}
+            for agent_email in failed:
+                self.add("assistant", f"Couldn't draft an email for **{agent_email}**: `{drafts[agent_email]['error']}`")
+            if not p["drafts"]:
+                s["pending_email"] = None
+                return
+            self._show_bulk_drafts(p, f"Here are the enquiries for **{len(p['drafts'])} agents**:")
+            return
+
+        if not t:
+            return
+
+        # Step 3: approve, drop someone, or refine every draft.
+        named = [e for e in extract_all_emails(t) if e in p["drafts"]]
+        if named:
+            for agent_email in named:
+                p["drafts"].pop(agent_email)
+            if not p["drafts"]:
+                self.add("assistant", "OK — that leaves nobody to email, so I've cancelled it.")
+                s["pending_email"] = None
+                return
+            self._show_bulk_drafts(p, f"Dropped {', '.join(f'**{e}**' for e in named)}. Still to send:")
+            return
+
+        if classify_draft_response(t) == "approve":
+            self._send_bulk(p)
+            return
+
+        def refine(item: tuple[str, dict]) -> dict:
+            _agent_email, d = item
+            try:
+                subject, body = refine_draft(draft_subject=d["subject"], draft_body=d["body"], instruction=t)
+            except Exception as exc:  # noqa: BLE001
+                return {**d, "error": str(exc)}
+            return {"subject": subject, "body": body}
+
+        with span("bulk.refine", agents=len(p["drafts"])):
+            refined = dict(zip(p["drafts"], _fan_out(refine, list(p["drafts"].items()))))
+        errors = {a: d.pop("error") for a, d in refined.items() if "error" in d}
+        p["drafts"] = refined
+        if errors:
+            first = next(iter(errors.values()))
+            self.add("assistant", f"Couldn't update {len(errors)} of the drafts (`{first}`); those are unchanged.")
+        self._show_bulk_drafts(p, "Here are the updated drafts:")
+
+    def _send_bulk(self, p: dict) -> None:
+        """Send every approved draft in one Gmail batch and record the threads."""
+        s = self.state
+        drafts: dict[str, dict] = p["drafts"]
+        agents = list(drafts)
+        messages = [
+            {
+                "to": agent_email,
+                "subject": drafts[agent_email]["subject"],
+                "body": drafts[agent_email]["body"],
+                "cc": [s["user_email"]],
+                # No reply_to — agent replies must land in LENAH's Gmail.
+                "thread_id": s["agent_threads"].get(agent_email),
+            }
+            for agent_email in agents
+        ]
+        try:
+            # Per-message failures, transport errors included, come back as
+            # results, so the sends that did go out are recorded below.
+            results = self._client().send_batch(messages)
+        except Exception as exc:  # noqa: BLE001
+            self.add("assistant", f"Sorry — couldn't send the emails: `{exc}`")
+            s["pending_email"] = None
+            return
+
+        sent: list[str] = []
+        failed: list[tuple[str, Exception]] = []
+        for agent_email, result in zip(agents, results):
+            if isinstance(result, Exception):
+                failed.append((agent_email, result))
+                continue
+            msg_id, thread_id = result
+            d = drafts[agent_email]
+            self._record_send(agent_email, msg_id, thread_id, d["subject"], d["body"])
+            sent.append(agent_email)
+
+        lines = []
+        if sent:
+            lines.append(
+                f"Done — emailed **{len(sent)} agents** and CC'd you at **{s['user_email']}**:\n\n"
+                + "\n".join(f"- {e}" for e in sent)
+            )
+        for agent_email, exc in failed:
+            lines.append(f"Couldn't send to **{agent_email}**: `{exc}`")
+        self.add("assistant", "\n\n".join(lines))
+        s["pending_email"] = None
+
+    # ------------------------------------------------------------------
+    # Main message dispatcher
+    # ------------------------------------------------------------------
+
+    @traced("turn.handle_message")
+    def handle_message(self, user_text: str) -> None:
+        """
+        Respond to ``user_text``, which the caller has already appended to
+        ``state["messages"]``.
+        """
+        s = self.state
+        current().set(
+            pending=(s["pending_email"] or {}).get("action"),
+            history=len(s["messages"]),
+        )
+
+        # Only sniff for the user's own email when not mid-flow — inside a pending
+        # flow the disambiguation logic in _run_pending takes precedence.
+        if s["pending_email"] is None:
+            own_email = sniff_own_email(user_text)
+            if own_email:
+                s["user_email"] = own_email
+
+        if s["pending_email"] is not None:
+            self._run_pending(user_text)
+            return
+
+        result = chat(
+            chat_history=s["messages"],
+            user_text=user_text,
+            user_email=s["user_email"],
+            listings=self._listing_context(user_text),
+            recalled=self._recall(user_text, CHAT_HISTORY_WINDOW),
+        )
+
+        if isinstance(result, str):
+            self.add("assistant", result)
+            return
+
+        # ToolCall — set pending state then immediately kick off the flow with an
+        # empty string so any first missing-info prompt is shown right away.
+        if result.name == "send_summary_to_user":
+            s["pending_email"] = {
+                "action": "summary",
+                "agent_email": None,
+            }
+        elif result.name == "send_email_to_agent":
+            agents = self._bulk_recipients(user_text)
+            if len(agents) > BULK_MAX_AGENTS:
+                self.add(
+                    "assistant",
+                    f"That's {len(agents)} addresses — I can email up to {BULK_MAX_AGENTS} agents at once. "
+                    "Could you split them up?",
+                )
+                return
+            if len(agents) > 1:
+                # Several addresses in one message: one personalised enquiry each.
+                s["pending_email"] = {
+                    "action": "bulk_agent",
+                    "user_request": user_text,
+                    "agents": agents,
+                    "drafts": None,
+                }
+            else:
+                s["pending_email"] = {
+                    "action": "agent",
+                    "user_request": user_text,
+                    "agent_email": result.args.get("agent_email") or None,
+                }
+
+        self._run_pending("")
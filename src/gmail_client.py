@@ -1,15 +1,73 @@
 from __future__ import annotations
 
 import base64
+import itertools
+import json
+import re
 from dataclasses import dataclass
 from email.message import EmailMessage
 from pathlib import Path
-from typing import Sequence
+from typing import Iterable, Iterator, Sequence
 
-from google.auth.transport.requests import Request
+from google.auth.transport.requests import AuthorizedSession, Request
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
 
+from src.recorder import capture_gmail
+from src.tracing import span, traced
+
+
+# Gmail accepts up to 100 calls per batch but recommends no more than 50.
+_BATCH_SIZE = 50
+
+
+class HistoryExpired(RuntimeError):
+    """The requested startHistoryId is older than Gmail keeps history for."""
+
+
+class AttachmentTooLarge(RuntimeError):
+    """An attachment download went over its size cap and was abandoned."""
+
+
+_DATA_FIELD = re.compile(rb'"data"\s*:\s*"')
+_STREAM_CHUNK = 64 * 1024
+
+
+def _write_base64_field(chunks: Iterable[bytes], dest: Path, max_bytes: int) -> int:
+    """
+    Decode the base64url ``"data"`` member of a (streamed) attachments.get
+    response into ``dest`` as it arrives, so neither the response nor the
+    file is ever held whole. Returns bytes written.
+    """
+    it = iter(chunks)
+    head = b""
+    for chunk in it:
+        head += chunk
+        m = _DATA_FIELD.search(head)
+        if m:
+            first = head[m.end():]
+            break
+        head = head[-32:]  # the marker may straddle two chunks
+    else:
+        raise ValueError("attachment response has no data")
+
+    written = 0
+    pending = b""
+    with dest.open("wb") as fh:
+        for chunk in itertools.chain([first], it):
+            end = chunk.find(b'"')
+            pending += chunk if end < 0 else chunk[:end]
+            usable = len(pending) // 4 * 4 if end < 0 else len(pending)
+            data = base64.urlsafe_b64decode(pending[:usable] + b"=" * (-usable % 4))
+            pending = pending[usable:]
+            written += len(data)
+            if written > max_bytes:
+                raise AttachmentTooLarge(f"over {max_bytes} bytes")
+            fh.write(data)
+            if end >= 0:
+                break
+    return written
+
 
 @dataclass
 class GmailClient:
@@ -43,11 +101,20 @@ class GmailClient:
     def service(self):
         # Cached on the instance so credentials are refreshed at most once.
         if not hasattr(self, "_service"):
-            object.__setattr__(
-                self, "_service", build("gmail", "v1", credentials=self._get_creds())
-            )
+            with span("gmail.build_service"):
+                object.__setattr__(
+                    self, "_service", build("gmail", "v1", credentials=self._get_creds())
+                )
         return self._service
 
+    @staticmethod
+    def _execute(request, endpoint: str, **attrs) -> dict:
+        """Run a prepared API request inside a span named after its endpoint."""
+        with span(f"gmail.{endpoint}", endpoint=endpoint, **attrs):
+            response = request.execute()
+        capture_gmail(endpoint, request, response)
+        return response
+
     # ------------------------------------------------------------------
     # Encoding helper
     # ------------------------------------------------------------------
@@ -61,7 +128,7 @@ class GmailClient:
     # ------------------------------------------------------------------
 
     def get_message(self, message_id: str) -> dict:
-        return (
+        request = (
             self.service()
             .users()
             .messages()
@@ -71,12 +138,12 @@ class GmailClient:
                 format="metadata",
                 metadataHeaders=["Message-Id", "References"],
             )
-            .execute()
         )
+        return self._execute(request, "messages.get")
 
     def get_thread(self, thread_id: str) -> dict:
         """Returns thread with metadata only (no body). Used for threading headers."""
-        return (
+        request = (
             self.service()
             .users()
             .threads()
@@ -86,18 +153,90 @@ class GmailClient:
                 format="metadata",
                 metadataHeaders=["Message-Id", "References", "From", "To", "Subject"],
             )
-            .execute()
         )
+        return self._execute(request, "threads.get", format="metadata")
 
     def get_thread_full(self, thread_id: str) -> dict:
         """Returns thread with full message payloads (includes body data)."""
-        return (
+        request = (
             self.service()
             .users()
             .threads()
             .get(userId="me", id=thread_id, format="full")
-            .execute()
         )
+        return self._execute(request, "threads.get", format="full")
+
+    # ------------------------------------------------------------------
+    # Mailbox history
+    # ------------------------------------------------------------------
+
+    def get_profile(self) -> dict:
+        """{"emailAddress", "historyId", ...} of the mailbox."""
+        request = self.service().users().getProfile(userId="me")
+        return self._execute(request, "getProfile")
+
+    def get_history_id(self) -> str:
+        """The mailbox's current historyId, a starting point for list_history."""
+        return str(self.get_profile()["historyId"])
+
+    def list_history(self, start_history_id: str) -> tuple[list[dict], str]:
+        """
+        Inbound messages added to the mailbox since ``start_history_id``.
+
+        Returns ([{"id", "threadId", "labelIds"}, ...], latest historyId).
+        Raises HistoryExpired if Gmail no longer has history that far back
+        (roughly a week); the caller should take a fresh historyId and fall
+        back to polling threads once.
+        """
+        from googleapiclient.errors import HttpError  # noqa: PLC0415
+
+        added: list[dict] = []
+        seen: set[str] = set()
+        latest = start_history_id
+        page_token: str | None = None
+        while True:
+            request = self.service().users().history().list(
+                userId="me",
+                startHistoryId=start_history_id,
+                historyTypes=["messageAdded"],
+                labelId="INBOX",
+                pageToken=page_token,
+            )
+            try:
+                page = self._execute(request, "history.list")
+            except HttpError as exc:
+                if exc.status_code == 404:
+                    raise HistoryExpired(start_history_id) from exc
+                raise
+            for record in page.get("history") or []:
+                for entry in record.get("messagesAdded") or []:
+                    msg = entry.get("message") or {}
+                    if msg.get("id") and msg["id"] not in seen and "SENT" not in (msg.get("labelIds") or []):
+                        seen.add(msg["id"])
+                        added.append(msg)
+            latest = str(page.get("historyId") or latest)
+            page_token = page.get("nextPageToken")
+            if not page_token:
+                return added, latest
+
+    # ------------------------------------------------------------------
+    # Push notifications
+    # ------------------------------------------------------------------
+
+    def watch(self, topic_name: str, label_ids: Sequence[str] = ("INBOX",)) -> dict:
+        """
+        Start, or renew, push notifications for the mailbox to a Cloud
+        Pub/Sub topic. Returns {"historyId", "expiration"}, the expiration
+        in epoch milliseconds (about a week out).
+        """
+        request = self.service().users().watch(
+            userId="me",
+            body={"topicName": topic_name, "labelIds": list(label_ids), "labelFilterBehavior": "INCLUDE"},
+        )
+        return self._execute(request, "watch")
+
+    def stop_watch(self) -> None:
+        self._execute(self.service().users().stop(userId="me"), "stop")
 
     # ------------------------------------------------------------------
     # Body extraction
@@ -140,10 +279,68 @@ class GmailClient:
 
         return ""
 
+    @staticmethod
+    def _attachment_parts(payload: dict) -> list[dict]:
+        """
+        Metadata of every attached file in a message payload; nothing is
+        downloaded. Each dict has part_id, filename, mime_type, size and
+        either attachment_id (fetch with download_attachment) or, for small
+        inline parts, the base64url ``data`` itself.
+        """
+        found: list[dict] = []
+        body = payload.get("body") or {}
+        if payload.get("filename") and (body.get("attachmentId") or body.get("data")):
+            found.append({
+                "part_id": payload.get("partId") or "",
+                "filename": payload["filename"],
+                "mime_type": payload.get("mimeType") or "application/octet-stream",
+                "size": int(body.get("size") or 0),
+                "attachment_id": body.get("attachmentId"),
+                "data": None if body.get("attachmentId") else body.get("data"),
+            })
+        for part in payload.get("parts") or []:
+            found.extend(GmailClient._attachment_parts(part))
+        return found
+
+    # ------------------------------------------------------------------
+    # Attachments
+    # ------------------------------------------------------------------
+
+    def _stream(self, uri: str) -> Iterator[bytes]:
+        if not hasattr(self, "_session"):
+            object.__setattr__(self, "_session", AuthorizedSession(self._get_creds()))
+        with self._session.get(uri, stream=True, timeout=60) as resp:
+            resp.raise_for_status()
+            yield from resp.iter_content(_STREAM_CHUNK)
+
+    def download_attachment(self, message_id: str, attachment_id: str, dest: Path, *, max_bytes: int) -> int:
+        """
+        Fetch one attachment (messages.attachments.get) into ``dest``,
+        streaming the response and decoding it on the way. Raises
+        AttachmentTooLarge, leaving no file, once it passes ``max_bytes``.
+        Returns the file's size.
+        """
+        request = self.service().users().messages().attachments().get(
+            userId="me", messageId=message_id, id=attachment_id
+        )
+        with span("gmail.messages.attachments.get", endpoint="messages.attachments.get") as s:
+            # A real API request is streamed over its own authorised session;
+            # anything else (tests, the bench fakes) just executes.
+            uri = getattr(request, "uri", None)
+            chunks = self._stream(uri) if uri else [json.dumps(request.execute()).encode("utf-8")]
+            try:
+                size = _write_base64_field(chunks, dest, max_bytes)
+            except BaseException:
+                dest.unlink(missing_ok=True)
+                raise
+            s.set(bytes=size)
+        return size
+
     # ------------------------------------------------------------------
     # Reply detection
     # ------------------------------------------------------------------
 
+    @traced("gmail.get_new_replies")
     def get_new_replies(
         self,
         thread_id: str,
@@ -156,6 +353,9 @@ class GmailClient:
             id   : str  — Gmail message ID
             from : str  — sender address / display name
             body : str  — plain-text content of the message
+            date : float — when Gmail received it (epoch seconds)
+            attachments : list[dict] — attached files, metadata only
+                (see _attachment_parts)
 
         If after_message_id is None, all messages in the thread are returned.
         Only messages *not* sent by "me" are returned — we filter out our own
@@ -194,6 +394,8 @@ class GmailClient:
                     "from": _header("From") or "Unknown sender",
                     "subject": _header("Subject"),
                     "body": self._extract_plain_text(payload),
+                    "date": int(msg.get("internalDate") or 0) / 1000,
+                    "attachments": self._attachment_parts(payload),
                 }
             )
 
@@ -212,6 +414,7 @@ class GmailClient:
                 return v or None
         return None
 
+    @traced("gmail.latest_rfc_ids")
     def _latest_rfc_ids(self, thread_id: str) -> tuple[str | None, str | None]:
         """
         Returns (in_reply_to, references) based on the latest message in thread.
@@ -236,7 +439,7 @@ class GmailClient:
     # Send
     # ------------------------------------------------------------------
 
-    def send_email(
+    def _send_payload(
         self,
         *,
         to: str,
@@ -245,15 +448,8 @@ class GmailClient:
         cc: list[str] | None = None,
         reply_to: str | None = None,
         thread_id: str | None = None,
-    ) -> tuple[str, str]:
-        """
-        Send an email from the authenticated account.
-
-        If thread_id is supplied the message is sent as a reply in that thread
-        with correct In-Reply-To / References headers.
-
-        Returns (gmail_message_id, thread_id).
-        """
+    ) -> dict:
+        """Build the messages.send request body, threading headers included."""
         cc = cc or []
         msg = EmailMessage()
         msg["To"] = to
@@ -278,12 +474,96 @@ class GmailClient:
         payload: dict = {"raw": self._b64url(msg.as_bytes())}
         if thread_id:
             payload["threadId"] = thread_id
+        return payload
+
+    @traced("gmail.send_email")
+    def send_email(
+        self,
+        *,
+        to: str,
+        subject: str,
+        body: str,
+        cc: list[str] | None = None,
+        reply_to: str | None = None,
+        thread_id: str | None = None,
+    ) -> tuple[str, str]:
+        """
+        Send an email from the authenticated account.
+
+        If thread_id is supplied the message is sent as a reply in that thread
+        with correct In-Reply-To / References headers.
+
+        Returns (gmail_message_id, thread_id).
+        """
+        payload = self._send_payload(
+            to=to, subject=subject, body=body, cc=cc, reply_to=reply_to, thread_id=thread_id
+        )
 
         from googleapiclient.errors import HttpError  # noqa: PLC0415
 
         try:
-            sent = self.service().users().messages().send(userId="me", body=payload).execute()
+            request = self.service().users().messages().send(userId="me", body=payload)
+            sent = self._execute(request, "messages.send", bytes=len(payload["raw"]))
         except HttpError as exc:
             raise RuntimeError(f"Gmail send failed ({exc.status_code}): {exc.reason}") from exc
 
-        return sent["id"], sent["threadId"]
\ No newline at end of file
+        return sent["id"], sent["threadId"]
+
+    @traced("gmail.send_batch")
+    def send_batch(self, messages: list[dict]) -> list[tuple[str, str] | Exception]:
+        """
+        Send several emails through Gmail's batch endpoint: one HTTP round
+        trip per _BATCH_SIZE messages instead of one each.
+
+        Each item takes send_email's keyword arguments. Returns, in the same
+        order, (gmail_message_id, thread_id) for every message sent or the
+        exception for every one that failed — one failure doesn't stop the
+        rest.
+        """
+        from googleapiclient.errors import HttpError  # noqa: PLC0415
+
+        results: list[tuple[str, str] | Exception | None] = [None] * len(messages)
+        service = self.service()
+        for start in range(0, len(messages), _BATCH_SIZE):
+            chunk = messages[start:start + _BATCH_SIZE]
+
+            def _done(request_id: str, response: dict | None, exc: Exception | None) -> None:
+                i = int(request_id)
+                if exc is not None:
+                    if isinstance(exc, HttpError):
+                        exc = RuntimeError(f"Gmail send failed ({exc.status_code}): {exc.reason}")
+                    results[i] = exc
+                    return
+                capture_gmail("messages.send", None, response)
+                results[i] = (response["id"], response["threadId"])
+
+            batch = service.new_batch_http_request(callback=_done)
+            size = 0
+            for i, kwargs in enumerate(chunk, start):
+                try:
+                    payload = self._send_payload(**kwargs)
+                except Exception as exc:  # noqa: BLE001
+                    results[i] = exc
+                    continue
+                size += len(payload["raw"])
+                batch.add(service.users().messages().send(userId="me", body=payload), request_id=str(i))
+            with span("gmail.batch", endpoint="messages.send", messages=len(chunk), bytes=size):
+                try:
+                    batch.execute()
+                except Exception as exc:  # noqa: BLE001
+                    # A transport error (timeout, SSL) can come after some
+                    # sub-requests went out. Their callbacks already ran, so
+                    # those stay sent; only the unresolved ones fail, and no
+                    # further batch is attempted on a connection in this state.
+                    if isinstance(exc, HttpError):
+                        error = RuntimeError(f"Gmail batch failed ({exc.status_code}): {exc.reason}")
+                    else:
+                        error = RuntimeError(f"Gmail batch failed ({type(exc).__name__}: {exc}); it may have been sent")
+                    for i in range(start, start + len(chunk)):
+                        if results[i] is None:
+                            results[i] = error
+                    for i in range(start + len(chunk), len(messages)):
+                        if results[i] is None:
+                            results[i] = RuntimeError("Not sent: an earlier Gmail batch failed")
+                    break
+        return [RuntimeError("Gmail returned no response") if r is None else r for r in results]
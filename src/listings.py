@@ -0,0 +1,385 @@
+"""
+Structured listings from agent replies, and a local index to query them.
+
+When the poller processes an agent's reply it also extracts the listings
+in it (price, bedrooms, area, availability) once, with one LLM call, and
+stores them in the user's ``listings`` state: listing id -> record. Later
+questions like "which ones were under £2,000?" are then answered here, not
+by the model re-reading the whole history:
+
+- :class:`ListingIndex` holds the records as numpy columns, so a filter is
+  a few vectorised comparisons and a sort is one argsort;
+- :func:`parse_query` turns the common phrasings (price bounds, bedrooms,
+  "available by", "cheapest") into a :class:`ListingFilter`;
+- :func:`listing_context` renders the matches as a compact table that is
+  handed to ``chat`` with the user's message.
+
+Indexes are cached per user and rebuilt only when their listings change.
+"""
+from __future__ import annotations
+
+import datetime as dt
+import re
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any
+
+import numpy as np
+
+# Rent quoted per week, as a monthly figure.
+_WEEKS_PER_MONTH = 52 / 12
+
+_MONTHS = {
+    m: i for i, m in enumerate(
+        ("jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"), 1
+    )
+}
+
+# Most matches rendered into the chat context.
+_CONTEXT_LIMIT = 10
+
+
+# ---------------------------------------------------------------------------
+# Records
+# ---------------------------------------------------------------------------
+
+def _number(value: Any) -> float | None:
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    if isinstance(value, str):
+        m = re.search(r"\d[\d,]*(?:\.\d+)?", value)
+        if m:
+            return float(m.group(0).replace(",", ""))
+    return None
+
+
+def _date(value: Any, received: dt.date) -> str | None:
+    if not isinstance(value, str) or not value.strip():
+        return None
+    text = value.strip().lower()
+    if text in ("now", "immediately", "available now"):
+        return received.isoformat()
+    try:
+        return dt.date.fromisoformat(text[:10]).isoformat()
+    except ValueError:
+        return None
+
+
+def normalise_listing(raw: dict[str, Any], *, agent_email: str, thread_id: str, received: float) -> dict[str, Any]:
+    """One extracted listing as stored in state, with a comparable monthly price."""
+    day = dt.datetime.fromtimestamp(received or 0, dt.timezone.utc).date()
+    price = _number(raw.get("price"))
+    period = raw.get("period") if raw.get("period") in ("pcm", "pw", "sale") else None
+    bedrooms = _number(raw.get("bedrooms"))
+    return {
+        "agent_email": agent_email,
+        "thread_id": thread_id,
+        "received": received,
+        "address": str(raw.get("address") or "").strip(),
+        "area": str(raw.get("area") or "").strip(),
+        "price": price,
+        "period": period,
+        # Rents compared per month; sale prices as they are.
+        "monthly": price * _WEEKS_PER_MONTH if price is not None and period == "pw" else price,
+        "bedrooms": int(bedrooms) if bedrooms is not None else None,
+        "available": _date(raw.get("available"), day),
+        "notes": str(raw.get("notes") or "").strip(),
+    }
+
+
+def add_listings(state: Any, reply_id: str, records: list[dict[str, Any]]) -> int:
+    """Store a reply's listings under ``{reply_id}:{n}``. Returns how many."""
+    listings = state.setdefault("listings", {})
+    for n, record in enumerate(records):
+        listings[f"{reply_id}:{n}"] = record
+    return len(records)
+
+
+# ---------------------------------------------------------------------------
+# Columnar index
+# ---------------------------------------------------------------------------
+
+@dataclass
+class ListingFilter:
+    min_price: float | None = None
+    max_price: float | None = None
+    min_bedrooms: int | None = None
+    max_bedrooms: int | None = None
+    available_by: str | None = None  # YYYY-MM-DD
+    area: str | None = None  # substring of the area or address
+    agent: str | None = None
+    sort: str = "price"  # price | -price | bedrooms | -bedrooms | available | -received
+    limit: int | None = None
+
+    def describe(self) -> str:
+        parts: list[str] = []
+        if self.min_price is not None and self.max_price is not None:
+            parts.append(f"£{self.min_price:,.0f}–£{self.max_price:,.0f}")
+        elif self.max_price is not None:
+            parts.append(f"up to £{self.max_price:,.0f}")
+        elif self.min_price is not None:
+            parts.append(f"from £{self.min_price:,.0f}")
+        if self.min_bedrooms is not None and self.min_bedrooms == self.max_bedrooms:
+            parts.append(f"{self.min_bedrooms} bed")
+        elif self.min_bedrooms is not None:
+            parts.append(f"{self.min_bedrooms}+ bed")
+        elif self.max_bedrooms is not None:
+            parts.append(f"up to {self.max_bedrooms} bed")
+        if self.available_by:
+            parts.append(f"available by {self.available_by}")
+        if self.area:
+            parts.append(f"in {self.area}")
+        if self.agent:
+            parts.append(f"from {self.agent}")
+        return ", ".join(parts)
+
+
+def _or_nan(value: float | None) -> float:
+    return np.nan if value is None else value
+
+
+class ListingIndex:
+    """One user's listings as parallel numpy columns; missing values are NaN / NaT."""
+
+    def __init__(self, listings: dict[str, dict[str, Any]]) -> None:
+        self.ids = list(listings)
+        self.records = [listings[i] for i in self.ids]
+        rows = self.records
+        self.price = np.array([_or_nan(r.get("monthly")) for r in rows], dtype=np.float64)
+        self.bedrooms = np.array([_or_nan(r.get("bedrooms")) for r in rows], dtype=np.float64)
+        self.available = np.array([r.get("available") or "NaT" for r in rows], dtype="datetime64[D]")
+        # Days since the epoch as floats, so unknown dates sort last like NaN prices.
+        self._available_days = np.where(
+            np.isnat(self.available), np.nan, self.available.astype(np.int64).astype(np.float64)
+        )
+        self.received = np.array([r.get("received") or 0.0 for r in rows], dtype=np.float64)
+        self.area = np.array([(r.get("area") or "").lower() for r in rows], dtype=np.str_)
+        self.address = np.array([(r.get("address") or "").lower() for r in rows], dtype=np.str_)
+        self.agent = np.array([r.get("agent_email") or "" for r in rows], dtype=np.str_)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def areas(self) -> list[str]:
+        """Distinct areas, longest first so "hackney central" wins over "hackney"."""
+        return sorted({a for a in self.area.tolist() if a}, key=len, reverse=True)
+
+    def query(self, f: ListingFilter) -> list[dict[str, Any]]:
+        """Records matching ``f``, sorted; rows missing a sort value go last."""
+        mask = np.ones(len(self), dtype=bool)
+        # Comparisons with NaN / NaT are False, so a bound excludes unknowns.
+        if f.min_price is not None:
+            mask &= self.price >= f.min_price
+        if f.max_price is not None:
+            mask &= self.price <= f.max_price
+        if f.min_bedrooms is not None:
+            mask &= self.bedrooms >= f.min_bedrooms
+        if f.max_bedrooms is not None:
+            mask &= self.bedrooms <= f.max_bedrooms
+        if f.available_by:
+            mask &= self.available <= np.datetime64(f.available_by, "D")
+        if f.area:
+            needle = f.area.lower()
+            mask &= (np.char.find(self.area, needle) >= 0) | (np.char.find(self.address, needle) >= 0)
+        if f.agent:
+            mask &= np.char.find(self.agent, f.agent.lower()) >= 0
+
+        rows = np.flatnonzero(mask)
+        key = {
+            "price": self.price,
+            "-price": -self.price,
+            "bedrooms": self.bedrooms,
+            "-bedrooms": -self.bedrooms,
+            "available": self._available_days,
+            "-received": -self.received,
+        }.get(f.sort, self.price)[rows]
+        rows = rows[np.argsort(key, kind="stable")]
+        if f.limit is not None:
+            rows = rows[:f.limit]
+        return [{"id": self.ids[i], **self.records[i]} for i in rows]
+
+
+_cache: OrderedDict[str, tuple[tuple, ListingIndex]] = OrderedDict()
+_cache_lock = threading.Lock()
+_CACHE_USERS = 256
+
+
+def index_for(state: Any) -> ListingIndex:
+    """The user's index, rebuilt only when their listings changed."""
+    listings: dict[str, dict] = state.get("listings") or {}
+    user = state.get("owner_email") or ""
+    key = (len(listings), next(reversed(listings), None))
+    with _cache_lock:
+        hit = _cache.get(user)
+        if hit is not None and hit[0] == key:
+            _cache.move_to_end(user)
+            return hit[1]
+    index = ListingIndex(listings)
+    with _cache_lock:
+        _cache[user] = (key, index)
+        _cache.move_to_end(user)
+        while len(_cache) > _CACHE_USERS:
+            _cache.popitem(last=False)
+    return index
+
+
+# ---------------------------------------------------------------------------
+# Questions -> filters
+# ---------------------------------------------------------------------------
+
+_AMOUNT = r"£\s?(\d[\d,]*(?:\.\d+)?)\s?(k|m)?"
+_LISTING_WORDS = re.compile(
+    r"\b(listings?|propert(?:y|ies)|flats?|apartments?|houses?|homes?|places?|options?|ones)\b"
+)
+
+
+def _amount(match: re.Match, group: int = 1) -> float:
+    value = float(match.group(group).replace(",", ""))
+    suffix = (match.group(group + 1) or "").lower()
+    return value * {"k": 1_000, "m": 1_000_000}.get(suffix, 1)
+
+
+# "3rd march", "march 3", "the end of march 2027", "mid-april": a month name
+# anywhere in the text, not just its first word ("by the end of march").
+_MONTH_NAMES = (
+    r"jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|june?|july?|aug(?:ust)?|"
+    r"sept?(?:ember)?|oct(?:ober)?|nov(?:ember)?|dec(?:ember)?"
+)
+_DAY = r"(\d{1,2})(?:st|nd|rd|th)?"
+_MONTH_DATE = re.compile(
+    rf"\b(?:{_DAY}\s+(?:of\s+)?|(start|beginning|mid|middle|end)[\s-]+(?:of\s+)?)?"
+    rf"({_MONTH_NAMES})\b(?:\s+{_DAY}\b)?(?:,?\s+(\d{{4}}))?"
+)
+
+
+def _parse_day(text: str, today: dt.date) -> str | None:
+    """The date in ``text`` as YYYY-MM-DD, or None if there is none or it doesn't exist ("31 feb")."""
+    if re.search(r"\b(now|today|immediately)\b", text):
+        return today.isoformat()
+    try:
+        m = re.search(r"\d{4}-\d{2}-\d{2}", text)
+        if m:
+            return dt.date.fromisoformat(m.group(0)).isoformat()
+        m = _MONTH_DATE.search(text)
+        if m:
+            before, part, name, after, year = m.groups()
+            month = _MONTHS[name[:3]]
+            year = int(year) if year else today.year + (month < today.month)
+            day = before or after or {"start": "1", "beginning": "1", "mid": "15", "middle": "15"}.get(part or "")
+            if day:
+                return dt.date(year, month, int(day)).isoformat()
+            # "by March", "by the end of March": any time in March.
+            end = dt.date(year + month // 12, month % 12 + 1, 1) - dt.timedelta(days=1)
+            return end.isoformat()
+    except ValueError:
+        return None
+    return None
+
+
+def parse_query(text: str, today: dt.date | None = None) -> ListingFilter | None:
+    """
+    The filter a question about listings asks for, or None if the message
+    isn't about listings at all.
+    """
+    t = (text or "").lower()
+    today = today or dt.date.today()
+    f = ListingFilter()
+    found = False
+
+    if m := re.search(rf"between\s+{_AMOUNT}\s+and\s+{_AMOUNT}", t):
+        f.min_price, f.max_price = _amount(m, 1), _amount(m, 3)
+        found = True
+    else:
+        if m := re.search(rf"(?:under|below|less than|cheaper than|max(?:imum)?|up to|at most|<)\s*{_AMOUNT}", t):
+            f.max_price = _amount(m)
+            found = True
+        if m := re.search(rf"(?:over|above|more than|at least|min(?:imum)?|from|>)\s*{_AMOUNT}", t):
+            f.min_price = _amount(m)
+            found = True
+
+    if m := re.search(r"(\d+)\s*\+\s*bed|(?:at least|minimum of|min)\s+(\d+)\s*bed", t):
+        f.min_bedrooms = int(m.group(1) or m.group(2))
+        found = True
+    elif m := re.search(r"(\d+)[\s-]*bed", t):
+        f.min_bedrooms = f.max_bedrooms = int(m.group(1))
+        found = True
+    elif "studio" in t:
+        f.min_bedrooms = f.max_bedrooms = 0
+        found = True
+
+    if m := re.search(r"available\s+(?:by|before|from|on|for)?\s*([^,.?!]+)", t):
+        f.available_by = _parse_day(m.group(1), today)
+        found = found or f.available_by is not None
+
+    if re.search(r"cheapest|lowest price|least expensive", t):
+        f.sort, found = "price", True
+    elif re.search(r"most expensive|priciest|highest price", t):
+        f.sort, found = "-price", True
+    elif re.search(r"biggest|largest|most bed", t):
+        f.sort, found = "-bedrooms", True
+    elif re.search(r"soonest|earliest", t):
+        f.sort, found = "available", True
+    elif re.search(r"latest|newest|most recent", t):
+        f.sort, found = "-received", True
+
+    if m := re.search(r"\b(?:top|first)\s+(\d+)\b", t):
+        f.limit = int(m.group(1))
+
+    if not found and not _LISTING_WORDS.search(t):
+        return None
+    if not found and not re.search(r"\b(which|what|show|list|any|compare)\b", t):
+        return None
+    return f
+
+
+# ---------------------------------------------------------------------------
+# Chat context
+# ---------------------------------------------------------------------------
+
+def _row(r: dict[str, Any]) -> str:
+    if r.get("price") is None:
+        price = "price n/a"
+    elif r.get("period") == "sale":
+        price = f"£{r['price']:,.0f}"
+    else:
+        price = f"£{r['price']:,.0f} {r.get('period') or ''}".rstrip()
+    beds = "studio" if r.get("bedrooms") == 0 else f"{r['bedrooms']} bed" if r.get("bedrooms") is not None else "? bed"
+    where = ", ".join(x for x in (r.get("address"), r.get("area")) if x) or "location n/a"
+    received = dt.datetime.fromtimestamp(r.get("received") or 0, dt.timezone.utc).date().isoformat()
+    parts = [price, beds, where, f"available {r.get('available') or 'n/a'}", f"{r['agent_email']} ({received})"]
+    if r.get("notes"):
+        parts.append(r["notes"])
+    return " | ".join(parts)
+
+
+def listing_context(state: Any, user_text: str) -> str | None:
+    """
+    The listings that answer ``user_text``, as a few lines for ``chat``, or
+    None when the message isn't about listings or there are none.
+    """
+    if not state.get("listings"):
+        return None
+    f = parse_query(user_text)
+    if f is None:
+        return None
+    index = index_for(state)
+    text = user_text.lower()
+    areas = index.areas()
+    # A whole area name, else one word of one ("hackney" for "hackney central").
+    f.area = next((a for a in areas if a in text), None) or next(
+        (w for w in re.findall(r"[a-z]{4,}", text) if any(w in a.split() for a in areas)), None
+    )
+    matches = index.query(f)
+    what = f.describe()
+    header = f"Listings agents have sent ({len(index)} in total)"
+    if what:
+        header += f"; {len(matches)} match {what}"
+    if not matches:
+        return header + ": none. Say so rather than guessing."
+    shown = matches[:f.limit or _CONTEXT_LIMIT]
+    lines = [header + ". Answer from these, not from memory:"]
+    lines += [f"{n}. {_row(r)}" for n, r in enumerate(shown, 1)]
+    if len(matches) > len(shown):
+        lines.append(f"(+{len(matches) - len(shown)} more)")
+    return "\n".join(lines)
@@ -6,8 +6,10 @@ from typing import Any
 
 from openai import OpenAI
 
-from src.config import OPENAI_API_KEY, OPENAI_MODEL
+from src.config import HISTORY_WINDOW_CHUNK, OPENAI_API_KEY, OPENAI_MODEL
+from src.recorder import capture_llm
 from src.templates import ensure_signature
+from src.tracing import span
 
 if not OPENAI_API_KEY:
     raise RuntimeError(
@@ -16,6 +18,12 @@ if not OPENAI_API_KEY:
 
 _client = OpenAI(api_key=OPENAI_API_KEY)
 
+# Recent messages each call sends verbatim (at least; see history_window).
+# Anything older only reaches the model as ``recalled`` snippets picked by
+# src/recall.py.
+CHAT_HISTORY_WINDOW = 20
+DRAFT_HISTORY_WINDOW = 40
+
 
 # ---------------------------------------------------------------------------
 # Tool definitions
@@ -44,9 +52,10 @@ _TOOLS = [
             "name": "send_email_to_agent",
             "description": (
                 "Call this when the user wants to contact or email a property agent, "
-                "letting agent, landlord, or property broker. "
-                "Examples: 'email the agent', 'reach out to the letting agency', "
-                "'contact foxtons about this', 'send an enquiry to the agent'."
+                "letting agent, landlord, or property broker — or several of them at "
+                "once. Examples: 'email the agent', 'reach out to the letting agency', "
+                "'contact foxtons about this', 'send an enquiry to the agent', "
+                "'send this to a@x.com, b@y.com and c@z.com'."
             ),
             "parameters": {
                 "type": "object",
@@ -128,6 +137,39 @@ Return ONLY valid JSON: {"subject": "...", "body": "..."}
 No prose, no markdown fences — just the JSON object.
 """
 
+_EXTRACT_LISTINGS_SYSTEM = """You are LENAH, an AI property-search assistant.
+
+Extract every property listing mentioned in an estate agent's email.
+
+For each listing give:
+- "address": street or building if stated, else ""
+- "area": neighbourhood or town, else ""
+- "price": the asking price or rent as a plain number in pounds, or null
+- "period": "pcm" (per month), "pw" (per week), "sale" (purchase price) or null
+- "bedrooms": integer (0 for a studio), or null
+- "available": "YYYY-MM-DD", "now", or null
+- "notes": anything else worth knowing (furnished, parking, viewings), max 15 words
+
+Resolve partial dates ("1 March") against the date the email was received.
+Only include properties actually on offer, not the user's own requirements.
+
+Return ONLY a JSON object: {"listings": [...]} — an empty list if there are none.
+No prose, no markdown fences.
+"""
+
+_THREAD_DIGEST_SYSTEM = """You are LENAH, an AI property-search assistant.
+
+You keep a running digest of one email thread between the user (written by LENAH on their behalf) and an estate agent.
+You are given the current digest and the new messages in the thread since it was written.
+
+Return the updated digest, at most 120 words, as short plain-text lines covering:
+- what the user asked for (requirements, budget, areas, dates)
+- what the agent offered (properties, prices, availability) and asked
+- anything agreed (viewings, documents) and what is still open
+
+Keep facts that still matter, drop ones the new messages superseded. No greeting, no markdown headings.
+"""
+
 
 # ---------------------------------------------------------------------------
 # ToolCall
@@ -162,6 +204,47 @@ def _parse_json(text: str) -> tuple[str, str] | None:
     return (subject, body) if subject and body else None
 
 
+def _create(**kwargs: Any) -> Any:
+    """Every completions call goes through here so each one gets a span."""
+    with span("llm.completion", model=kwargs.get("model")) as s:
+        resp = _client.chat.completions.create(**kwargs)
+        usage = getattr(resp, "usage", None)
+        if usage is not None:
+            details = getattr(usage, "prompt_tokens_details", None)
+            cached = getattr(details, "cached_tokens", 0) or 0
+            s.set(
+                prompt_tokens=usage.prompt_tokens,
+                completion_tokens=usage.completion_tokens,
+                cached_tokens=cached,
+                cached_ratio=round(cached / usage.prompt_tokens, 3) if usage.prompt_tokens else 0.0,
+            )
+    capture_llm(kwargs, resp)
+    return resp
+
+
+# ---------------------------------------------------------------------------
+# Prompt layout
+#
+# The provider caches prompt prefixes: a request whose first tokens match a
+# recent one skips prefill for them. So every prompt is laid out
+#
+#     system prompt (+ tools) → history window → per-call context → request
+#
+# from most to least stable, and the history window moves in steps of
+# HISTORY_WINDOW_CHUNK messages instead of sliding by one each turn.
+# ---------------------------------------------------------------------------
+
+def history_window(history: list[dict], size: int) -> list[dict]:
+    """
+    The last ``size`` to ``size + HISTORY_WINDOW_CHUNK - 1`` messages,
+    starting at a chunk boundary so the slice's start only moves once every
+    HISTORY_WINDOW_CHUNK messages.
+    """
+    chunk = max(1, HISTORY_WINDOW_CHUNK)
+    start = max(0, len(history) - size) // chunk * chunk
+    return history[start:]
+
+
 def _ensure_sig(body: str) -> str:
     return ensure_signature((body or "").strip())
 
@@ -175,11 +258,23 @@ _FALLBACK_BODY = (
 )
 
 
+def _recalled_message(recalled: list[str] | None) -> list[dict]:
+    """Older snippets retrieved for this call, as one context message (or none)."""
+    if not recalled:
+        return []
+    lines = "\n".join(f"- {r}" for r in recalled)
+    return [{
+        "role": "user",
+        "content": f"Earlier in the conversation (retrieved; may be out of date):\n{lines}",
+    }]
+
+
 def _draft(
     *,
     prompt: str,
     history: list[dict],
     system: str = _EMAIL_SYSTEM,
+    recalled: list[str] | None = None,
 ) -> tuple[str, str]:
     """
     Call the model to draft an email; retry once with a stricter nudge,
@@ -189,27 +284,32 @@ def _draft(
     instructions (reply drafting, refinement) while reusing the same
     retry / parse / fallback logic.
     """
-    context_messages = history[-40:]
-
-    for extra in ("", "\n\nIMPORTANT: Your entire response must be a single JSON object."):
-        resp = _client.chat.completions.create(
-            model=OPENAI_MODEL,
-            messages=[
-                {"role": "system", "content": system},
-                *context_messages,
-                {"role": "user", "content": prompt + extra},
-            ],
-            temperature=0.2,
-        )
-        raw = (resp.choices[0].message.content or "").strip()
-        result = _parse_json(raw)
-        if result:
-            subject, body = result
-            body = _ensure_sig(body)
-            if len(body.split()) >= 20:
-                return subject, body
-
-    return _FALLBACK_SUBJECT, _FALLBACK_BODY
+    context_messages = history_window(history, DRAFT_HISTORY_WINDOW) + _recalled_message(recalled)
+
+    with span("llm.draft", history=len(context_messages)) as s:
+        for attempt, extra in enumerate(
+            ("", "\n\nIMPORTANT: Your entire response must be a single JSON object.")
+        ):
+            s.set(retries=attempt)
+            resp = _create(
+                model=OPENAI_MODEL,
+                messages=[
+                    {"role": "system", "content": system},
+                    *context_messages,
+                    {"role": "user", "content": prompt + extra},
+                ],
+                temperature=0.2,
+            )
+            raw = (resp.choices[0].message.content or "").strip()
+            result = _parse_json(raw)
+            if result:
+                subject, body = result
+                body = _ensure_sig(body)
+                if len(body.split()) >= 20:
+                    return subject, body
+
+        s.set(fallback=True)
+        return _FALLBACK_SUBJECT, _FALLBACK_BODY
 
 
 def _complete(*, system: str, messages: list[dict]) -> str:
@@ -217,7 +317,7 @@ def _complete(*, system: str, messages: list[dict]) -> str:
     Single-turn plain-text completion.
     Used for summarisation where structured JSON is not needed.
     """
-    resp = _client.chat.completions.create(
+    resp = _create(
         model=OPENAI_MODEL,
         messages=[{"role": "system", "content": system}, *messages],
         temperature=0.3,
@@ -231,14 +331,14 @@ def _complete(*, system: str, messages: list[dict]) -> str:
 
 _CLASSIFY_SYSTEM = """You are a classifier for a property-search assistant called LENAH.
 
-The user has been shown a draft email and asked to either approve it or request changes.
+The user has been shown a draft email (or several) and asked to either approve it or request changes.
 
 Classify their response as exactly one of:
   approve  — the user is happy with the draft and wants it sent as-is
   refine   — the user wants changes to the draft (tone, content, length, etc.)
 
 Rules:
-- "yes", "send it", "go ahead", "looks good", "that's fine", "ok", "sure", etc. → approve
+- "yes", "send it", "send them", "go ahead", "looks good", "that's fine", "ok", "sure", etc. → approve
 - Any instruction, correction, or preference → refine
 - If genuinely ambiguous, choose refine (safer — we'd rather ask than send wrongly)
 
@@ -255,7 +355,7 @@ def classify_draft_response(user_text: str) -> str:
         "approve" — send the draft as-is
         "refine"  — apply the user's instruction and show an updated draft
     """
-    resp = _client.chat.completions.create(
+    resp = _create(
         model=OPENAI_MODEL,
         messages=[
             {"role": "system", "content": _CLASSIFY_SYSTEM},
@@ -279,22 +379,32 @@ def chat(
     chat_history: list[dict],
     user_text: str,
     user_email: str | None,
+    listings: str | None = None,
+    recalled: list[str] | None = None,
 ) -> str | ToolCall:
     """
     Send a conversational message and return either:
       - str       → plain assistant reply
       - ToolCall  → model wants to trigger an email action
+
+    ``listings`` is a compact table of the agents' listings that match the
+    user's question, already filtered locally (see src/listings.py).
+    ``recalled`` are older messages relevant to ``user_text`` that fell out
+    of the history window (see src/recall.py).
     """
     context = f"User's email (if known): {user_email or 'unknown'}"
+    if listings:
+        context += f"\n\n{listings}"
 
     messages = [
         {"role": "system", "content": _SYSTEM},
+        *history_window(chat_history, CHAT_HISTORY_WINDOW),
+        *_recalled_message(recalled),
         {"role": "user", "content": context},
-        *chat_history[-20:],
         {"role": "user", "content": user_text},
     ]
 
-    resp = _client.chat.completions.create(
+    resp = _create(
         model=OPENAI_MODEL,
         messages=messages,
         tools=_TOOLS,
@@ -351,8 +461,17 @@ def draft_summary_email(*, chat_history: list[dict]) -> tuple[str, str]:
     return "Your property search – summary", body
 
 
-def draft_agent_email(*, chat_history: list[dict], user_request: str) -> tuple[str, str]:
-    """Draft an initial enquiry email to an estate agent."""
+def draft_agent_email(
+    *,
+    chat_history: list[dict],
+    user_request: str,
+    agent_email: str | None = None,
+    recalled: list[str] | None = None,
+) -> tuple[str, str]:
+    """
+    Draft an initial enquiry email to an estate agent. With ``agent_email``
+    the draft is personalised to that agency (bulk enquiries draft one each).
+    """
     prompt = (
         "Write a short professional email to an estate agent on behalf of the user.\n\n"
         "Include:\n"
@@ -362,7 +481,13 @@ def draft_agent_email(*, chat_history: list[dict], user_request: str) -> tuple[s
         "- Ask what documents and steps are needed to proceed\n\n"
         f"User's request: {user_request}\n"
     )
-    subject, body = _draft(prompt=prompt, history=chat_history)
+    if agent_email:
+        prompt += (
+            f"\nThis email goes to {agent_email} only. Address that agency by name if "
+            "the address or the conversation makes it clear, and mention anything "
+            "the user said about them specifically.\n"
+        )
+    subject, body = _draft(prompt=prompt, history=chat_history, recalled=recalled)
     if not subject or subject.lower() == "summary":
         subject = "Property enquiry"
     return subject, body
@@ -372,17 +497,48 @@ def draft_agent_email(*, chat_history: list[dict], user_request: str) -> tuple[s
 # Public API — inbound reply handling
 # ---------------------------------------------------------------------------
 
+def _thread_message(thread_digest: str) -> list[dict]:
+    """The thread's digest so far, as one context message (or none)."""
+    if not thread_digest:
+        return []
+    return [{"role": "user", "content": f"THE THREAD SO FAR (digest):\n{thread_digest}"}]
+
+
+def update_thread_digest(*, digest: str, new_messages: list[dict]) -> str:
+    """
+    Fold ``new_messages`` (dicts with "direction" "in"/"out", "subject",
+    "body") into a thread's digest. Only the delta is sent, so the prompt
+    stays the same size however long the thread gets.
+    """
+    delta = "\n\n".join(
+        f"{'AGENT' if m['direction'] == 'in' else 'USER (sent by LENAH)'}"
+        f"{' — ' + m['subject'] if m.get('subject') else ''}:\n{m['body']}"
+        for m in new_messages
+    )
+    with span("llm.thread_digest", messages=len(new_messages)):
+        return _complete(
+            system=_THREAD_DIGEST_SYSTEM,
+            messages=[{
+                "role": "user",
+                "content": f"CURRENT DIGEST:\n{digest or '(empty — new thread)'}\n\nNEW MESSAGES:\n{delta}",
+            }],
+        )
+
+
 def summarise_agent_reply(
     *,
     reply_body: str,
-    chat_history: list[dict],
+    thread_digest: str,
+    recalled: list[str] | None = None,
 ) -> str:
     """
     Summarise an agent's reply email in 2–4 plain sentences for the user.
-    Uses recent chat history as context so the summary is relevant.
+    The thread's digest (and any recalled chat) stands in for history, so
+    the prompt doesn't grow with the thread or the chat.
     """
     messages = [
-        *chat_history[-10:],
+        *_recalled_message(recalled),
+        *_thread_message(thread_digest),
         {
             "role": "user",
             "content": (
@@ -395,19 +551,45 @@ def summarise_agent_reply(
     return _complete(system=_SUMMARISE_REPLY_SYSTEM, messages=messages)
 
 
+def extract_listings(*, reply_body: str, received: str) -> list[dict]:
+    """
+    Pull the listings out of an agent's reply as raw dicts (see
+    _EXTRACT_LISTINGS_SYSTEM for the fields). ``received`` is the reply's
+    date, YYYY-MM-DD. Returns [] when the model's output isn't usable.
+    """
+    with span("llm.extract_listings"):
+        raw = _complete(
+            system=_EXTRACT_LISTINGS_SYSTEM,
+            messages=[{
+                "role": "user",
+                "content": f"Email received {received}.\n\nAGENT EMAIL:\n{reply_body}",
+            }],
+        )
+    m = re.search(r"\{.*\}", raw, re.DOTALL)
+    if not m:
+        return []
+    try:
+        listings = json.loads(m.group(0)).get("listings")
+    except (ValueError, AttributeError):
+        return []
+    return [x for x in listings if isinstance(x, dict)] if isinstance(listings, list) else []
+
+
 def draft_reply_to_agent(
     *,
     reply_body: str,
-    chat_history: list[dict],
+    thread_digest: str,
     user_request: str,
+    recalled: list[str] | None = None,
 ) -> tuple[str, str]:
     """
     Draft a reply to an agent's inbound email.
 
     Args:
-        reply_body:   Plain-text body of the agent's email.
-        chat_history: Conversation history for context.
-        user_request: Optional user instruction (e.g. "ask about parking").
+        reply_body:    Plain-text body of the agent's email.
+        thread_digest: Running digest of the thread (src/thread_digest.py).
+        user_request:  Optional user instruction (e.g. "ask about parking").
+        recalled:      Chat messages relevant to the reply (src/recall.py).
 
     Returns:
         (subject, body)
@@ -420,8 +602,9 @@ def draft_reply_to_agent(
     )
     subject, body = _draft(
         prompt=prompt,
-        history=chat_history,
+        history=_thread_message(thread_digest),
         system=_DRAFT_REPLY_SYSTEM,
+        recalled=recalled,
     )
     if not subject:
         subject = "Re: Property enquiry"
@@ -0,0 +1,224 @@
+"""
+Central Gmail mailbox shards.
+
+Each shard is a separate LENAH Gmail account with its own credentials and
+token, so every shard brings its own send and read quota. Users are spread
+over the shards by consistent hashing on their user id, and the result is
+stored in their state (``mailbox``) the first time it is needed. After that
+the assignment never changes by itself, so a user's threads always stay on
+the mailbox that sent them.
+
+Shards are listed in a JSON file named by LENAH_GMAIL_SHARDS:
+
+    [
+      {"name": "lenah-1", "credentials": "secrets/lenah-1.json", "token": "secrets/lenah-1-token.json"},
+      {"name": "lenah-2", "credentials": "secrets/lenah-2.json", "token": "secrets/lenah-2-token.json"}
+    ]
+
+Optional per shard: ``weight`` (relative share of new users, default 1) and
+``accept_new`` (false stops assigning new users to it). List the original
+mailbox first: users who already had threads before sharding stay on it.
+Without the setting there is one shard, "default", using
+GMAIL_CREDENTIALS_PATH / GMAIL_TOKEN_PATH.
+
+Adding a shard moves roughly 1/N of the hash ring onto it, which only
+affects users not assigned yet. To also move existing users who have no
+threads yet (nothing to strand):
+
+    python -m src.mailboxes                  # users per shard
+    python -m src.mailboxes --rebalance --dry-run
+    python -m src.mailboxes --rebalance
+"""
+from __future__ import annotations
+
+import argparse
+import bisect
+import hashlib
+import json
+import sys
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from typing import Any
+
+from src.config import CREDENTIALS_PATH, GMAIL_SCOPES, GMAIL_SHARDS_PATH, PROJECT_ROOT, TOKEN_PATH
+from src.gmail_client import GmailClient
+from src.session import _user_id, iter_user_emails, open_user_store
+
+# Points per unit of weight on the ring; enough for an even spread over a
+# handful of shards.
+_VNODES = 160
+
+
+@dataclass(frozen=True)
+class Shard:
+    name: str
+    credentials_path: Path
+    token_path: Path
+    weight: int = 1
+    accept_new: bool = True
+
+
+def _resolve(path: str) -> Path:
+    p = Path(path)
+    return p if p.is_absolute() else PROJECT_ROOT / p
+
+
+def _parse(raw: list[dict[str, Any]]) -> tuple[Shard, ...]:
+    shards: list[Shard] = []
+    for entry in raw:
+        try:
+            shards.append(Shard(
+                name=str(entry["name"]),
+                credentials_path=_resolve(entry["credentials"]),
+                token_path=_resolve(entry["token"]),
+                weight=max(1, int(entry.get("weight", 1))),
+                accept_new=bool(entry.get("accept_new", True)),
+            ))
+        except (KeyError, TypeError, ValueError) as exc:
+            raise RuntimeError(f"Bad mailbox shard entry {entry!r} in {GMAIL_SHARDS_PATH}: {exc}") from None
+    if not shards:
+        raise RuntimeError(f"{GMAIL_SHARDS_PATH} lists no mailbox shards.")
+    if len({s.name for s in shards}) != len(shards):
+        raise RuntimeError(f"{GMAIL_SHARDS_PATH} has duplicate shard names.")
+    if not any(s.accept_new for s in shards):
+        raise RuntimeError(f"Every shard in {GMAIL_SHARDS_PATH} has accept_new false.")
+    return tuple(shards)
+
+
+@lru_cache(maxsize=1)
+def load_shards() -> tuple[Shard, ...]:
+    """Configured shards, the original mailbox first."""
+    if GMAIL_SHARDS_PATH is None:
+        return (Shard("default", CREDENTIALS_PATH, TOKEN_PATH),)
+    return _parse(json.loads(GMAIL_SHARDS_PATH.read_text(encoding="utf-8")))
+
+
+def get_shard(name: str) -> Shard:
+    for shard in load_shards():
+        if shard.name == name:
+            return shard
+    raise RuntimeError(f"Unknown mailbox shard {name!r}; is it missing from {GMAIL_SHARDS_PATH}?")
+
+
+def make_client(name: str) -> GmailClient:
+    """A new GmailClient for shard ``name``; callers cache one per shard."""
+    shard = get_shard(name)
+    return GmailClient(
+        credentials_path=str(shard.credentials_path),
+        token_path=str(shard.token_path),
+        scopes=GMAIL_SCOPES,
+    )
+
+
+# ---------------------------------------------------------------------------
+# Consistent hashing
+# ---------------------------------------------------------------------------
+
+def _point(key: str) -> int:
+    return int.from_bytes(hashlib.sha256(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """Shards accepting new users, each at ``weight * _VNODES`` ring points."""
+
+    def __init__(self, shards: tuple[Shard, ...]) -> None:
+        points = sorted(
+            (_point(f"{s.name}#{i}"), s.name)
+            for s in shards if s.accept_new
+            for i in range(s.weight * _VNODES)
+        )
+        self._keys = [p for p, _ in points]
+        self._names = [n for _, n in points]
+
+    def lookup(self, user_id: str) -> str:
+        i = bisect.bisect(self._keys, _point(user_id)) % len(self._keys)
+        return self._names[i]
+
+
+@lru_cache(maxsize=1)
+def _ring() -> HashRing:
+    return HashRing(load_shards())
+
+
+def ring_shard(user_id: str) -> str:
+    """Where the ring would put ``user_id`` today."""
+    return _ring().lookup(user_id)
+
+
+# ---------------------------------------------------------------------------
+# Assignment
+# ---------------------------------------------------------------------------
+
+def ensure_mailbox(state: Any) -> str:
+    """
+    The user's mailbox shard, assigning one if the state has none yet.
+
+    Users who already have agent threads but no assignment predate sharding;
+    their threads live on the original mailbox, so that is where they stay.
+    Everyone else goes where the ring puts their store's user_id (from
+    ``owner_email``, which the user can't change). The caller persists the
+    assignment with the rest of the state.
+    """
+    name = state.get("mailbox")
+    if name:
+        return name
+    if state.get("agent_threads"):
+        name = load_shards()[0].name
+    else:
+        owner = state.get("owner_email")
+        if not owner:
+            raise ValueError("Can't assign a mailbox shard to state that wasn't loaded from a UserStore.")
+        name = ring_shard(_user_id(owner))
+    state["mailbox"] = name
+    return name
+
+
+def rebalance(dry_run: bool) -> dict[str, int]:
+    """Move users with no agent threads onto their current ring shard."""
+    stats = {"users": 0, "moved": 0, "pinned": 0}
+    for email in iter_user_emails():
+        store = open_user_store(email)
+        state = store.load()
+        stats["users"] += 1
+        target = ring_shard(store.user_id)
+        current = state.get("mailbox")
+        if current == target:
+            continue
+        if state["agent_threads"]:
+            stats["pinned"] += 1
+            continue
+        print(f"  {'WOULD MOVE' if dry_run else 'MOVED'} {store.user_id}: {current or '(unassigned)'} → {target}")
+        stats["moved"] += 1
+        if not dry_run:
+            state["mailbox"] = target
+            store.save(state)
+    return stats
+
+
+def distribution() -> dict[str, int]:
+    counts = {s.name: 0 for s in load_shards()}
+    counts["(unassigned)"] = 0
+    for email in iter_user_emails():
+        name = open_user_store(email).load().get("mailbox") or "(unassigned)"
+        counts[name] = counts.get(name, 0) + 1
+    return counts
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rebalance", action="store_true", help="move thread-less users to their ring shard")
+    parser.add_argument("--dry-run", action="store_true", help="with --rebalance: report, change nothing")
+    args = parser.parse_args(argv)
+
+    if args.rebalance:
+        stats = rebalance(args.dry_run)
+        verb = "would move" if args.dry_run else "moved"
+        print(f"\n{stats['users']} users, {stats['moved']} {verb}, {stats['pinned']} kept for their threads.\n")
+    for name, n in distribution().items():
+        print(f"{name:<20}{n:>8}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,205 @@
+from __future__ import annotations
+
+import copy
+import threading
+from datetime import datetime, timezone
+from typing import Any
+
+from bson import encode as bson_encode
+from pymongo import ASCENDING, MongoClient
+from pymongo.collection import Collection
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from src.config import MONGO_DB_NAME, MONGO_MAX_POOL_SIZE, MONGO_URI
+from src.session import _DEFAULTS, _SHARED_KEYS, _STATE_KEYS, UserStore
+from src.tracing import span
+
+# ---------------------------------------------------------------------------
+# Process-wide client
+# ---------------------------------------------------------------------------
+
+_client: MongoClient | None = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> MongoClient:
+    """
+    One pooled MongoClient per process, shared by every session.
+
+    A ``mongomock://`` URI swaps in mongomock's in-memory client so the
+    backend can be exercised without a running mongod.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                if MONGO_URI.startswith("mongomock://"):
+                    import mongomock  # noqa: PLC0415
+
+                    _client = mongomock.MongoClient()
+                else:
+                    _client = MongoClient(MONGO_URI, maxPoolSize=MONGO_MAX_POOL_SIZE)
+    return _client
+
+
+def users_collection() -> Collection:
+    return get_client()[MONGO_DB_NAME]["users"]
+
+
+_archive_indexed = False
+
+
+def archive_collection() -> Collection:
+    global _archive_indexed
+    collection = get_client()[MONGO_DB_NAME]["user_archive"]
+    if not _archive_indexed:
+        collection.create_index([("user_id", ASCENDING), ("i", ASCENDING)])
+        _archive_indexed = True
+    return collection
+
+
+# Conditional updates retried after merging a concurrent session's write.
+_MAX_SAVE_ATTEMPTS = 5
+
+
+# ---------------------------------------------------------------------------
+# Store
+# ---------------------------------------------------------------------------
+
+class MongoUserStore(UserStore):
+    """
+    Per-user state as one document in the ``users`` collection, keyed by
+    user_id — the same shape migrate_to_mongo.py writes.
+
+    ``save`` sends only what changed since the last load/save: new messages
+    via ``$push`` / ``$each`` and changed keys via ``$set``. Cold history
+    lives in ``user_archive``, one document per message.
+
+    Each update is conditional on the ``_version`` this store last saw; if
+    another session got there first, its thread/cursor maps are merged and
+    the update retried against the new version.
+    """
+
+    backend = "mongo"
+
+    def __init__(
+        self,
+        email: str,
+        collection: Collection | None = None,
+        archive: Collection | None = None,
+    ) -> None:
+        super().__init__(email)
+        self._collection = collection if collection is not None else users_collection()
+        self._archive = archive if archive is not None else archive_collection()
+
+    @property
+    def exists(self) -> bool:
+        return self._collection.count_documents({"_id": self.user_id}, limit=1) > 0
+
+    def load(self) -> dict[str, Any]:
+        with span("store.load", backend=self.backend):
+            doc = self._collection.find_one({"_id": self.user_id}) or {}
+        state = {k: doc.get(k, copy.deepcopy(_DEFAULTS[k])) for k in _STATE_KEYS}
+        with self._lock:
+            self._version = int(doc.get("_version") or 0)
+            self._disk_shared = {k: copy.deepcopy(state[k]) for k in _SHARED_KEYS}
+            self._mark_persisted(state)
+            self._mark_synced(self._version, state)
+        self._stamp_owner(state)
+        return state
+
+    def _disk_state(self) -> tuple[int, dict[str, dict]]:
+        projection = {k: 1 for k in _SHARED_KEYS}
+        projection["_version"] = 1
+        doc = self._collection.find_one({"_id": self.user_id}, projection) or {}
+        self._version = int(doc.get("_version") or 0)
+        self._disk_shared = {k: doc.get(k) or {} for k in _SHARED_KEYS}
+        return self._version, self._disk_shared
+
+    def _version_filter(self) -> dict[str, Any]:
+        # Documents written before versioning (or by the migration) have no
+        # _version field; treat them as version 0.
+        if self._version == 0:
+            return {"_id": self.user_id, "_version": {"$in": [0, None]}}
+        return {"_id": self.user_id, "_version": self._version}
+
+    def save(self, state: dict[str, Any]) -> None:
+        with span("store.save", backend=self.backend) as s:
+            delta = self._delta(state)
+            if not delta:
+                s.set(bytes=0)
+                return
+
+            now = datetime.now(timezone.utc)
+            update: dict[str, Any] = {
+                "$set": {**delta.set, "email": self.email, "last_active": now},
+                "$setOnInsert": {"created_at": now},
+                "$inc": {"_version": 1},
+            }
+            if delta.append:
+                update["$push"] = {"messages": {"$each": delta.append}}
+
+            with self._lock:
+                size = 0
+                for attempt in range(_MAX_SAVE_ATTEMPTS):
+                    merged = self._merge_shared(state, self._disk_shared)
+                    for k in _SHARED_KEYS:
+                        if merged[k] != self._disk_shared.get(k):
+                            update["$set"][k] = merged[k]
+                        else:
+                            update["$set"].pop(k, None)
+                    size += len(bson_encode(update))
+                    try:
+                        result = self._collection.update_one(self._version_filter(), update, upsert=True)
+                    except DuplicateKeyError:
+                        result = None  # the document exists at another version
+                    if result is not None and (result.matched_count or result.upserted_id is not None):
+                        break
+                    self._disk_state()
+                else:
+                    raise RuntimeError(
+                        f"Could not save user {self.user_id}: concurrent updates kept winning."
+                    )
+                self._version += 1
+                self._disk_shared = merged
+                self._mark_persisted(state)
+                conflict = self._mark_written(state, merged)
+            self.bytes_written += size
+            s.set(bytes=size, appended=len(delta.append), keys=len(delta.set),
+                  attempts=attempt + 1, merged=conflict)
+
+    def delete(self) -> None:
+        self._collection.delete_one({"_id": self.user_id})
+        self.clear_archive()
+
+    # ------------------------------------------------------------------
+    # Cold archive
+    # ------------------------------------------------------------------
+
+    def _archive_append(self, start: int, messages: list[dict]) -> None:
+        # Keyed by (user, index): a spill repeated after an interrupted save
+        # hits duplicate keys for messages already archived, which is fine.
+        docs = [
+            {"_id": f"{self.user_id}:{start + n}", "user_id": self.user_id, "i": start + n, "m": m}
+            for n, m in enumerate(messages)
+        ]
+        if not docs:
+            return
+        try:
+            self._archive.insert_many(docs, ordered=False)
+        except BulkWriteError as exc:
+            if any(e.get("code") != 11000 for e in exc.details.get("writeErrors", [])):
+                raise
+        self.bytes_written += sum(len(bson_encode(d)) for d in docs)
+
+    def load_archive(self, start: int, end: int) -> list[dict]:
+        if end <= start:
+            return []
+        cursor = self._archive.find(
+            {"user_id": self.user_id, "i": {"$gte": start, "$lt": end}},
+            {"m": 1, "_id": 0},
+        ).sort("i", ASCENDING)
+        return [row["m"] for row in cursor]
+
+    def clear_archive(self) -> None:
+        self._archive.delete_many({"user_id": self.user_id})
@@ -0,0 +1,217 @@
+"""
+Adaptive per-thread polling schedule for the reply poller.
+
+Every (user, agent) thread gets its own interval instead of all threads
+being checked every cycle:
+
+- recently active threads are re-checked quickly: the interval never
+  exceeds a fraction of the time since the thread's last message;
+- each empty check doubles the interval (exponential backoff), up to
+  LENAH_POLL_MAX_INTERVAL_S; a reply or an outbound send resets it;
+- all users' threads share one priority queue ordered by due time, drained
+  through a global token bucket (LENAH_POLL_QUOTA_PER_MIN) so a burst of
+  due threads can never exceed the Gmail quota — the overflow simply waits.
+
+The last-activity time per thread lives in the user's ``agent_activity``
+state, so a restarted poller picks up where it left off.
+"""
+from __future__ import annotations
+
+import heapq
+import itertools
+import math
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any
+
+from src.utils import now as clock_now
+
+# Never wait longer than this fraction of a thread's silence before the
+# next check: replied 5 min ago -> ~30 s, silent 3 weeks -> capped at max.
+_AGE_FACTOR = 0.1
+
+_HISTOGRAM_BOUNDS = (60, 300, 900, 3600, 4 * 3600, 24 * 3600)
+_HISTOGRAM_LABELS = ("≤1m", "≤5m", "≤15m", "≤1h", "≤4h", "≤1d", ">1d")
+
+
+def note_activity(state: Any, agent_email: str, when: float | None = None, *, reply: bool = False) -> None:
+    """Record a message on ``agent_email``'s thread (a send, or a reply if ``reply``)."""
+    activity = state["agent_activity"]
+    entry = dict(activity.get(agent_email) or {"last": 0.0, "replies": 0})
+    entry["last"] = max(entry["last"], when or clock_now())
+    if reply:
+        entry["replies"] += 1
+    activity[agent_email] = entry
+
+
+class TokenBucket:
+    """``rate`` tokens per second, holding at most ``burst``."""
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._stamp = time.monotonic()
+
+    def take(self) -> bool:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+
+@dataclass
+class _Thread:
+    user_email: str
+    agent_email: str
+    thread_id: str
+    last_activity: float
+    misses: int = 0
+    interval: float = 0.0
+    due: float = 0.0
+    token: int = field(default=0)  # bumped on reschedule; stale heap rows are skipped
+
+
+class PollSchedule:
+    def __init__(self, min_interval: float, max_interval: float, quota_per_min: float) -> None:
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.bucket = TokenBucket(quota_per_min / 60, burst=max(1.0, quota_per_min / 6))
+        self._threads: dict[tuple[str, str], _Thread] = {}
+        self._heap: list[tuple[float, int, int, tuple[str, str]]] = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self.polls = 0
+        self.deferred = 0
+        self._chosen: list[int] = [0] * len(_HISTOGRAM_LABELS)
+
+    # ------------------------------------------------------------------
+    # Interval policy
+    # ------------------------------------------------------------------
+
+    def interval_for(self, t: _Thread, now: float) -> float:
+        backoff = self.min_interval * 2 ** t.misses
+        if t.last_activity:
+            backoff = min(backoff, max(self.min_interval, (now - t.last_activity) * _AGE_FACTOR))
+        return min(self.max_interval, max(self.min_interval, backoff))
+
+    def _push(self, t: _Thread) -> None:
+        t.token += 1
+        heapq.heappush(self._heap, (t.due, next(self._seq), t.token, (t.user_email, t.agent_email)))
+
+    # ------------------------------------------------------------------
+    # Keeping the schedule in line with user state
+    # ------------------------------------------------------------------
+
+    def sync_user(self, user_email: str, state: dict[str, Any], now: float | None = None) -> None:
+        """Add, update or drop this user's threads from their current state."""
+        now = now or time.time()
+        activity = state.get("agent_activity") or {}
+        threads = state.get("agent_threads") or {}
+        with self._lock:
+            for key in [k for k in self._threads if k[0] == user_email and k[1] not in threads]:
+                del self._threads[key]
+            for agent_email, thread_id in threads.items():
+                last = float((activity.get(agent_email) or {}).get("last") or 0)
+                key = (user_email, agent_email)
+                t = self._threads.get(key)
+                if t is None:
+                    t = _Thread(user_email, agent_email, thread_id, last)
+                    # Start a long-silent thread at its backed-off interval
+                    # rather than polling it right away.
+                    if last:
+                        silence = max(now - last, self.min_interval)
+                        t.misses = max(0, int(math.log2(silence * _AGE_FACTOR / self.min_interval)))
+                    t.interval = self.interval_for(t, now)
+                    t.due = now if not last else min(now + t.interval, last + t.interval)
+                    self._threads[key] = t
+                    self._push(t)
+                    continue
+                t.thread_id = thread_id
+                if last > t.last_activity:
+                    # Activity we didn't see ourselves (e.g. the user sent a
+                    # follow-up): check again soon.
+                    t.last_activity, t.misses = last, 0
+                    t.interval = self.interval_for(t, now)
+                    if now + t.interval < t.due:
+                        t.due = now + t.interval
+                        self._push(t)
+
+    def record(self, user_email: str, agent_email: str, *, replied: bool, activity: float | None = None) -> None:
+        """Reschedule a thread after polling it."""
+        now = time.time()
+        with self._lock:
+            t = self._threads.get((user_email, agent_email))
+            if t is None:
+                return
+            if replied:
+                t.misses = 0
+                t.last_activity = max(t.last_activity, activity or now)
+            else:
+                t.misses += 1
+            t.interval = self.interval_for(t, now)
+            t.due = now + t.interval
+            self._chosen[_bucket(t.interval)] += 1
+            self._push(t)
+
+    # ------------------------------------------------------------------
+    # Draining
+    # ------------------------------------------------------------------
+
+    def due(self, now: float | None = None) -> list[_Thread]:
+        """
+        Threads due for a check, earliest first, as far as the quota allows.
+        Threads left over stay queued and come first next time.
+        """
+        now = now or time.time()
+        ready: list[_Thread] = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                _due, _seq, token, key = self._heap[0]
+                t = self._threads.get(key)
+                if t is None or t.token != token:
+                    heapq.heappop(self._heap)
+                    continue
+                if not self.bucket.take():
+                    self.deferred += sum(1 for row in self._heap if row[0] <= now)
+                    break
+                heapq.heappop(self._heap)
+                ready.append(t)
+            self.polls += len(ready)
+        return ready
+
+    # ------------------------------------------------------------------
+    # Reporting
+    # ------------------------------------------------------------------
+
+    def histogram(self) -> dict[str, dict[str, int]]:
+        """Current interval per thread, and every interval chosen so far, by bucket."""
+        with self._lock:
+            current = [0] * len(_HISTOGRAM_LABELS)
+            for t in self._threads.values():
+                current[_bucket(t.interval)] += 1
+            return {
+                "current": dict(zip(_HISTOGRAM_LABELS, current)),
+                "chosen": dict(zip(_HISTOGRAM_LABELS, self._chosen)),
+            }
+
+    def report(self) -> str:
+        hist = self.histogram()
+        lines = [
+            f"threads {len(self._threads)}  polls {self.polls}  deferred by quota {self.deferred}",
+            f"{'interval':<10}{'threads now':>12}{'polls':>8}",
+        ]
+        for label in _HISTOGRAM_LABELS:
+            lines.append(f"{label:<10}{hist['current'][label]:>12}{hist['chosen'][label]:>8}")
+        return "\n".join(lines)
+
+
+def _bucket(interval: float) -> int:
+    for i, bound in enumerate(_HISTOGRAM_BOUNDS):
+        if interval <= bound:
+            return i
+    return len(_HISTOGRAM_BOUNDS)
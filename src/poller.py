@@ -0,0 +1,399 @@
+"""
+Background reply poller.
+
+Checks users' agent threads for new replies and pre-computes the summary
+and suggested reply for each, queuing them in the user's ``ready_replies``
+state. The listings in each reply are extracted into the user's
+``listings`` state at the same time (src/listings.py). The "Check for new
+replies" button and page load then only surface what is already queued.
+
+The poller wakes every LENAH_POLL_INTERVAL_S seconds. With LENAH_POLL_MODE
+"inbox" (the default) it reads each central mailbox's history once and
+routes each new message to its owner through src/thread_index.py. With "threads"
+it checks threads individually instead: src/poll_schedule.py gives each
+thread its own interval from its recent activity and keeps the total under
+the Gmail quota.
+
+Runs as a thread inside the Streamlit server (LENAH_POLL_INTERVAL_S > 0 and
+LENAH_POLLER_IN_APP) or as its own process:
+
+    python -m src.poller --interval 120
+    python -m src.poller --once
+    python -m src.poller --mode threads --report 3600   # print the interval histogram hourly
+"""
+from __future__ import annotations
+
+import argparse
+import sys
+import threading
+import time
+from functools import lru_cache
+from typing import Any, Callable, Iterable
+
+from src.attachments import with_attachments
+from src.config import (
+    POLL_DISCOVER_S,
+    POLL_INTERVAL_S,
+    POLL_MAX_INTERVAL_S,
+    POLL_MODE,
+    POLL_QUOTA_PER_MIN,
+)
+from src.gmail_client import GmailClient, HistoryExpired
+from src.listings import add_listings, normalise_listing
+from src.llm import draft_reply_to_agent, extract_listings, summarise_agent_reply
+from src.mailboxes import ensure_mailbox, load_shards, make_client
+from src.poll_schedule import PollSchedule, note_activity
+from src.recall import recall, remember
+from src.search import index_email
+from src.session import _user_id, iter_user_emails, open_user_store
+from src.thread_digest import note_inbound, refresh
+from src.thread_index import get_index
+from src.tracing import span
+from src.utils import now
+
+
+def history_cursor_key(mailbox: str) -> str:
+    """Thread-index meta key of the last historyId synced for ``mailbox``."""
+    return f"history_id:{mailbox}"
+
+
+def _store_listings(state: dict[str, Any], reply: dict[str, Any], agent_email: str, thread_id: str) -> int:
+    """
+    Extract the listings in ``reply`` into the user's ``listings`` state.
+    Returns how many; a failed extraction just stores none, since the
+    summary and draft stand on their own.
+    """
+    received = reply.get("date") or now()
+    day = time.strftime("%Y-%m-%d", time.gmtime(received))
+    try:
+        with span("poller.listings"):
+            raw = extract_listings(reply_body=reply["body"], received=day)
+    except Exception:  # noqa: BLE001
+        return 0
+    records = [
+        normalise_listing(r, agent_email=agent_email, thread_id=thread_id, received=received) for r in raw
+    ]
+    return add_listings(state, reply["id"], records)
+
+
+def poll_user(
+    state: dict[str, Any],
+    client: GmailClient,
+    agents: Iterable[str] | None = None,
+) -> tuple[list[str], list[tuple[str, str]]]:
+    """
+    Fetch new replies on the agent threads in ``state`` (all of them, or
+    just ``agents``) and queue them in ``state["ready_replies"]``, keyed by
+    reply message id. Listings in those replies are added to
+    ``state["listings"]``.
+
+    Only the latest reply per thread is processed. The thread's cursor is
+    advanced *before* LLM processing so a processing failure never causes
+    the same message to be queued twice; the failure is queued instead.
+
+    Returns ([agent_email that replied, ...], [(agent_email, fetch error), ...]).
+    """
+    replied: list[str] = []
+    errors: list[tuple[str, str]] = []
+    ready: dict[str, dict] = state.setdefault("ready_replies", {})
+    cursors: dict[str, str] = state["agent_last_message_id"]
+    state.setdefault("agent_activity", {})
+    state.setdefault("agent_digests", {})
+    threads = state["agent_threads"]
+    wanted = list(threads) if agents is None else [a for a in agents if a in threads]
+
+    for agent_email in wanted:
+        thread_id = threads[agent_email]
+        try:
+            replies = client.get_new_replies(thread_id=thread_id, after_message_id=cursors.get(agent_email))
+        except Exception as exc:  # noqa: BLE001
+            errors.append((agent_email, str(exc)))
+            continue
+        if not replies:
+            continue
+        # Only the latest reply is processed, so only its attachments are read.
+        replies[-1] = with_attachments(client, state.get("mailbox") or "default", replies[-1])
+
+        # Every reply is searchable in full, even the ones not surfaced.
+        for reply in replies:
+            index_email(
+                state.get("owner_email"), inbound=True, agent_email=agent_email,
+                subject=reply.get("subject") or "", body=reply["body"],
+                message_id=reply["id"], ts=reply.get("date"),
+            )
+            remember(state.get("owner_email"), agent_email, reply["body"])
+            note_inbound(state, agent_email, reply)
+
+        latest = replies[-1]
+        cursors[agent_email] = latest["id"]
+        note_activity(state, agent_email, latest.get("date"), reply=True)
+        item: dict[str, Any] = {
+            "agent_email": agent_email,
+            "thread_id": thread_id,
+            "from": latest["from"],
+            "queued_at": now(),
+        }
+        try:
+            # The digest already covers this reply; it stands in for history.
+            digest = refresh(state, agent_email)
+            recalled = recall(state.get("owner_email"), latest["body"], recent=[])
+            item["summary"] = summarise_agent_reply(
+                reply_body=latest["body"],
+                thread_digest=digest,
+                recalled=recalled,
+            )
+            item["draft_subject"], item["draft_body"] = draft_reply_to_agent(
+                reply_body=latest["body"],
+                thread_digest=digest,
+                user_request="",
+                recalled=recalled,
+            )
+        except Exception as exc:  # noqa: BLE001
+            item["error"] = str(exc)
+        else:
+            item["listings"] = _store_listings(state, latest, agent_email, thread_id)
+        ready[latest["id"]] = item
+        replied.append(agent_email)
+
+    return replied, errors
+
+
+class ReplyPoller:
+    """
+    Wakes every ``interval`` seconds on a daemon thread.
+
+    ``client_factory`` returns the (cached) client for a mailbox shard name.
+    In ``inbox`` mode each cycle syncs every mailbox's history and fetches
+    only the threads that received mail. In ``threads`` mode it
+    checks the threads the schedule says are due, (re)discovering users and
+    their threads every ``discover`` seconds.
+    """
+
+    def __init__(
+        self,
+        client_factory: Callable[[str], GmailClient],
+        interval: float,
+        *,
+        max_interval: float = POLL_MAX_INTERVAL_S,
+        quota_per_min: float = POLL_QUOTA_PER_MIN,
+        discover: float = POLL_DISCOVER_S,
+        mode: str = POLL_MODE,
+    ) -> None:
+        self._client_factory = client_factory
+        self.interval = interval
+        self.mode = mode
+        self.discover = discover
+        self.schedule = PollSchedule(interval, max_interval, quota_per_min)
+        self.last_run: float | None = None
+        self._last_discover = 0.0
+        # One sync per mailbox at a time: push notifications (src/push.py)
+        # and the regular cycle may ask for the same one together.
+        self._mailbox_locks: dict[str, threading.Lock] = {}
+        self._locks_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def discover_users(self) -> int:
+        """Sync every user's threads into the schedule. Returns the number of users with threads."""
+        users = 0
+        for email in iter_user_emails():
+            state = open_user_store(email).load()
+            if state["agent_threads"] or state.get("agent_activity"):
+                self.schedule.sync_user(email, state)
+                users += bool(state["agent_threads"])
+        self._last_discover = time.time()
+        return users
+
+    def _poll_user_threads(
+        self, email: str, agents: list[str], stats: dict[str, int], mailbox: str | None = None
+    ) -> tuple[list[str], dict[str, Any]]:
+        """
+        Poll ``agents``' threads for one user through their mailbox and save.
+        With ``mailbox``, users assigned elsewhere are skipped. Returns
+        (replied, agent_activity).
+        """
+        try:
+            store = open_user_store(email)
+            if not store.exists:
+                # Nothing saved under this address (a stale index entry):
+                # don't leave an empty state file behind for it.
+                return [], {}
+            state = store.load()
+            assigned = state.get("mailbox")
+            name = ensure_mailbox(state)
+            if mailbox is not None and name != mailbox:
+                return [], {}
+            client = self._client_factory(name)
+            # Pick up threads and sends since the last discovery.
+            self.schedule.sync_user(email, state)
+            stats["users"] += 1
+            stats["threads"] += len(agents)
+            with span("poller.user", threads=len(agents)):
+                replied, errors = poll_user(state, client, agents)
+            for agent_email, error in errors:
+                print(f"LENAH poller: couldn't check {agent_email} for user {store.user_id}: {error}")
+            stats["queued"] += len(replied)
+            stats["errors"] += len(errors)
+            # Cursors and ready_replies are merged with whatever the
+            # user's own sessions wrote meanwhile (see UserStore.save).
+            if replied or assigned is None:
+                store.save(state)
+            return replied, state["agent_activity"]
+        except Exception as exc:  # noqa: BLE001
+            print(f"LENAH poller: couldn't poll user {_user_id(email)}: {exc}")
+            stats["errors"] += 1
+            return [], {}
+
+    def _poll_due(self, stats: dict[str, int]) -> None:
+        """Per-thread mode: check whichever threads the schedule says are due."""
+        if time.time() - self._last_discover >= self.discover:
+            self.discover_users()
+
+        by_user: dict[str, list[str]] = {}
+        for t in self.schedule.due():
+            by_user.setdefault(t.user_email, []).append(t.agent_email)
+
+        for email, agents in by_user.items():
+            replied, activity = self._poll_user_threads(email, agents, stats)
+            # Due threads left the queue; put every one back.
+            for agent_email in agents:
+                self.schedule.record(
+                    email,
+                    agent_email,
+                    replied=agent_email in replied,
+                    activity=(activity.get(agent_email) or {}).get("last"),
+                )
+
+    def _poll_everything(self, mailbox: str, stats: dict[str, int]) -> None:
+        """Check every thread of every user on ``mailbox`` once, registering them in the index."""
+        index = get_index()
+        for email in iter_user_emails():
+            state = open_user_store(email).load()
+            threads = state["agent_threads"]
+            if not threads or ensure_mailbox(state) != mailbox:
+                continue
+            index.register_many([(mailbox, tid, email, agent) for agent, tid in threads.items() if tid])
+            self._poll_user_threads(email, list(threads), stats, mailbox)
+
+    def _sync_inbox(self, stats: dict[str, int]) -> None:
+        """Inbox mode: sync each mailbox shard in turn; one failing doesn't stop the rest."""
+        for shard in load_shards():
+            try:
+                self._sync_mailbox(shard.name, stats)
+            except Exception as exc:  # noqa: BLE001
+                print(f"LENAH poller: couldn't sync mailbox {shard.name}: {exc}")
+                stats["errors"] += 1
+
+    def _sync_mailbox(self, mailbox: str, stats: dict[str, int]) -> None:
+        """
+        One history.list call for the whole mailbox, each new message routed
+        to its owner through the thread index, and only those threads
+        fetched.
+
+        With no cursor yet (first run) or one Gmail has expired, every thread
+        on the mailbox is polled once from a fresh historyId.
+        """
+        with self._locks_lock:
+            lock = self._mailbox_locks.setdefault(mailbox, threading.Lock())
+        with lock:
+            self._sync_mailbox_locked(mailbox, stats)
+
+    def _sync_mailbox_locked(self, mailbox: str, stats: dict[str, int]) -> None:
+        index = get_index()
+        client = self._client_factory(mailbox)
+        key = history_cursor_key(mailbox)
+        cursor = index.get_meta(key)
+        try:
+            if cursor is None:
+                raise HistoryExpired("none")
+            added, latest = client.list_history(cursor)
+        except HistoryExpired:
+            latest = client.get_history_id()
+            stats["full_sync"] = stats.get("full_sync", 0) + 1
+            self._poll_everything(mailbox, stats)
+            index.set_meta(key, latest)
+            return
+
+        owners = index.lookup_many(mailbox, sorted({m["threadId"] for m in added if m.get("threadId")}))
+        by_user: dict[str, set[str]] = {}
+        for msg in added:
+            owner = owners.get(msg.get("threadId"))
+            if owner is None:
+                stats["unrouted"] += 1
+                continue
+            by_user.setdefault(owner.user_email, set()).add(owner.agent_email)
+        stats["inbound"] += len(added)
+
+        for email, agents in by_user.items():
+            # poll_user skips agents no longer in the user's agent_threads.
+            self._poll_user_threads(email, sorted(agents), stats, mailbox)
+        # Advance only once everything is queued: a crash re-routes the same
+        # messages, and the per-thread cursors stop them queuing twice.
+        index.set_meta(key, latest)
+
+    def sync_mailbox(self, mailbox: str) -> dict[str, int]:
+        """Sync one mailbox now, as inbox mode would; push notifications call this."""
+        stats = {"users": 0, "threads": 0, "queued": 0, "errors": 0, "inbound": 0, "unrouted": 0}
+        with span("poller.sync", mailbox=mailbox) as s:
+            self._sync_mailbox(mailbox, stats)
+            s.set(**stats)
+        return stats
+
+    def poll_once(self) -> dict[str, int]:
+        stats = {"users": 0, "threads": 0, "queued": 0, "errors": 0}
+        with span("poller.cycle", mode=self.mode) as s:
+            if self.mode == "inbox":
+                stats.update(inbound=0, unrouted=0)
+                self._sync_inbox(stats)
+                s.set(**stats)
+            else:
+                self._poll_due(stats)
+                hist = self.schedule.histogram()["current"]
+                s.set(**stats, deferred=self.schedule.deferred, intervals=hist)
+        self.last_run = time.time()
+        return stats
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="lenah-poller", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _run(self, report_every: float = 0) -> None:
+        last_report = time.time()
+        while not self._stop.is_set():
+            try:
+                self.poll_once()
+            except Exception as exc:  # noqa: BLE001
+                print(f"LENAH poller: cycle failed: {exc}")
+            if report_every and self.mode == "threads" and time.time() - last_report >= report_every:
+                print(self.schedule.report())
+                last_report = time.time()
+            self._stop.wait(self.interval)
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--interval", type=float, default=POLL_INTERVAL_S or 120, help="seconds between cycles")
+    parser.add_argument("--once", action="store_true", help="run a single cycle and exit")
+    parser.add_argument("--mode", choices=("inbox", "threads"), default=POLL_MODE, help="see LENAH_POLL_MODE")
+    parser.add_argument("--report", type=float, default=0, help="print the interval histogram every N seconds")
+    args = parser.parse_args(argv)
+
+    poller = ReplyPoller(lru_cache(maxsize=None)(make_client), args.interval, mode=args.mode)
+    if args.once:
+        print(poller.poll_once())
+        if poller.mode == "threads":
+            print(poller.schedule.report())
+        return 0
+    try:
+        poller._run(args.report)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
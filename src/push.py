@@ -0,0 +1,385 @@
+"""
+Push notifications for agent replies (Gmail ``users.watch``).
+
+Inbox-mode polling (src/poller.py) asks Gmail for each mailbox's history
+every cycle whether or not anything arrived, and notices a reply only at
+the next cycle. With push, Gmail says when something arrived:
+
+- ``users.watch`` makes each central mailbox publish its inbox changes to a
+  Cloud Pub/Sub topic (LENAH_PUSH_TOPIC), and a push subscription posts each
+  notification to this receiver.
+- A notification names the mailbox and its new ``historyId``. The receiver
+  acknowledges it at once and queues a sync of that mailbox, the same
+  history.list → thread index → poll_user path the poller uses. Notifications
+  arriving during a sync are coalesced into one more sync, and ones at or
+  below the mailbox's synced cursor are dropped.
+- Watches last seven days. They are renewed once within
+  LENAH_PUSH_RENEW_BEFORE_S of expiring.
+- As a fallback, every mailbox is still synced every
+  LENAH_PUSH_FALLBACK_INTERVAL_S, which catches anything a lost
+  notification would have announced.
+
+    python -m src.push                        # receiver + watch renewal + fallback sync
+    python -m src.push --renew                # (re)start every mailbox's watch and exit
+    python -m src.push --simulate --address lenah@example.com --history-id 12345
+
+``--simulate`` posts the same envelope Pub/Sub would, so the whole path can
+run offline; the bench Gmail fake calls :func:`simulate` for each injected
+reply while a watch is active.
+"""
+from __future__ import annotations
+
+import argparse
+import base64
+import binascii
+import json
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from collections import Counter
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable
+from urllib.parse import parse_qs, urlsplit
+
+from src.config import (
+    PUSH_FALLBACK_INTERVAL_S,
+    PUSH_HOST,
+    PUSH_PORT,
+    PUSH_RENEW_BEFORE_S,
+    PUSH_TOKEN,
+    PUSH_TOPIC,
+)
+from src.gmail_client import GmailClient
+from src.mailboxes import load_shards, make_client
+from src.poller import ReplyPoller, history_cursor_key
+from src.thread_index import get_index
+from src.tracing import span
+
+PUSH_PATH = "/gmail/push"
+
+# How often watch expiry is checked; renewal itself happens a day early.
+_RENEW_CHECK_S = 3600.0
+
+
+# ---------------------------------------------------------------------------
+# Watches
+# ---------------------------------------------------------------------------
+
+def _watch_key(mailbox: str) -> str:
+    return f"watch:{mailbox}"
+
+
+def watch_info(mailbox: str) -> dict | None:
+    """{"address", "expiration" (epoch ms), "topic"} of the mailbox's watch, if any."""
+    raw = get_index().get_meta(_watch_key(mailbox))
+    return json.loads(raw) if raw else None
+
+
+def renew_watches(
+    client_factory: Callable[[str], GmailClient],
+    topic: str = PUSH_TOPIC,
+    *,
+    force: bool = False,
+) -> list[str]:
+    """
+    Start a watch on every mailbox without one, or whose watch expires within
+    LENAH_PUSH_RENEW_BEFORE_S (any, with ``force``). Returns the mailboxes
+    watched. Without a topic there is nothing to watch with.
+    """
+    if not topic:
+        return []
+    renewed: list[str] = []
+    deadline_ms = (time.time() + PUSH_RENEW_BEFORE_S) * 1000
+    for shard in load_shards():
+        info = watch_info(shard.name)
+        if not force and info and info.get("topic") == topic and info["expiration"] > deadline_ms:
+            continue
+        try:
+            client = client_factory(shard.name)
+            with span("push.watch", mailbox=shard.name):
+                resp = client.watch(topic)
+                address = info["address"] if info else client.get_profile()["emailAddress"]
+        except Exception as exc:  # noqa: BLE001
+            print(f"LENAH push: couldn't watch mailbox {shard.name}: {exc}")
+            continue
+        get_index().set_meta(_watch_key(shard.name), json.dumps({
+            "address": address.strip().lower(),
+            "expiration": int(resp["expiration"]),
+            "topic": topic,
+        }))
+        renewed.append(shard.name)
+    return renewed
+
+
+def mailbox_for(address: str) -> str | None:
+    """The shard whose watch reported ``address``; with one shard, always it."""
+    address = address.strip().lower()
+    shards = load_shards()
+    for shard in shards:
+        info = watch_info(shard.name)
+        if info and info.get("address") == address:
+            return shard.name
+    return shards[0].name if len(shards) == 1 else None
+
+
+# ---------------------------------------------------------------------------
+# Notification payloads
+# ---------------------------------------------------------------------------
+
+def envelope(address: str, history_id: int) -> dict:
+    """A Pub/Sub push request body, as Gmail's notifications arrive."""
+    data = json.dumps({"emailAddress": address, "historyId": history_id}).encode("utf-8")
+    return {
+        "message": {
+            "data": base64.b64encode(data).decode("ascii"),
+            "messageId": uuid.uuid4().hex,
+            "publishTime": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        },
+        "subscription": "projects/lenah-local/subscriptions/gmail-push",
+    }
+
+
+def parse_notification(body: bytes) -> tuple[str, int]:
+    """(emailAddress, historyId) from a push request body; ValueError if malformed."""
+    try:
+        message = json.loads(body)["message"]
+        data = json.loads(base64.b64decode(message["data"], validate=True))
+        return str(data["emailAddress"]), int(data["historyId"])
+    except (KeyError, TypeError, ValueError, binascii.Error) as exc:
+        raise ValueError(f"not a Gmail push notification: {exc}") from None
+
+
+def simulate(address: str, history_id: int, *, url: str | None = None, token: str = PUSH_TOKEN) -> int:
+    """Post a notification to a receiver as Pub/Sub would. Returns the HTTP status."""
+    url = url or f"http://{PUSH_HOST}:{PUSH_PORT}{PUSH_PATH}"
+    if token:
+        url += f"?token={token}"
+    request = urllib.request.Request(
+        url,
+        data=json.dumps(envelope(address, history_id)).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+        method="POST",
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=10) as resp:
+            return resp.status
+    except urllib.error.HTTPError as exc:
+        return exc.code
+
+
+# ---------------------------------------------------------------------------
+# Receiver
+# ---------------------------------------------------------------------------
+
+class PushReceiver:
+    """
+    HTTP endpoint for push notifications plus the threads behind it: one
+    syncing notified mailboxes, one renewing watches and queueing the
+    fallback sync.
+    """
+
+    def __init__(
+        self,
+        client_factory: Callable[[str], GmailClient],
+        *,
+        topic: str = PUSH_TOPIC,
+        token: str = PUSH_TOKEN,
+        fallback_interval: float = PUSH_FALLBACK_INTERVAL_S,
+    ) -> None:
+        self.client_factory = client_factory
+        self.topic = topic
+        self.token = token
+        self.fallback_interval = fallback_interval
+        self.poller = ReplyPoller(client_factory, fallback_interval, mode="inbox")
+        # received / queued / stale / unknown notifications, syncs, replies queued
+        self.stats: Counter = Counter()
+        self._cond = threading.Condition()
+        self._dirty: dict[str, None] = {}  # mailboxes waiting for a sync, oldest first
+        self._syncing = 0
+        self._stop = threading.Event()
+        self._server: ThreadingHTTPServer | None = None
+
+    # -- notifications ------------------------------------------------------
+
+    def notify(self, address: str, history_id: int) -> str:
+        """Handle one notification: "queued", "stale" (already synced) or "unknown" mailbox."""
+        self.stats["received"] += 1
+        mailbox = mailbox_for(address)
+        if mailbox is None:
+            outcome = "unknown"
+            print(f"LENAH push: notification for unknown mailbox {address}")
+        else:
+            cursor = get_index().get_meta(history_cursor_key(mailbox))
+            outcome = "stale" if cursor is not None and history_id <= int(cursor) else "queued"
+            if outcome == "queued":
+                self._queue(mailbox)
+        self.stats[outcome] += 1
+        return outcome
+
+    def _queue(self, mailbox: str) -> None:
+        with self._cond:
+            self._dirty[mailbox] = None
+            self._cond.notify_all()
+
+    def _sync_loop(self) -> None:
+        while True:
+            with self._cond:
+                while not self._dirty and not self._stop.is_set():
+                    self._cond.wait()
+                if self._stop.is_set():
+                    return
+                mailbox = next(iter(self._dirty))
+                del self._dirty[mailbox]
+                self._syncing += 1
+            try:
+                stats = self.poller.sync_mailbox(mailbox)
+                self.stats["syncs"] += 1
+                self.stats["replies"] += stats["queued"]
+            except Exception as exc:  # noqa: BLE001
+                print(f"LENAH push: couldn't sync mailbox {mailbox}: {exc}")
+            finally:
+                with self._cond:
+                    self._syncing -= 1
+                    self._cond.notify_all()
+
+    def wait_idle(self, timeout: float = 10.0) -> bool:
+        """Block until every queued sync has finished. False on timeout."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._dirty or self._syncing:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    # -- watches and fallback -----------------------------------------------
+
+    def _maintain_loop(self) -> None:
+        next_fallback = time.monotonic() + self.fallback_interval
+        while not self._stop.wait(min(_RENEW_CHECK_S, max(0.0, next_fallback - time.monotonic()))):
+            renew_watches(self.client_factory, self.topic)
+            if time.monotonic() >= next_fallback:
+                self.stats["fallback_syncs"] += 1
+                for shard in load_shards():
+                    self._queue(shard.name)
+                next_fallback = time.monotonic() + self.fallback_interval
+
+    # -- HTTP ---------------------------------------------------------------
+
+    def _handler(self) -> type[BaseHTTPRequestHandler]:
+        receiver = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            def do_POST(self) -> None:  # noqa: N802
+                url = urlsplit(self.path)
+                if url.path != PUSH_PATH:
+                    self.send_error(404)
+                    return
+                if receiver.token and parse_qs(url.query).get("token", [""])[0] != receiver.token:
+                    self.send_error(403)
+                    return
+                try:
+                    address, history_id = parse_notification(
+                        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                    )
+                except ValueError as exc:
+                    self.send_error(400, str(exc))
+                    return
+                with span("push.notification"):
+                    receiver.notify(address, history_id)
+                # Pub/Sub redelivers anything not acknowledged with a 2xx, so
+                # unknown mailboxes are acknowledged too (and logged).
+                self.send_response(204)
+                self.end_headers()
+
+            def do_GET(self) -> None:  # noqa: N802
+                if urlsplit(self.path).path != "/healthz":
+                    self.send_error(404)
+                    return
+                body = json.dumps({
+                    "stats": dict(receiver.stats),
+                    "watches": {s.name: watch_info(s.name) for s in load_shards()},
+                }).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args: Any) -> None:
+                pass
+
+        return _Handler
+
+    def start(self, host: str = PUSH_HOST, port: int = PUSH_PORT) -> tuple[str, int]:
+        """Watch, serve and sync in the background. Returns the bound (host, port)."""
+        renew_watches(self.client_factory, self.topic)
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        for target, name in (
+            (self._server.serve_forever, "lenah-push-http"),
+            (self._sync_loop, "lenah-push-sync"),
+            (self._maintain_loop, "lenah-push-watch"),
+        ):
+            threading.Thread(target=target, name=name, daemon=True).start()
+        # Catch up on whatever arrived while nothing was listening.
+        for shard in load_shards():
+            self._queue(shard.name)
+        return self._server.server_address[:2]
+
+    def stop(self) -> None:
+        self._stop.set()
+        with self._cond:
+            self._cond.notify_all()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default=PUSH_HOST)
+    parser.add_argument("--port", type=int, default=PUSH_PORT)
+    parser.add_argument("--renew", action="store_true", help="(re)start every mailbox's watch and exit")
+    parser.add_argument("--stop", action="store_true", help="stop every mailbox's watch and exit")
+    parser.add_argument("--simulate", action="store_true", help="post one notification to a running receiver")
+    parser.add_argument("--address", help="--simulate: the mailbox's email address")
+    parser.add_argument("--history-id", type=int, help="--simulate: the mailbox's new historyId")
+    parser.add_argument("--url", help=f"--simulate: receiver URL (default http://HOST:PORT{PUSH_PATH})")
+    args = parser.parse_args(argv)
+
+    if args.simulate:
+        if not args.address or args.history_id is None:
+            parser.error("--simulate needs --address and --history-id")
+        print(simulate(args.address, args.history_id, url=args.url or f"http://{args.host}:{args.port}{PUSH_PATH}"))
+        return 0
+
+    client_factory = lru_cache(maxsize=None)(make_client)
+    if args.stop:
+        for shard in load_shards():
+            client_factory(shard.name).stop_watch()
+            get_index().set_meta(_watch_key(shard.name), "")
+        return 0
+    if args.renew:
+        print(renew_watches(client_factory, force=True) or "LENAH push: LENAH_PUSH_TOPIC is not set.")
+        return 0
+
+    if not PUSH_TOPIC:
+        print("LENAH push: LENAH_PUSH_TOPIC is not set; only simulated notifications and the fallback sync will run.")
+    receiver = PushReceiver(client_factory)
+    host, port = receiver.start(args.host, args.port)
+    print(f"LENAH push: listening on http://{host}:{port}{PUSH_PATH}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        receiver.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
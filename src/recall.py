@@ -0,0 +1,508 @@
+"""
+Long-range recall: an embedding index over each user's past messages.
+
+``chat`` and the drafting calls only see the last few dozen messages, so a
+requirement stated early in a long session ("must allow pets") falls out
+of the prompt. Instead of sending more history, every chat message and
+agent reply is embedded once, and each call gets the few older snippets
+most similar to what it is about (:func:`recall`) next to its usual recent
+window.
+
+- Embedders are pluggable (LENAH_EMBEDDER): ``hashing`` is a local,
+  dependency-free hashed bag of words and bigrams; ``openai`` calls the
+  embeddings API (LENAH_EMBED_MODEL). More can be added with
+  :func:`register_embedder`.
+- Each user's vectors live in LENAH_EMBED_DIR/{user_id}/ as an append-only
+  float16 matrix, memory-mapped for search, next to one JSON line per row.
+  A text is keyed by its content hash and embedded only once.
+- Embedding happens on a background thread in batches, off the turn: a
+  message only becomes worth recalling once it has left the recent window,
+  many turns later.
+
+Switching embedders starts each user's index afresh; ``python -m
+src.recall --rebuild`` re-embeds saved chat history (archive included).
+"""
+from __future__ import annotations
+
+import argparse
+import atexit
+import hashlib
+import json
+import re
+import shutil
+import sys
+import threading
+import zlib
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, NamedTuple, Protocol
+
+import numpy as np
+
+from src.config import EMBED_DIR, EMBED_MODEL, EMBEDDER, RECALL_K, RECALL_MIN_SCORE
+from src.session import _file_lock, _user_id, iter_user_emails, open_user_store
+from src.tracing import span
+
+# Texts shorter than this ("send it", "thanks") carry nothing worth recalling.
+_MIN_CHARS = 25
+# Stored per row for the prompt; the vector is computed from the full text.
+_MAX_STORED_CHARS = 1200
+
+
+def content_hash(text: str) -> str:
+    return hashlib.blake2b(text.strip().encode("utf-8"), digest_size=12).hexdigest()
+
+
+# ---------------------------------------------------------------------------
+# Embedders
+# ---------------------------------------------------------------------------
+
+class Embedder(Protocol):
+    name: str
+    dim: int
+
+    def embed(self, texts: list[str]) -> np.ndarray:
+        """(len(texts), dim) float32 rows, L2-normalised."""
+        ...
+
+
+_STOPWORDS = frozenset(
+    "about also an and any are as at be been but by can could did do does for from had has have "
+    "how if in is it its just me my not of on or our please remind said so some tell than thank "
+    "thanks that the their them then there these they this to us was we were what when which who "
+    "why will with would you your".split()
+)
+
+
+def _words(text: str) -> list[str]:
+    # A plural/verb "s" is the cheapest stemming that matters here ("pets" ~ "pet").
+    return [
+        w[:-1] if len(w) > 3 and w.endswith("s") and not w.endswith("ss") else w
+        for w in re.findall(r"[a-z0-9£]{2,}", text.lower())
+        if w not in _STOPWORDS
+    ]
+
+
+class HashingEmbedder:
+    """
+    Signed feature hashing of words and word pairs, log-scaled. No model and
+    no network; good at "same words, same topic", blind to synonyms.
+    """
+
+    def __init__(self, dim: int = 1024) -> None:
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+
+    def embed(self, texts: list[str]) -> np.ndarray:
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            words = _words(text)
+            for feature in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+                h = zlib.crc32(feature.encode("utf-8"))
+                out[row, h % self.dim] += 1.0 if h & 0x80000000 else -1.0
+        out = np.sign(out) * np.log1p(np.abs(out))
+        return _normalise(out)
+
+
+class OpenAIEmbedder:
+    """The OpenAI embeddings endpoint, through the same client as src/llm.py."""
+
+    def __init__(self, model: str = EMBED_MODEL) -> None:
+        self.model = model
+        self.name = f"openai-{model}"
+        self.dim = 0  # known after the first call
+
+    def embed(self, texts: list[str]) -> np.ndarray:
+        from src import llm  # noqa: PLC0415  (imports the client and needs the API key)
+
+        with span("llm.embed", model=self.model, texts=len(texts)):
+            resp = llm._client.embeddings.create(model=self.model, input=texts)
+        out = np.array([d.embedding for d in resp.data], dtype=np.float32)
+        self.dim = out.shape[1]
+        return _normalise(out)
+
+
+def _normalise(m: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(m, axis=1, keepdims=True)
+    return m / np.where(norms == 0, 1, norms)
+
+
+_EMBEDDERS: dict[str, Callable[[], Embedder]] = {
+    "hashing": HashingEmbedder,
+    "openai": OpenAIEmbedder,
+}
+
+
+def register_embedder(name: str, factory: Callable[[], Embedder]) -> None:
+    """Make ``LENAH_EMBEDDER=name`` use ``factory()``."""
+    _EMBEDDERS[name] = factory
+
+
+_embedder: Embedder | None = None
+
+
+def get_embedder() -> Embedder:
+    global _embedder
+    if _embedder is None:
+        try:
+            _embedder = _EMBEDDERS[EMBEDDER]()
+        except KeyError:
+            raise RuntimeError(
+                f"Unknown LENAH_EMBEDDER {EMBEDDER!r}; expected one of {', '.join(_EMBEDDERS)}."
+            ) from None
+    return _embedder
+
+
+# ---------------------------------------------------------------------------
+# Per-user vector store
+# ---------------------------------------------------------------------------
+
+class Snippet(NamedTuple):
+    score: float
+    source: str  # "user" | "assistant" | agent email address
+    text: str
+
+
+class VectorStore:
+    """
+    One user's embeddings: ``vectors.f16`` (rows of ``dim`` float16, append
+    only), ``rows.jsonl`` (hash, source and text per row) and
+    ``index.json`` (which embedder wrote them).
+
+    Appends and clears hold a lock on the directory and first catch up
+    with the files on disk, so a second handle on the same user (one
+    opened after :func:`get_store` evicted this one, or another process)
+    adds after the other's rows instead of over them.
+    """
+
+    def __init__(self, directory: Path, embedder: Embedder) -> None:
+        self.dir = directory
+        self.embedder = embedder
+        self._lock = threading.Lock()
+        self._rows: list[dict] | None = None
+        self._hashes: set[str] = set()
+        self._matrix: np.ndarray | None = None
+        self._dim = 0
+        self._torn = False
+
+    def _load(self) -> None:
+        if self._rows is not None:
+            return
+        self._rows, self._hashes = [], set()
+        header = self.dir / "index.json"
+        if header.exists():
+            meta = json.loads(header.read_text(encoding="utf-8"))
+            if meta.get("embedder") != self.embedder.name:
+                shutil.rmtree(self.dir)  # other embedder's vectors aren't comparable
+                return
+            self._dim = int(meta["dim"])
+            rows = [json.loads(line) for line in (self.dir / "rows.jsonl").read_text(encoding="utf-8").splitlines()]
+            # A crash between the two appends can leave one file a row ahead.
+            size = (self.dir / "vectors.f16").stat().st_size
+            n = min(len(rows), size // (2 * self._dim))
+            self._torn = len(rows) != n or size != n * 2 * self._dim
+            self._rows = rows[:n]
+            self._hashes = {r["hash"] for r in self._rows}
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._load()
+            return len(self._rows)
+
+    def _sync(self) -> None:
+        """Re-read the files if another handle changed them; call under the directory lock."""
+        vectors, lines = self.dir / "vectors.f16", self.dir / "rows.jsonl"
+        size = vectors.stat().st_size if vectors.exists() else 0
+        if self._rows is None or size != len(self._rows) * 2 * self._dim:
+            self._rows, self._matrix, self._dim = None, None, 0
+            self._load()
+        if self._torn:
+            # Torn append (crash between the two writes): cut both files back to
+            # the rows they agree on, so the next append lines up again.
+            n = len(self._rows)
+            with vectors.open("r+b") as fh:
+                fh.truncate(n * 2 * self._dim)
+            lines.write_text("".join(json.dumps(r, ensure_ascii=False) + "\n" for r in self._rows), encoding="utf-8")
+            self._torn = False
+
+    def add(self, items: list[tuple[str, str]]) -> int:
+        """Embed and append the (source, text) items not stored yet. Returns rows added."""
+        with self._lock:
+            self._load()
+            fresh: dict[str, tuple[str, str]] = {}
+            for source, text in items:
+                h = content_hash(text)
+                if h not in self._hashes and h not in fresh:
+                    fresh[h] = (source, text)
+            if not fresh:
+                return 0
+            # Embedding can be a network call, so it happens outside the directory lock.
+            vectors = self.embedder.embed([text for _source, text in fresh.values()]).astype(np.float16)
+            self.dir.mkdir(parents=True, exist_ok=True)
+            with _file_lock(self.dir / ".lock"):
+                self._sync()
+                keep = {i for i, h in enumerate(fresh) if h not in self._hashes}
+                if not keep:
+                    return 0
+                vectors = vectors[sorted(keep)]
+                if not self._dim:
+                    self._dim = vectors.shape[1]
+                    (self.dir / "index.json").write_text(
+                        json.dumps({"embedder": self.embedder.name, "dim": self._dim}), encoding="utf-8"
+                    )
+                kept = [item for i, item in enumerate(fresh.items()) if i in keep]
+                rows = [{"hash": h, "source": s, "text": t[:_MAX_STORED_CHARS]} for h, (s, t) in kept]
+                with (self.dir / "vectors.f16").open("ab") as fh:
+                    fh.write(vectors.tobytes())
+                with (self.dir / "rows.jsonl").open("a", encoding="utf-8") as fh:
+                    fh.writelines(json.dumps(r, ensure_ascii=False) + "\n" for r in rows)
+            self._rows.extend(rows)
+            self._hashes.update(r["hash"] for r in rows)
+            return len(rows)
+
+    def search(self, query: np.ndarray, k: int, exclude: set[str], min_score: float) -> list[Snippet]:
+        with self._lock:
+            self._load()
+            n = len(self._rows)
+            if not n:
+                return []
+            self._matrix = self._extend_matrix(n)
+            scores = self._matrix @ query.astype(np.float32)
+            rows = self._rows
+        # Best k plus room for the excluded ones, then exact order.
+        take = min(n, k + len(exclude))
+        top = np.argpartition(-scores, take - 1)[:take]
+        top = top[np.argsort(-scores[top])]
+        hits: list[Snippet] = []
+        for i in top:
+            if scores[i] < min_score or len(hits) == k:
+                break
+            if rows[i]["hash"] not in exclude:
+                hits.append(Snippet(float(scores[i]), rows[i]["source"], rows[i]["text"]))
+        return hits
+
+    def _extend_matrix(self, n: int) -> np.ndarray:
+        """The float32 matrix in memory, reading only rows appended since the last search."""
+        have = 0 if self._matrix is None else len(self._matrix)
+        if have == n:
+            return self._matrix
+        disk = np.memmap(self.dir / "vectors.f16", dtype=np.float16, mode="r", shape=(n, self._dim))
+        new = np.asarray(disk[have:], dtype=np.float32)
+        return new if self._matrix is None else np.vstack([self._matrix, new])
+
+    def clear(self) -> None:
+        with self._lock, _file_lock(self.dir / ".lock"):
+            for path in self.dir.glob("*"):
+                if path.name != ".lock":
+                    path.unlink()
+            self._rows, self._hashes, self._matrix, self._dim, self._torn = None, set(), None, 0, False
+
+
+_OPEN_MAX = 64
+_stores: OrderedDict[str, VectorStore] = OrderedDict()
+_stores_lock = threading.Lock()
+
+
+def get_store(user_email: str) -> VectorStore:
+    user_id = _user_id(user_email)
+    with _stores_lock:
+        store = _stores.get(user_id)
+        if store is None:
+            store = _stores[user_id] = VectorStore(EMBED_DIR / user_id, get_embedder())
+        _stores.move_to_end(user_id)
+        # An evicted store may still be mid-add on another thread; the
+        # directory lock in VectorStore.add keeps a fresh handle from
+        # writing over it.
+        if len(_stores) > _OPEN_MAX:
+            _stores.popitem(last=False)
+    return store
+
+
+# ---------------------------------------------------------------------------
+# Background embedding
+# ---------------------------------------------------------------------------
+
+_BATCH = 64
+
+
+class _Indexer:
+    """Daemon thread embedding queued texts in batches, grouped by user."""
+
+    def __init__(self) -> None:
+        self._cond = threading.Condition()
+        self._queue: list[tuple[str, str, str]] = []
+        self._busy = False
+        self._thread: threading.Thread | None = None
+
+    def submit(self, user_email: str, source: str, text: str) -> None:
+        with self._cond:
+            self._queue.append((user_email, source, text))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="lenah-recall-indexer", daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+
+    def _take(self) -> list[tuple[str, str, str]]:
+        batch, self._queue = self._queue[:_BATCH], self._queue[_BATCH:]
+        self._busy = bool(batch)
+        return batch
+
+    def _write(self, batch: list[tuple[str, str, str]]) -> None:
+        by_user: dict[str, list[tuple[str, str]]] = {}
+        for user_email, source, text in batch:
+            by_user.setdefault(user_email, []).append((source, text))
+        for user_email, items in by_user.items():
+            try:
+                with span("recall.embed", texts=len(items)):
+                    get_store(user_email).add(items)
+            except Exception as exc:  # noqa: BLE001
+                print(f"LENAH recall: couldn't embed {len(items)} texts for user {_user_id(user_email)}: {exc}")
+
+    def flush(self) -> None:
+        """Embed everything queued now, and wait for the thread's batch in progress."""
+        while True:
+            with self._cond:
+                while self._busy:
+                    self._cond.wait()
+                batch = self._take()
+            if not batch:
+                return
+            try:
+                self._write(batch)
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._queue or self._busy:
+                    self._cond.wait()
+                batch = self._take()
+            try:
+                self._write(batch)
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+
+
+_indexer = _Indexer()
+atexit.register(_indexer.flush)
+
+
+def remember(user_email: str | None, source: str, text: str) -> None:
+    """Queue ``text`` (said by ``source``) for this user's index. Never blocks on embedding."""
+    if user_email and text and len(text.strip()) >= _MIN_CHARS:
+        _indexer.submit(user_email, source, text)
+
+
+def flush() -> None:
+    _indexer.flush()
+
+
+def forget(user_email: str) -> None:
+    """Drop a user's vectors (their saved data is being cleared)."""
+    flush()
+    get_store(user_email).clear()
+
+
+# ---------------------------------------------------------------------------
+# Retrieval
+# ---------------------------------------------------------------------------
+
+_QUERY_CACHE = 256
+_query_vectors: OrderedDict[tuple[str, str], np.ndarray] = OrderedDict()
+_query_lock = threading.Lock()
+
+
+def _embed_query(text: str) -> np.ndarray:
+    embedder = get_embedder()
+    key = (embedder.name, content_hash(text))
+    with _query_lock:
+        if key in _query_vectors:
+            _query_vectors.move_to_end(key)
+            return _query_vectors[key]
+    vector = embedder.embed([text])[0]
+    with _query_lock:
+        _query_vectors[key] = vector
+        if len(_query_vectors) > _QUERY_CACHE:
+            _query_vectors.popitem(last=False)
+    return vector
+
+
+def recall(
+    user_email: str | None,
+    query: str,
+    *,
+    recent: list[dict],
+    k: int = RECALL_K,
+) -> list[str]:
+    """
+    Up to ``k`` older snippets relevant to ``query``, formatted for a prompt.
+    Anything in ``recent`` (the history window the call already sends) is
+    left out. Never raises: recall only ever adds context.
+    """
+    if not user_email or not query.strip() or k <= 0:
+        return []
+    try:
+        with span("recall.query", k=k) as s:
+            store = get_store(user_email)
+            exclude = {content_hash(m.get("content") or "") for m in recent}
+            hits = store.search(_embed_query(query), k, exclude, RECALL_MIN_SCORE)
+            s.set(hits=len(hits), rows=len(store))
+    except Exception as exc:  # noqa: BLE001
+        print(f"LENAH recall: lookup failed for user {_user_id(user_email)}: {exc}")
+        return []
+    return [f"{_SPEAKERS.get(hit.source, f'Agent {hit.source}')}: {hit.text}" for hit in hits]
+
+
+_SPEAKERS = {"user": "User", "assistant": "LENAH"}
+
+
+# ---------------------------------------------------------------------------
+# Backfill
+# ---------------------------------------------------------------------------
+
+_REBUILD_CHUNK = 500
+
+
+def rebuild(user_email: str) -> int:
+    """Re-embed a user's saved chat, a chunk of the archive at a time. Returns rows stored."""
+    store = open_user_store(user_email)
+    state = store.load()
+    vectors = get_store(store.email)
+    vectors.clear()
+    archived = state["archived_count"] or 0
+
+    def add(messages: list[dict]) -> None:
+        vectors.add([
+            (m["role"], m["content"]) for m in messages
+            if m.get("content") and len(m["content"].strip()) >= _MIN_CHARS
+        ])
+
+    for start in range(0, archived, _REBUILD_CHUNK):
+        add(store.load_archive(start, min(start + _REBUILD_CHUNK, archived)))
+    add(state["messages"])
+    return len(vectors)
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("email", nargs="?", help="user to query or rebuild (default: every user with --rebuild)")
+    parser.add_argument("query", nargs="?", help="show what would be recalled for this text")
+    parser.add_argument("--rebuild", action="store_true", help="re-embed chat history from the user store")
+    args = parser.parse_args(argv)
+
+    if args.rebuild:
+        for email in [args.email] if args.email else iter_user_emails():
+            print(f"{_user_id(email)}: {rebuild(email)} rows")
+    if args.email and args.query:
+        for line in recall(args.email, args.query, recent=[]):
+            print(f"- {line}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,276 @@
+from __future__ import annotations
+
+import base64
+import contextlib
+import contextvars
+import copy
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Iterator
+
+from src.config import RECORD_DIR, RECORD_REDACT_EMAILS
+from src.session import _STATE_KEYS
+from src.utils import EMAIL_RE, frozen_clock
+
+TRACE_VERSION = 1
+
+# Calls captured during the active turn; None when no turn is being recorded.
+_calls: contextvars.ContextVar[list[dict] | None] = contextvars.ContextVar(
+    "lenah_recorded_calls", default=None
+)
+
+Redactor = Callable[[dict], dict]
+_redactors: list[Redactor] = []
+
+
+# ---------------------------------------------------------------------------
+# Redaction hooks
+# ---------------------------------------------------------------------------
+
+def register_redactor(fn: Redactor) -> None:
+    """Add a hook applied to every turn record before it is written."""
+    _redactors.append(fn)
+
+
+def _pseudonym(match: re.Match) -> str:
+    digest = hashlib.sha256(match.group(0).lower().encode()).hexdigest()[:10]
+    return f"{digest}@redacted.invalid"
+
+
+def _redact_text(text: str) -> str:
+    return EMAIL_RE.sub(_pseudonym, text)
+
+
+def _walk(value: Any, key: str | None = None) -> Any:
+    if isinstance(value, dict):
+        return {_redact_text(k) if isinstance(k, str) else k: _walk(v, k) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_walk(v) for v in value]
+    if isinstance(value, str):
+        # Gmail body parts are base64url; redact the decoded text.
+        if key == "data":
+            try:
+                padded = value + "=" * (-len(value) % 4)
+                decoded = base64.urlsafe_b64decode(padded).decode("utf-8")
+            except (ValueError, UnicodeDecodeError):
+                return value
+            return base64.urlsafe_b64encode(_redact_text(decoded).encode()).decode()
+        return _redact_text(value)
+    return value
+
+
+def pseudonymise_emails(record: dict) -> dict:
+    """
+    Replace every email address with a stable hash-based pseudonym.
+
+    The mapping is deterministic, so the redacted trace still replays
+    consistently: the same agent address always becomes the same pseudonym.
+    """
+    return _walk(record)
+
+
+if RECORD_REDACT_EMAILS:
+    register_redactor(pseudonymise_emails)
+
+
+# ---------------------------------------------------------------------------
+# Capture — called from src.llm._create and GmailClient._execute
+# ---------------------------------------------------------------------------
+
+def _jsonable(obj: Any) -> Any:
+    if hasattr(obj, "model_dump"):
+        return obj.model_dump(mode="json", exclude_none=True)
+    if isinstance(obj, dict):
+        return {k: _jsonable(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_jsonable(v) for v in obj]
+    if hasattr(obj, "__dict__"):
+        return {k: _jsonable(v) for k, v in vars(obj).items() if not k.startswith("_")}
+    return obj
+
+
+def capture_llm(request: dict, response: Any) -> None:
+    calls = _calls.get()
+    if calls is None:
+        return
+    calls.append({"type": "llm", "request": _jsonable(request), "response": _jsonable(response)})
+
+
+def capture_gmail(endpoint: str, request: Any, response: dict) -> None:
+    calls = _calls.get()
+    if calls is None:
+        return
+    body = getattr(request, "body", None)
+    calls.append({
+        "type": "gmail",
+        "endpoint": endpoint,
+        "request": {
+            "method": getattr(request, "method", None),
+            "uri": getattr(request, "uri", None),
+            "body_bytes": len(body) if body else 0,
+        },
+        "response": _jsonable(response),
+    })
+
+
+# ---------------------------------------------------------------------------
+# Per-turn recording
+# ---------------------------------------------------------------------------
+
+def _snapshot(state: Any) -> dict:
+    return {k: copy.deepcopy(state.get(k)) for k in _STATE_KEYS}
+
+
+def state_delta(before: dict, after: dict) -> dict:
+    """
+    Describe ``after`` relative to ``before`` compactly: appended messages
+    plus any other key that changed. :func:`apply_delta` reverses it.
+    """
+    delta: dict[str, Any] = {}
+    old, new = before.get("messages") or [], after.get("messages") or []
+    if new[: len(old)] == old:
+        if len(new) > len(old):
+            delta["append"] = new[len(old):]
+    else:
+        delta.setdefault("set", {})["messages"] = new
+    for k in _STATE_KEYS:
+        if k != "messages" and before.get(k) != after.get(k):
+            delta.setdefault("set", {})[k] = after.get(k)
+    return delta
+
+
+def apply_delta(before: dict, delta: dict) -> dict:
+    after = copy.deepcopy(before)
+    after["messages"] = list(after.get("messages") or []) + list(delta.get("append") or [])
+    after.update(copy.deepcopy(delta.get("set") or {}))
+    return after
+
+
+class TraceWriter:
+    """
+    Appends one JSON line per turn to a session trace file.
+
+    ``state_before`` is written in full only when it differs from the
+    previous turn's ``state_after`` (first turn, or another tab changed the
+    user's state in between); otherwise it is null.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self._last_after: dict | None = None
+        self._lock = threading.Lock()
+
+    def write(self, *, kind: str, user_text: str | None, before: dict, after: dict,
+              calls: list[dict], started: float, duration: float) -> None:
+        record = {
+            "v": TRACE_VERSION,
+            "ts": started,
+            "kind": kind,
+            "user_text": user_text,
+            "state_before": None if before == self._last_after else before,
+            "state_delta": state_delta(before, after),
+            "calls": calls,
+            "duration_ms": round(duration * 1000, 3),
+        }
+        self._last_after = after
+        for redactor in _redactors:
+            record = redactor(record)
+        line = json.dumps(record, ensure_ascii=False, separators=(",", ":"), default=str)
+        with self._lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with self.path.open("a", encoding="utf-8") as fh:
+                fh.write(line + "\n")
+
+
+# One writer per user per process, so a user's turns land in one trace
+# whichever session or API request ran them. Least recently used first.
+_writers: OrderedDict[str, TraceWriter] = OrderedDict()
+_writers_lock = threading.Lock()
+_MAX_WRITERS = 256
+
+
+def _writer_for(state: Any, store: Any = None) -> TraceWriter | None:
+    if RECORD_DIR is None:
+        return None
+    store = store if store is not None else state.get("_user_store")
+    user_id = getattr(store, "user_id", None)
+    if user_id is None:
+        # No store to tie the turns to: one trace per session state.
+        writer = state.get("_trace_writer")
+        if writer is None:
+            writer = state["_trace_writer"] = TraceWriter(
+                RECORD_DIR / f"anonymous-{time.strftime('%Y%m%dT%H%M%S')}.jsonl"
+            )
+        return writer
+    with _writers_lock:
+        writer = _writers.get(user_id)
+        if writer is None:
+            writer = _writers[user_id] = TraceWriter(
+                RECORD_DIR / f"{user_id}-{time.strftime('%Y%m%dT%H%M%S')}.jsonl"
+            )
+            while len(_writers) > _MAX_WRITERS:
+                _writers.popitem(last=False)
+        _writers.move_to_end(user_id)
+    return writer
+
+
+@contextlib.contextmanager
+def record_turn(kind: str, user_text: str | None, state: Any, store: Any = None) -> Iterator[None]:
+    """
+    Record everything one turn reads and produces. A no-op unless
+    LENAH_RECORD_DIR is set. The trace is the user's whose ``store`` it is
+    (by default ``state["_user_store"]``, as in the app).
+
+        with record_turn("message", user_text, st.session_state):
+            _handle_message(user_text)
+    """
+    writer = _writer_for(state, store)
+    if writer is None:
+        yield
+        return
+
+    before = _snapshot(state)
+    calls: list[dict] = []
+    token = _calls.set(calls)
+    # The turn sees one wall-clock time, recorded as "ts"; replay pins the
+    # clock to it again, so timestamps the turn saves into state match.
+    started = time.time()
+    start = time.perf_counter()
+    try:
+        with frozen_clock(started):
+            yield
+    finally:
+        duration = time.perf_counter() - start
+        _calls.reset(token)
+        writer.write(
+            kind=kind,
+            user_text=user_text,
+            before=before,
+            after=_snapshot(state),
+            calls=calls,
+            started=started,
+            duration=duration,
+        )
+
+
+def read_trace(path: Path) -> list[dict]:
+    """Load a trace, materialising every turn's full ``state_before``/``state_after``."""
+    turns: list[dict] = []
+    previous_after: dict | None = None
+    for line in path.read_text(encoding="utf-8").splitlines():
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        before = record["state_before"] if record["state_before"] is not None else previous_after
+        if before is None:
+            raise ValueError(f"{path}: first turn has no state_before")
+        record["state_before"] = before
+        record["state_after"] = apply_delta(before, record["state_delta"])
+        previous_after = record["state_after"]
+        turns.append(record)
+    return turns
@@ -0,0 +1,290 @@
+"""
+Full-text search over a user's chat and agent correspondence.
+
+Every user gets a small SQLite FTS5 database under LENAH_SEARCH_DIR
+(``{user_id}.sqlite``) holding:
+
+- every chat message, added as the conversation engine appends it;
+- every email sent to an agent (enquiries, replies, bulk sends);
+- every agent reply the poller fetches, in full — the chat itself only ever
+  shows a summary of it.
+
+Writes are incremental (one row per message or email), so searching never
+needs the user's history in memory: a query is one FTS5 ``MATCH`` ranked
+by bm25 with a highlighted snippet, a few milliseconds even over thousands
+of messages. Like the thread index, it is derived data and never raises
+into a turn; history from before it existed can be added with
+
+    python -m src.search --rebuild             # every user's chat history
+    python -m src.search me@example.com "parking"
+
+Agent emails from before then were never stored, so only chat is rebuilt.
+"""
+from __future__ import annotations
+
+import argparse
+import re
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import NamedTuple
+
+from src.config import SEARCH_DIR
+from src.session import _user_id, iter_user_emails, open_user_store
+from src.tracing import span
+
+_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS docs USING fts5(
+    kind UNINDEXED,
+    title,
+    body,
+    ts UNINDEXED,
+    tokenize = 'porter unicode61'
+);
+-- Gmail message id -> docs rowid, so an email is only indexed once.
+CREATE TABLE IF NOT EXISTS emails (
+    message_id TEXT PRIMARY KEY,
+    doc        INTEGER NOT NULL
+);
+"""
+
+# bm25 column weights (kind, title, body): a hit in a subject or sender
+# counts for more than one in the body.
+_RANK = "bm25(docs, 0.0, 2.0, 1.0)"
+
+_CHAT_TITLES = {"user": "You", "assistant": "LENAH"}
+
+
+class Hit(NamedTuple):
+    kind: str      # "chat" | "email_in" | "email_out"
+    title: str
+    snippet: str   # matched terms wrapped in **…**
+    ts: float
+
+
+# ---------------------------------------------------------------------------
+# Per-user index
+# ---------------------------------------------------------------------------
+
+class SearchIndex:
+    """One user's FTS5 database; safe to share between threads."""
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn: sqlite3.Connection | None = None
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def add(self, kind: str, title: str, body: str, ts: float, message_id: str | None = None) -> bool:
+        """Index one document. An email already indexed under ``message_id`` is skipped."""
+        with self._lock:
+            db = self._db()
+            if message_id and db.execute("SELECT 1 FROM emails WHERE message_id = ?", (message_id,)).fetchone():
+                return False
+            db.execute("BEGIN")
+            try:
+                cur = db.execute(
+                    "INSERT INTO docs (kind, title, body, ts) VALUES (?, ?, ?, ?)", (kind, title, body, ts)
+                )
+                if message_id:
+                    db.execute("INSERT INTO emails VALUES (?, ?)", (message_id, cur.lastrowid))
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+        return True
+
+    def add_many(self, rows: list[tuple[str, str, str, float]]) -> None:
+        with self._lock:
+            db = self._db()
+            db.execute("BEGIN")
+            db.executemany("INSERT INTO docs (kind, title, body, ts) VALUES (?, ?, ?, ?)", rows)
+            db.execute("COMMIT")
+
+    def search(self, query: str, limit: int = 20) -> list[Hit]:
+        match = _match_expression(query)
+        if not match:
+            return []
+        with self._lock:
+            rows = self._db().execute(
+                "SELECT kind, highlight(docs, 1, '**', '**'), snippet(docs, 2, '**', '**', '…', 16), ts "
+                f"FROM docs WHERE docs MATCH ? ORDER BY {_RANK} LIMIT ?",
+                (match, limit),
+            ).fetchall()
+        return [Hit(kind, title, snippet, float(ts)) for kind, title, snippet, ts in rows]
+
+    def count(self) -> int:
+        with self._lock:
+            return self._db().execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+
+    def clear_chat(self) -> None:
+        with self._lock:
+            self._db().execute("DELETE FROM docs WHERE kind = 'chat'")
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+def _match_expression(query: str) -> str:
+    """
+    Free text -> FTS5 query: every word must appear, the last one as a
+    prefix so results show while the user is still typing. Quoting each
+    word keeps FTS5 operators and punctuation in user input inert.
+    """
+    words = re.findall(r"\w+", query or "")
+    if not words:
+        return ""
+    terms = [f'"{w}"' for w in words]
+    terms[-1] += "*"
+    return " ".join(terms)
+
+
+# ---------------------------------------------------------------------------
+# Process-wide access
+# ---------------------------------------------------------------------------
+
+# Open databases, most recently used last; the oldest is closed beyond this.
+_OPEN_MAX = 64
+_open: OrderedDict[str, SearchIndex] = OrderedDict()
+_open_lock = threading.Lock()
+
+
+def get_index(user_email: str) -> SearchIndex:
+    user_id = _user_id(user_email)
+    with _open_lock:
+        index = _open.get(user_id)
+        if index is None:
+            index = _open[user_id] = SearchIndex(SEARCH_DIR / f"{user_id}.sqlite")
+        _open.move_to_end(user_id)
+        evicted = _open.popitem(last=False)[1] if len(_open) > _OPEN_MAX else None
+    if evicted is not None:
+        evicted.close()
+    return index
+
+
+def _safely(what: str, fn) -> None:
+    """The index is an extra; a failure is logged and never ends a turn."""
+    try:
+        with span("search.index", what=what):
+            fn()
+    except Exception as exc:  # noqa: BLE001
+        print(f"LENAH search: couldn't index {what}: {exc}")
+
+
+def index_message(user_email: str | None, message: dict) -> None:
+    if not user_email or not message.get("content"):
+        return
+    title = _CHAT_TITLES.get(message.get("role") or "", message.get("role") or "")
+    _safely("chat message", lambda: get_index(user_email).add("chat", title, message["content"], time.time()))
+
+
+def index_email(
+    user_email: str | None,
+    *,
+    inbound: bool,
+    agent_email: str,
+    subject: str,
+    body: str,
+    message_id: str,
+    ts: float | None = None,
+) -> None:
+    """An email to (``inbound`` False) or from an agent."""
+    if not user_email:
+        return
+    kind, title = ("email_in", f"From {agent_email}") if inbound else ("email_out", f"To {agent_email}")
+    if subject:
+        title += f" — {subject}"
+    _safely(
+        "email",
+        lambda: get_index(user_email).add(kind, title, body or "", ts or time.time(), message_id=message_id),
+    )
+
+
+def search_history(user_email: str, query: str, limit: int = 20) -> list[Hit]:
+    with span("search.query", limit=limit) as s:
+        hits = get_index(user_email).search(query, limit)
+        s.set(hits=len(hits))
+    return hits
+
+
+def delete_history(user_email: str) -> None:
+    """Drop a user's index entirely (their saved data is being cleared)."""
+    user_id = _user_id(user_email)
+    with _open_lock:
+        index = _open.pop(user_id, None)
+    if index is not None:
+        index.close()
+    for suffix in ("", "-wal", "-shm"):
+        (SEARCH_DIR / f"{user_id}.sqlite{suffix}").unlink(missing_ok=True)
+
+
+# ---------------------------------------------------------------------------
+# Backfill
+# ---------------------------------------------------------------------------
+
+_REBUILD_CHUNK = 500
+
+
+def rebuild(user_email: str) -> int:
+    """Re-index a user's chat (archive included, a chunk at a time). Returns messages indexed."""
+    store = open_user_store(user_email)
+    state = store.load()
+    index = get_index(store.email)
+    index.clear_chat()
+    archived = state["archived_count"] or 0
+    total = 0
+    for start in range(0, archived, _REBUILD_CHUNK):
+        chunk = store.load_archive(start, min(start + _REBUILD_CHUNK, archived))
+        total += _add_chat(index, chunk)
+    total += _add_chat(index, state["messages"])
+    return total
+
+
+def _add_chat(index: SearchIndex, messages: list[dict]) -> int:
+    # Chat messages carry no timestamps; backfilled ones are dated now.
+    now = time.time()
+    rows = [
+        ("chat", _CHAT_TITLES.get(m.get("role") or "", m.get("role") or ""), m["content"], now)
+        for m in messages if m.get("content")
+    ]
+    index.add_many(rows)
+    return len(rows)
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("email", nargs="?", help="user to search or rebuild (default: every user with --rebuild)")
+    parser.add_argument("query", nargs="?", help="search this user's history")
+    parser.add_argument("--rebuild", action="store_true", help="re-index chat history from the user store")
+    parser.add_argument("--limit", type=int, default=10)
+    args = parser.parse_args(argv)
+
+    if args.rebuild:
+        for email in [args.email] if args.email else iter_user_emails():
+            print(f"{_user_id(email)}: {rebuild(email)} messages")
+    if args.email and args.query:
+        start = time.perf_counter()
+        hits = search_history(args.email, args.query, args.limit)
+        for hit in hits:
+            print(f"[{hit.kind}] {hit.title}\n    {hit.snippet}")
+        print(f"\n{len(hits)} hits in {(time.perf_counter() - start) * 1000:.1f} ms")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,66 +1,854 @@
 from __future__ import annotations
 
+import atexit
+import contextlib
 import copy
 import hashlib
 import json
+import os
+import threading
+import time
+import zlib
 from pathlib import Path
-from typing import Any
+from typing import Any, Iterator
+
+from src.config import (
+    HISTORY_HOT_WINDOW,
+    HISTORY_SPILL_CHUNK,
+    JOURNAL_COMPACT_EVERY,
+    USER_STORE_BACKEND,
+    USER_STORE_FORMAT,
+    WRITE_BEHIND_DELAY_S,
+)
+from src.tracing import span
+
+try:
+    import fcntl
+except ImportError:  # Windows: only in-process locking is available
+    fcntl = None
 
 USERS_DIR = Path("data/users")
 
 _STATE_KEYS = (
     "messages",
     "user_email",
+    "owner_email",
     "pending_email",
     "agent_threads",
     "agent_last_message_id",
+    "archived_count",
+    "ready_replies",
+    "agent_activity",
+    "mailbox",
+    "listings",
+    "agent_digests",
 )
 
 _DEFAULTS: dict[str, Any] = {
     "messages": [],
+    # Address the user is CC'd at; they can change it mid-chat ("my email is …").
     "user_email": None,
+    # Address the state belongs to (what the store is keyed by), set on every
+    # load and never changed by the conversation. Anything indexed per user —
+    # threads, search, recall, the mailbox shard — is keyed by this one.
+    "owner_email": None,
     "pending_email": None,
     "agent_threads": {},
     "agent_last_message_id": {},
+    # Number of oldest messages moved out of "messages" into the cold archive.
+    "archived_count": 0,
+    # reply message_id -> agent reply pre-fetched and pre-processed by the
+    # poller, waiting to be surfaced (see src/poller.py)
+    "ready_replies": {},
+    # agent_email -> {"last": epoch seconds of the latest message either way,
+    # "replies": replies seen}; drives the poll schedule (src/poll_schedule.py)
+    "agent_activity": {},
+    # Name of the central Gmail mailbox shard the user's mail goes through;
+    # assigned once, then fixed (see src/mailboxes.py)
+    "mailbox": None,
+    # "{reply message_id}:{n}" -> listing extracted from an agent reply;
+    # queried locally (see src/listings.py)
+    "listings": {},
+    # agent_email -> {"text": running digest of the thread, "pending": sent /
+    # received messages not folded in yet, ...} (see src/thread_digest.py)
+    "agent_digests": {},
 }
 
+# Maps that several sessions of the same user (two tabs, two processes, the
+# background poller) update independently. On a concurrent write they are
+# merged per entry instead of the last writer overwriting the other's
+# threads, cursors and queued replies.
+_SHARED_KEYS = (
+    "agent_threads",
+    "agent_last_message_id",
+    "ready_replies",
+    "agent_activity",
+    "listings",
+    "agent_digests",
+)
+
 
 def _user_id(email: str) -> str:
     """Deterministic, filesystem-safe identifier derived from the email address."""
     return hashlib.sha256(email.strip().lower().encode()).hexdigest()[:16]
 
 
+def _fingerprint(value: Any) -> bytes:
+    """Short content hash of one state key, for cheap change detection."""
+    text = json.dumps(value, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+
+# ---------------------------------------------------------------------------
+# Snapshot encoding
+# ---------------------------------------------------------------------------
+
+FORMATS = ("json", "zlib", "zstd")
+
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+def _zstd():
+    try:
+        import zstandard  # noqa: PLC0415
+    except ImportError:
+        raise RuntimeError(
+            "The zstd user store format needs the zstandard package (pip install zstandard)."
+        ) from None
+    return zstandard
+
+
+def encode_state(payload: dict[str, Any], fmt: str) -> bytes:
+    """Serialise a snapshot in one of :data:`FORMATS`."""
+    if fmt == "json":
+        return json.dumps(payload, ensure_ascii=False, indent=2).encode("utf-8")
+    compact = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    if fmt == "zlib":
+        return zlib.compress(compact, 1)  # saves are per-turn: favour speed
+    if fmt == "zstd":
+        return _zstd().ZstdCompressor(level=3).compress(compact)
+    raise ValueError(f"Unknown user store format {fmt!r}; expected one of {', '.join(FORMATS)}.")
+
+
+def detect_format(raw: bytes) -> str:
+    """Tell the formats apart by their first bytes; JSON always starts with ``{``."""
+    if raw.startswith(_ZSTD_MAGIC):
+        return "zstd"
+    if raw[:1] == b"\x78":  # zlib header
+        return "zlib"
+    return "json"
+
+
+def decode_state(raw: bytes) -> dict[str, Any]:
+    fmt = detect_format(raw)
+    if fmt == "zstd":
+        zstandard = _zstd()
+        try:
+            raw = zstandard.ZstdDecompressor().decompress(raw)
+        except zstandard.ZstdError as exc:
+            # A ValueError like a bad JSON snapshot, so callers handle all formats alike.
+            raise ValueError(f"corrupt zstd snapshot: {exc}") from exc
+    elif fmt == "zlib":
+        raw = zlib.decompress(raw)
+    return json.loads(raw)
+
+
+def _atomic_write(path: Path, data: bytes) -> None:
+    """Write via a temp file + rename so readers never see a torn file."""
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with tmp.open("wb") as fh:
+        fh.write(data)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(tmp, path)
+
+
+_path_locks: dict[Path, threading.Lock] = {}
+_path_locks_guard = threading.Lock()
+
+
+@contextlib.contextmanager
+def _file_lock(path: Path) -> Iterator[None]:
+    """
+    Exclusive advisory lock on ``path`` for a read-merge-write cycle. Held
+    only around the write itself, never across a turn. Sessions in the same
+    process also serialise on a plain lock, since flock is not available
+    everywhere.
+    """
+    with _path_locks_guard:
+        local = _path_locks.setdefault(path, threading.Lock())
+    with local:
+        if fcntl is None:
+            yield
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with path.open("a") as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+def _three_way(base: dict, ours: dict, theirs: dict) -> dict:
+    """``theirs`` plus every entry ``ours`` added, changed or removed relative to ``base``."""
+    merged = dict(theirs)
+    for key, value in ours.items():
+        if base.get(key) != value:
+            merged[key] = value
+    for key in base.keys() - ours.keys():
+        merged.pop(key, None)
+    return merged
+
+
+def _stat(path: Path) -> tuple[int, int] | None:
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+class StateDelta:
+    """What changed in the tracked keys since the last load/save."""
+
+    __slots__ = ("append", "set")
+
+    def __init__(self) -> None:
+        self.append: list[dict] = []
+        self.set: dict[str, Any] = {}
+
+    def __bool__(self) -> bool:
+        return bool(self.append or self.set)
+
+
 class UserStore:
     """Manages per-user state persistence in data/users/{user_id}.json."""
 
+    backend = "file"
+
     def __init__(self, email: str) -> None:
         self.email: str = email.strip().lower()
         self.user_id: str = _user_id(self.email)
         self._path: Path = USERS_DIR / f"{self.user_id}.json"
+        self._archive_path: Path = USERS_DIR / f"{self.user_id}.archive.jsonl"
+        self._lock_path: Path = USERS_DIR / f"{self.user_id}.lock"
+        self.format: str = USER_STORE_FORMAT
+        self.bytes_written: int = 0
+        # What was last read from / written to the backing store, so
+        # subclasses can persist deltas instead of the whole state.
+        self._msg_count: int | None = None  # None until loaded: nothing known
+        self._msg_tail: dict | None = None
+        self._fingerprints: dict[str, bytes] = {}
+        # Write-behind bookkeeping: snapshots are numbered on submit and a
+        # flush never writes one older than what is already on disk.
+        self._lock = threading.RLock()
+        self._submitted: int = 0
+        self._flushed: int = 0
+        # Optimistic concurrency between sessions of the same user. Every
+        # write bumps a persisted version; _synced is the copy of the shared
+        # maps the live session state last incorporated, i.e. the base our
+        # local changes are measured against when merging.
+        self._version: int = 0
+        self._disk_sig: Any = None
+        self._disk_shared: dict[str, dict] = {}
+        self._synced: dict[str, dict] = {}
+        self._synced_version: int = 0
 
     @property
     def exists(self) -> bool:
         return self._path.exists()
 
-    def load(self) -> dict[str, Any]:
-        """Return persisted state, filling missing keys with defaults."""
+    def _read_snapshot(self) -> dict[str, Any]:
+        """Decoded snapshot in whichever format it was written, or {} if missing / unreadable."""
         if not self._path.exists():
-            return copy.deepcopy(_DEFAULTS)
+            return {}
         try:
-            data = json.loads(self._path.read_text(encoding="utf-8"))
-        except (json.JSONDecodeError, OSError):
-            return copy.deepcopy(_DEFAULTS)
-        return {k: data.get(k, copy.deepcopy(_DEFAULTS[k])) for k in _STATE_KEYS}
+            return decode_state(self._path.read_bytes())
+        except (ValueError, zlib.error, OSError):
+            return {}
+
+    def _reread(self) -> dict[str, Any] | None:
+        """The snapshot if someone else changed it since we last read or wrote it, else None."""
+        sig = _stat(self._path)
+        if sig == self._disk_sig:
+            return None
+        data = self._read_snapshot()
+        self._version = int(data.get("_version", 0))
+        self._disk_shared = {k: data.get(k) or {} for k in _SHARED_KEYS}
+        self._disk_sig = sig
+        return data
+
+    def _disk_state(self) -> tuple[int, dict[str, dict]]:
+        """Persisted version and shared maps, re-read only if the file changed."""
+        self._reread()
+        return self._version, self._disk_shared
+
+    def load(self) -> dict[str, Any]:
+        """Return persisted state, filling missing keys with defaults."""
+        with self._lock:
+            self._disk_sig = _stat(self._path)  # before reading: a later write re-reads
+            data = self._read_snapshot()
+            state = {k: data.get(k, copy.deepcopy(_DEFAULTS[k])) for k in _STATE_KEYS}
+            self._version = int(data.get("_version", 0))
+            self._disk_shared = {k: copy.deepcopy(state[k]) for k in _SHARED_KEYS}
+            self._mark_persisted(state)
+            self._mark_synced(self._version, state)
+        self._stamp_owner(state)
+        return state
+
+    def _stamp_owner(self, state: dict[str, Any]) -> None:
+        # After _mark_persisted, so state saved before owner_email existed
+        # picks it up on its next save.
+        state["owner_email"] = self.email
 
     def save(self, state: dict[str, Any]) -> None:
-        """Persist the five tracked keys from state to disk."""
-        USERS_DIR.mkdir(parents=True, exist_ok=True)
-        payload = {k: state.get(k, _DEFAULTS[k]) for k in _STATE_KEYS}
-        self._path.write_text(
-            json.dumps(payload, ensure_ascii=False, indent=2),
-            encoding="utf-8",
-        )
+        """
+        Persist the tracked keys from state to disk (skipped if unchanged).
+
+        The write is an atomic replace under an advisory lock. If another
+        session wrote since this one last synced, keys this one did not
+        change keep the other's values and the shared maps are merged per
+        entry; keys both changed are last-writer-wins.
+        """
+        with span("store.save", backend=self.backend) as s:
+            delta = self._delta(state)
+            if not delta:
+                s.set(bytes=0)
+                return
+            USERS_DIR.mkdir(parents=True, exist_ok=True)
+            with self._lock, _file_lock(self._lock_path):
+                disk = self._reread()
+                version, theirs = self._version, self._disk_shared
+                payload = {k: state.get(k, _DEFAULTS[k]) for k in _STATE_KEYS}
+                if disk:
+                    changed = set(delta.set) | ({"messages"} if delta.append else set())
+                    payload.update({k: disk[k] for k in _STATE_KEYS if k in disk and k not in changed})
+                merged = self._merge_shared(state, theirs)
+                payload.update(merged)
+                payload["_version"] = version + 1
+                data = encode_state(payload, self.format)
+                _atomic_write(self._path, data)
+                self._disk_sig = _stat(self._path)
+                self._version = payload["_version"]
+                self._disk_shared = merged
+                self._mark_persisted(state)
+                conflict = self._mark_written(state, merged)
+            self.bytes_written += len(data)
+            s.set(bytes=len(data), messages=len(payload["messages"]), merged=conflict)
+
+    def schedule_save(self, state: dict[str, Any]) -> None:
+        """
+        Persist ``state`` soon. Unchanged state is dropped here; otherwise a
+        snapshot is handed to the write-behind flusher, which coalesces
+        several quick turns into one write. With LENAH_WRITE_BEHIND_DELAY_S=0
+        the save happens synchronously.
+        """
+        with span("store.schedule_save", backend=self.backend) as s:
+            with self._lock:
+                if not self._delta(state):
+                    s.set(skipped=True)
+                    return
+                self._submitted += 1
+                version = self._submitted
+            snapshot = _snapshot(state)
+            if _flusher is None:
+                self._write(snapshot, version)
+            else:
+                s.set(coalesced=_flusher.submit(self, snapshot, version))
+
+    def _write(self, snapshot: dict[str, Any], version: int) -> None:
+        with self._lock:
+            if version <= self._flushed:
+                return
+            self.save(snapshot)
+            self._flushed = version
 
     def delete(self) -> None:
         if self._path.exists():
             self._path.unlink()
+        self.clear_archive()
+
+    # ------------------------------------------------------------------
+    # Concurrent sessions of the same user
+    # ------------------------------------------------------------------
+
+    def refresh(self, state: dict[str, Any]) -> bool:
+        """
+        Fold thread/cursor updates another session persisted into ``state``
+        (entries changed locally win). Call at the start of a turn so a reply
+        another tab already surfaced is not surfaced again. Cheap when
+        nothing changed. Returns True if ``state`` was updated.
+        """
+        with self._lock:
+            if self._remote_shared() is None:
+                return False
+        # Our own queued snapshot was taken against the current base; write
+        # it before the base moves.
+        flush_pending(self.user_id)
+        with self._lock:
+            remote = self._remote_shared()
+            if remote is None:
+                return False
+            version, theirs = remote
+            changed = False
+            for k in _SHARED_KEYS:
+                ours = state.get(k) or {}
+                merged = _three_way(self._synced.get(k, {}), ours, theirs.get(k) or {})
+                if merged != ours:
+                    state[k] = merged
+                    changed = True
+                if merged == (theirs.get(k) or {}):
+                    self._fingerprints[k] = _fingerprint(merged)
+            self._mark_synced(version, theirs)
+        return changed
+
+    def _remote_shared(self) -> tuple[int, dict[str, dict]] | None:
+        """Persisted (version, shared maps) if newer than what state last synced."""
+        version, shared = self._disk_state()
+        if version == self._synced_version:
+            return None
+        return version, shared
+
+    def _merge_shared(self, state: dict[str, Any], theirs: dict[str, dict]) -> dict[str, dict]:
+        return {
+            k: _three_way(self._synced.get(k, {}), state.get(k) or {}, theirs.get(k) or {})
+            for k in _SHARED_KEYS
+        }
+
+    def _mark_synced(self, version: int, shared: dict[str, Any]) -> None:
+        self._synced = {k: copy.deepcopy(shared.get(k) or {}) for k in _SHARED_KEYS}
+        self._synced_version = version
+
+    def _mark_written(self, state: dict[str, Any], merged: dict[str, dict]) -> bool:
+        """
+        Record a write of ``merged``. If it holds nothing ``state`` lacks,
+        state is in sync with it; otherwise :meth:`refresh` picks up the
+        other session's entries later. Returns True if a merge happened.
+        """
+        if all(merged[k] == (state.get(k) or {}) for k in _SHARED_KEYS):
+            self._mark_synced(self._version, merged)
+            return False
+        return True
+
+    # ------------------------------------------------------------------
+    # Hot / cold history
+    # ------------------------------------------------------------------
+
+    def spill_cold(self, state: dict[str, Any]) -> int:
+        """
+        Keep at most HISTORY_HOT_WINDOW messages in ``state``.
+
+        Once the hot window overflows by HISTORY_SPILL_CHUNK, the oldest
+        messages are appended to the cold archive and dropped from
+        ``state["messages"]`` (in place); ``archived_count`` records how many
+        live there. Returns the number of messages moved.
+        """
+        messages = state.get("messages") or []
+        excess = len(messages) - HISTORY_HOT_WINDOW
+        if excess < HISTORY_SPILL_CHUNK:
+            return 0
+        start = state.get("archived_count") or 0
+        with span("store.spill_cold", backend=self.backend, messages=excess):
+            self._archive_append(start, messages[:excess])
+        del messages[:excess]
+        state["archived_count"] = start + excess
+        return excess
+
+    def _archive_append(self, start: int, messages: list[dict]) -> None:
+        USERS_DIR.mkdir(parents=True, exist_ok=True)
+        lines = "".join(
+            json.dumps({"i": start + n, "m": m}, ensure_ascii=False, separators=(",", ":")) + "\n"
+            for n, m in enumerate(messages)
+        )
+        data = lines.encode("utf-8")
+        with _file_lock(self._lock_path), self._archive_path.open("ab") as fh:
+            fh.write(data)
+            fh.flush()
+            os.fsync(fh.fileno())
+        self.bytes_written += len(data)
+
+    def load_archive(self, start: int, end: int) -> list[dict]:
+        """
+        Archived messages with index in [start, end), oldest first. Read on
+        demand only (scrolling back), never at login.
+
+        An index can appear twice if a spill was interrupted before the hot
+        state was saved and then repeated; the later copy wins.
+        """
+        if end <= start:
+            return []
+        found = read_archive(self._archive_path, start, end)
+        return [found[i] for i in sorted(found)]
+
+    def clear_archive(self) -> None:
+        if self._archive_path.exists():
+            self._archive_path.unlink()
+
+    # ------------------------------------------------------------------
+    # Change tracking
+    # ------------------------------------------------------------------
+
+    def _mark_persisted(self, state: dict[str, Any]) -> None:
+        messages = state.get("messages") or []
+        self._msg_count = len(messages)
+        self._msg_tail = copy.deepcopy(messages[-1]) if messages else None
+        self._fingerprints = {
+            k: _fingerprint(state.get(k, _DEFAULTS[k])) for k in _STATE_KEYS if k != "messages"
+        }
+
+    def _delta(self, state: dict[str, Any]) -> StateDelta:
+        """
+        Diff ``state`` against what was last persisted.
+
+        Messages are only ever appended during a session, so checking the
+        length and the last persisted message is enough to tell an append
+        from a rewrite (e.g. "New chat") without comparing the whole list.
+        """
+        delta = StateDelta()
+        messages = state.get("messages") or []
+        n = self._msg_count
+        if n is not None and len(messages) >= n and (n == 0 or messages[n - 1] == self._msg_tail):
+            delta.append = list(messages[n:])
+        else:
+            delta.set["messages"] = list(messages)
+        for k in _STATE_KEYS:
+            if k == "messages":
+                continue
+            value = state.get(k, _DEFAULTS[k])
+            if _fingerprint(value) != self._fingerprints.get(k):
+                delta.set[k] = value
+        return delta
+
+
+def _snapshot(state: dict[str, Any]) -> dict[str, Any]:
+    """
+    Point-in-time copy of the tracked keys. Messages are never mutated once
+    appended, so copying the list (not each message) is enough for them.
+    """
+    snap = {k: copy.deepcopy(state.get(k, _DEFAULTS[k])) for k in _STATE_KEYS if k != "messages"}
+    snap["messages"] = list(state.get("messages") or [])
+    return snap
+
+
+class _WriteBehind:
+    """
+    Single background thread that persists scheduled snapshots.
+
+    Pending work is keyed by store (one per session), so a burst of turns
+    replaces the queued snapshot instead of queuing more writes; it is
+    flushed at most ``delay`` seconds after the first change of the burst.
+    Two sessions of the same user keep separate entries and are merged by
+    the store when written.
+    """
+
+    def __init__(self, delay: float) -> None:
+        self._delay = delay
+        self._cond = threading.Condition()
+        self._pending: dict[UserStore, tuple[dict[str, Any], int, float]] = {}
+        self._inflight: dict[str, int] = {}  # user_id -> writes in progress
+        self._thread: threading.Thread | None = None
+
+    def submit(self, store: UserStore, snapshot: dict[str, Any], version: int) -> bool:
+        """Queue a snapshot; returns True if it replaced one already queued."""
+        with self._cond:
+            existing = self._pending.get(store)
+            due = existing[2] if existing else time.monotonic() + self._delay
+            self._pending[store] = (snapshot, version, due)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="lenah-write-behind", daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+            return existing is not None
+
+    def _take(self, stores: list[UserStore]) -> list[tuple[UserStore, dict[str, Any], int]]:
+        batch = []
+        for store in stores:
+            snapshot, version, _due = self._pending.pop(store)
+            self._inflight[store.user_id] = self._inflight.get(store.user_id, 0) + 1
+            batch.append((store, snapshot, version))
+        return batch
+
+    def _done(self, batch: list[tuple[UserStore, dict[str, Any], int]]) -> None:
+        with self._cond:
+            for store, _snapshot, _version in batch:
+                self._inflight[store.user_id] -= 1
+                if not self._inflight[store.user_id]:
+                    del self._inflight[store.user_id]
+            self._cond.notify_all()
+
+    def flush(self, user_id: str | None = None) -> None:
+        """
+        Write pending snapshots now — all of them, or just one user's — and
+        wait for any the background thread is already writing.
+        """
+        with self._cond:
+            while self._inflight if user_id is None else user_id in self._inflight:
+                self._cond.wait()
+            batch = self._take([
+                store for store in self._pending if user_id is None or store.user_id == user_id
+            ])
+        try:
+            for store, snapshot, version in batch:
+                store._write(snapshot, version)
+        finally:
+            self._done(batch)
+
+    def discard(self, user_id: str) -> None:
+        with self._cond:
+            for store in [s for s in self._pending if s.user_id == user_id]:
+                del self._pending[store]
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                now = time.monotonic()
+                due = [store for store, item in self._pending.items() if item[2] <= now]
+                if not due:
+                    self._cond.wait(min(item[2] for item in self._pending.values()) - now)
+                    continue
+                batch = self._take(due)
+            for store, snapshot, version in batch:
+                try:
+                    store._write(snapshot, version)
+                except Exception as exc:  # noqa: BLE001
+                    print(f"LENAH write-behind: failed to save user {store.user_id}: {exc}")
+            self._done(batch)
+
+
+_flusher: _WriteBehind | None = _WriteBehind(WRITE_BEHIND_DELAY_S) if WRITE_BEHIND_DELAY_S > 0 else None
+
+
+def flush_pending(user_id: str | None = None) -> None:
+    """Synchronously write anything the write-behind flusher still holds."""
+    if _flusher is not None:
+        _flusher.flush(user_id)
+
+
+def discard_pending(user_id: str) -> None:
+    """Drop a user's queued snapshot, e.g. because their data is being deleted."""
+    if _flusher is not None:
+        _flusher.discard(user_id)
+
+
+atexit.register(flush_pending)
+
+
+def replay_journal(data: dict[str, Any], journal: Path) -> tuple[dict[str, Any], int, int, int | None]:
+    """
+    Fold a journal into its decoded snapshot ``data``. Returns (state, seq,
+    entries, valid_bytes); valid_bytes is None unless the journal ends in a
+    torn line.
+    """
+    state = {k: data.get(k, copy.deepcopy(_DEFAULTS[k])) for k in _STATE_KEYS}
+    seq = int(data.get("_seq", 0))
+    entries = 0
+    if not journal.exists():
+        return state, seq, entries, None
+
+    raw = journal.read_bytes()
+    valid = 0
+    for line in raw.splitlines(keepends=True):
+        try:
+            entry = json.loads(line)
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            break
+        if not line.endswith(b"\n"):
+            break
+        valid += len(line)
+        entries += 1
+        if entry.get("seq", 0) <= seq:
+            continue
+        state["messages"].extend(entry.get("append") or [])
+        state.update(entry.get("set") or {})
+        seq = entry["seq"]
+    return state, seq, entries, valid if valid < len(raw) else None
+
+
+def read_archive(path: Path, start: int = 0, end: int | None = None) -> dict[int, dict]:
+    """Messages in a cold archive file by index, within [start, end); later copies win."""
+    found: dict[int, dict] = {}
+    if not path.exists():
+        return found
+    with path.open("r", encoding="utf-8") as fh:
+        for line in fh:
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if start <= row["i"] and (end is None or row["i"] < end):
+                found[row["i"]] = row["m"]
+    return found
+
+
+class JournalUserStore(UserStore):
+    """
+    Append-only persistence: data/users/{user_id}.json is a snapshot and
+    data/users/{user_id}.journal.jsonl holds one line per save with only
+    the appended messages and changed keys. Every JOURNAL_COMPACT_EVERY
+    entries the journal is folded into a fresh snapshot (written atomically)
+    and truncated, so per-turn cost no longer grows with history length.
+
+    Each entry carries a sequence number and the snapshot records the last
+    one it includes, so a crash between snapshot and truncate never replays
+    an entry twice. A torn final line (crash mid-append) is ignored. The
+    sequence number doubles as the version for merging concurrent sessions.
+    """
+
+    backend = "journal"
+
+    def __init__(self, email: str) -> None:
+        super().__init__(email)
+        self._journal: Path = USERS_DIR / f"{self.user_id}.journal.jsonl"
+        self._entries: int = 0
+
+    @property
+    def exists(self) -> bool:
+        return self._path.exists() or self._journal.exists()
+
+    def _sig(self) -> tuple[Any, Any]:
+        return _stat(self._path), _stat(self._journal)
+
+    def _replay(self) -> tuple[dict[str, Any], int, int, int | None]:
+        return replay_journal(self._read_snapshot(), self._journal)
+
+    def _disk_state(self) -> tuple[int, dict[str, dict]]:
+        sig = self._sig()
+        if sig != self._disk_sig:
+            state, self._version, self._entries, _torn = self._replay()
+            self._disk_shared = {k: copy.deepcopy(state[k]) for k in _SHARED_KEYS}
+            self._disk_sig = sig
+        return self._version, self._disk_shared
+
+    def load(self) -> dict[str, Any]:
+        with self._lock, _file_lock(self._lock_path):
+            state, self._version, self._entries, torn = self._replay()
+            if torn is not None:
+                # Drop a torn tail so later appends start on a clean line.
+                with self._journal.open("r+b") as fh:
+                    fh.truncate(torn)
+            self._disk_sig = self._sig()
+            self._disk_shared = {k: copy.deepcopy(state[k]) for k in _SHARED_KEYS}
+            self._mark_persisted(state)
+            self._mark_synced(self._version, state)
+        self._stamp_owner(state)
+        return state
+
+    def save(self, state: dict[str, Any]) -> None:
+        with span("store.save", backend=self.backend) as s:
+            delta = self._delta(state)
+            if not delta:
+                s.set(bytes=0)
+                return
+
+            USERS_DIR.mkdir(parents=True, exist_ok=True)
+            with self._lock, _file_lock(self._lock_path):
+                seq, theirs = self._disk_state()
+                merged = self._merge_shared(state, theirs)
+                for k in _SHARED_KEYS:
+                    if merged[k] != theirs.get(k):
+                        delta.set[k] = merged[k]
+                    else:
+                        delta.set.pop(k, None)
+                entry = {"seq": seq + 1, "append": delta.append, "set": delta.set}
+                data = (json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+                with self._journal.open("ab") as fh:
+                    fh.write(data)
+                    fh.flush()
+                    os.fsync(fh.fileno())
+                self._disk_sig = self._sig()
+                self._version = entry["seq"]
+                self._disk_shared = merged
+                self._entries += 1
+                self._mark_persisted(state)
+                conflict = self._mark_written(state, merged)
+                self.bytes_written += len(data)
+                s.set(bytes=len(data), appended=len(delta.append), keys=len(delta.set), merged=conflict)
+
+                if self._entries >= JOURNAL_COMPACT_EVERY:
+                    self.compact()
+                    s.set(compacted=True)
+
+    def compact(self) -> None:
+        """
+        Fold the journal into a new snapshot and truncate it. Folds what is
+        on disk, not this session's state, so entries another session
+        appended survive. Call with the file lock held.
+        """
+        with span("store.compact", backend=self.backend) as s:
+            state, seq, _entries, _torn = self._replay()
+            payload = {**state, "_seq": seq}
+            data = encode_state(payload, self.format)
+            _atomic_write(self._path, data)
+            self._journal.write_bytes(b"")
+            self._disk_sig = self._sig()
+            self.bytes_written += len(data)
+            self._entries = 0
+            s.set(bytes=len(data))
+
+    def delete(self) -> None:
+        super().delete()
+        if self._journal.exists():
+            self._journal.unlink()
+
+
+_BACKENDS: dict[str, type[UserStore]] = {
+    "file": UserStore,
+    "journal": JournalUserStore,
+}
+
+
+def open_user_store(email: str) -> UserStore:
+    """Return a store for ``email`` using the backend chosen in config."""
+    if USER_STORE_BACKEND == "mongo":
+        # Imported lazily so pymongo is only needed when the backend is used.
+        from src.mongo_store import MongoUserStore  # noqa: PLC0415
+
+        return MongoUserStore(email)
+    try:
+        cls = _BACKENDS[USER_STORE_BACKEND]
+    except KeyError:
+        raise RuntimeError(
+            f"Unknown LENAH_USER_STORE backend {USER_STORE_BACKEND!r}; "
+            f"expected one of file, journal, mongo."
+        ) from None
+    return cls(email)
+
+
+def state_owner(state: dict[str, Any], user_id: str) -> str | None:
+    """
+    The address the state saved under ``user_id`` belongs to. State saved
+    before owner_email existed falls back to user_email, but only while it
+    still hashes to ``user_id`` (the user may have changed it mid-chat).
+    """
+    owner = state.get("owner_email")
+    if owner is None and state.get("user_email") and _user_id(state["user_email"]) == user_id:
+        owner = state["user_email"]
+    return owner
+
+
+def iter_user_emails() -> Iterator[str]:
+    """Every user with saved state in the configured backend."""
+    if USER_STORE_BACKEND == "mongo":
+        from src.mongo_store import users_collection  # noqa: PLC0415
+
+        for doc in users_collection().find({}, {"email": 1}):
+            if doc.get("email"):
+                yield doc["email"]
+        return
+    if not USERS_DIR.exists():
+        return
+    stems = {p.stem for p in USERS_DIR.glob("*.json")}
+    stems |= {p.name[: -len(".journal.jsonl")] for p in USERS_DIR.glob("*.journal.jsonl")}
+    for stem in sorted(stems):
+        snapshot, journal = USERS_DIR / f"{stem}.json", USERS_DIR / f"{stem}.journal.jsonl"
+        try:
+            data = decode_state(snapshot.read_bytes()) if snapshot.exists() else {}
+            state = replay_journal(data, journal)[0]
+        except (ValueError, zlib.error, OSError):
+            continue
+        owner = state_owner(state, stem)
+        if owner:
+            yield owner
@@ -0,0 +1,77 @@
+"""
+Running digest of each agent thread.
+
+Reply summaries and drafts used to see only the agent's latest email plus
+generic chat history, so every reply re-inferred what the thread was about.
+Instead each thread keeps a short digest in the user's ``agent_digests``
+state (next to ``agent_threads``), updated from the delta only:
+
+- a send records the outgoing email as *pending* — no model call in the turn;
+- when the poller processes replies, the pending sends and the new replies
+  are folded into the digest in one call (``llm.update_thread_digest``).
+
+Summarising and drafting then get the digest instead of raw history, so
+their prompts stay the same size however long the thread runs. Threads
+started before digests existed begin from their next message.
+"""
+from __future__ import annotations
+
+from typing import Any
+
+from src.llm import update_thread_digest
+from src.tracing import span
+from src.utils import now
+
+# Messages waiting to be folded in; older ones are dropped if the poller
+# hasn't run for a long time (the digest then just misses them).
+_MAX_PENDING = 8
+# Of each message, only this much goes into the fold: quoted history below
+# it is already in the digest.
+_MAX_DELTA_CHARS = 3000
+
+
+def _entry(state: Any, agent_email: str) -> dict:
+    return dict(state["agent_digests"].get(agent_email) or {"text": "", "pending": [], "messages": 0})
+
+
+def _queue(state: Any, agent_email: str, direction: str, subject: str, body: str) -> None:
+    # Entries are replaced, never mutated, so the store's change tracking and
+    # per-entry merge see the update.
+    entry = _entry(state, agent_email)
+    entry["pending"] = [
+        *entry["pending"],
+        {"direction": direction, "subject": subject or "", "body": (body or "")[:_MAX_DELTA_CHARS]},
+    ][-_MAX_PENDING:]
+    state["agent_digests"][agent_email] = entry
+
+
+def note_outbound(state: Any, agent_email: str, *, subject: str, body: str) -> None:
+    """An email LENAH sent to ``agent_email``; folded in with the next reply."""
+    _queue(state, agent_email, "out", subject, body)
+
+
+def note_inbound(state: Any, agent_email: str, reply: dict) -> None:
+    """A reply fetched from ``agent_email`` (a poller reply dict)."""
+    _queue(state, agent_email, "in", reply.get("subject") or "", reply.get("body") or "")
+
+
+def refresh(state: Any, agent_email: str) -> str:
+    """
+    Fold the thread's pending messages into its digest and return it. If
+    the model call fails the old digest is returned and the messages stay
+    pending for next time.
+    """
+    entry = _entry(state, agent_email)
+    if not entry["pending"]:
+        return entry["text"]
+    try:
+        with span("digest.refresh", pending=len(entry["pending"])):
+            text = update_thread_digest(digest=entry["text"], new_messages=entry["pending"])
+    except Exception as exc:  # noqa: BLE001
+        print(f"LENAH digest: couldn't update the {agent_email} thread digest: {exc}")
+        return entry["text"]
+    if not text:
+        return entry["text"]
+    entry.update(text=text, pending=[], messages=entry["messages"] + len(entry["pending"]), updated=now())
+    state["agent_digests"][agent_email] = entry
+    return text
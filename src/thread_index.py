@@ -0,0 +1,246 @@
+"""
+Reverse index: (mailbox, Gmail thread_id) -> (user, agent_email).
+
+Every enquiry goes out from a shared central mailbox (one of the shards in
+src/mailboxes.py), so an inbound message only says which *thread* it
+belongs to. Thread ids are only unique within one mailbox, hence the key. The index lets the inbox-wide sync
+(see src/poller.py) route it to its owner with one lookup instead of
+scanning every user's ``agent_threads``. It is written on every send and
+can be rebuilt from user state at any time:
+
+    python -m src.thread_index --rebuild
+
+It lives next to the user state: a SQLite file for the file and journal
+backends, a ``thread_index`` collection for mongo. The same store holds the
+inbox sync cursors (the last Gmail historyId seen per mailbox).
+
+Entries are never deleted when a user starts a new chat; routing checks the
+owner's current ``agent_threads``, so a stale entry just routes to nobody.
+"""
+from __future__ import annotations
+
+import argparse
+import sqlite3
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import NamedTuple
+
+from src.config import MONGO_DB_NAME, THREAD_INDEX_PATH, USER_STORE_BACKEND
+from src.mailboxes import ensure_mailbox
+from src.session import _user_id, iter_user_emails, open_user_store
+from src.tracing import span
+
+
+class ThreadOwner(NamedTuple):
+    user_id: str
+    user_email: str
+    agent_email: str
+
+
+# ---------------------------------------------------------------------------
+# SQLite (file / journal backends)
+# ---------------------------------------------------------------------------
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS threads (
+    mailbox     TEXT NOT NULL,
+    thread_id   TEXT NOT NULL,
+    user_id     TEXT NOT NULL,
+    user_email  TEXT NOT NULL,
+    agent_email TEXT NOT NULL,
+    updated_at  REAL NOT NULL,
+    PRIMARY KEY (mailbox, thread_id)
+);
+CREATE INDEX IF NOT EXISTS threads_user ON threads (user_id);
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+class SqliteThreadIndex:
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self._local = threading.local()
+
+    def _conn(self) -> sqlite3.Connection:
+        # One connection per thread; WAL lets the poller read while a
+        # session writes.
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(threads)")}
+            if columns and "mailbox" not in columns:
+                # Pre-sharding layout. The index is derived data: the first
+                # inbox sync per mailbox re-registers every thread.
+                conn.execute("DROP TABLE threads")
+            conn.executescript(_SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    def register(self, mailbox: str, thread_id: str, user_email: str, agent_email: str) -> None:
+        self.register_many([(mailbox, thread_id, user_email, agent_email)])
+
+    def register_many(self, rows: list[tuple[str, str, str, str]]) -> None:
+        now = time.time()
+        self._conn().executemany(
+            "INSERT INTO threads VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(mailbox, thread_id) DO UPDATE SET user_id=excluded.user_id, "
+            "user_email=excluded.user_email, agent_email=excluded.agent_email, updated_at=excluded.updated_at",
+            [(mb, tid, _user_id(user), user.strip().lower(), agent, now) for mb, tid, user, agent in rows],
+        )
+
+    def lookup(self, mailbox: str, thread_id: str) -> ThreadOwner | None:
+        return self.lookup_many(mailbox, [thread_id]).get(thread_id)
+
+    def lookup_many(self, mailbox: str, thread_ids: list[str]) -> dict[str, ThreadOwner]:
+        found: dict[str, ThreadOwner] = {}
+        conn = self._conn()
+        # Stay well under SQLite's bound-parameter limit.
+        for start in range(0, len(thread_ids), 500):
+            chunk = thread_ids[start:start + 500]
+            marks = ",".join("?" * len(chunk))
+            for tid, *owner in conn.execute(
+                "SELECT thread_id, user_id, user_email, agent_email FROM threads "
+                f"WHERE mailbox = ? AND thread_id IN ({marks})",
+                [mailbox, *chunk],
+            ):
+                found[tid] = ThreadOwner(*owner)
+        return found
+
+    def count(self) -> int:
+        return self._conn().execute("SELECT COUNT(*) FROM threads").fetchone()[0]
+
+    def get_meta(self, key: str) -> str | None:
+        row = self._conn().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: str) -> None:
+        self._conn().execute(
+            "INSERT INTO meta VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value=excluded.value", (key, value)
+        )
+
+
+# ---------------------------------------------------------------------------
+# Mongo
+# ---------------------------------------------------------------------------
+
+class MongoThreadIndex:
+    def __init__(self) -> None:
+        # Imported lazily so pymongo is only needed when the backend is used.
+        from src.mongo_store import get_client  # noqa: PLC0415
+
+        db = get_client()[MONGO_DB_NAME]
+        self._threads = db["thread_index"]
+        self._meta = db["thread_index_meta"]
+        # Pre-sharding entries were keyed by thread id alone; see SqliteThreadIndex.
+        self._threads.delete_many({"mailbox": {"$exists": False}})
+
+    @staticmethod
+    def _update(mailbox: str, thread_id: str, user_email: str, agent_email: str) -> dict:
+        return {"$set": {
+            "mailbox": mailbox,
+            "thread_id": thread_id,
+            "user_id": _user_id(user_email),
+            "user_email": user_email.strip().lower(),
+            "agent_email": agent_email,
+            "updated_at": time.time(),
+        }}
+
+    def register(self, mailbox: str, thread_id: str, user_email: str, agent_email: str) -> None:
+        self._threads.update_one(
+            {"_id": f"{mailbox}:{thread_id}"}, self._update(mailbox, thread_id, user_email, agent_email), upsert=True
+        )
+
+    def register_many(self, rows: list[tuple[str, str, str, str]]) -> None:
+        from pymongo import UpdateOne  # noqa: PLC0415
+
+        for start in range(0, len(rows), 500):
+            ops = [
+                UpdateOne({"_id": f"{mb}:{tid}"}, self._update(mb, tid, user, agent), upsert=True)
+                for mb, tid, user, agent in rows[start:start + 500]
+            ]
+            self._threads.bulk_write(ops, ordered=False)
+
+    def lookup(self, mailbox: str, thread_id: str) -> ThreadOwner | None:
+        return self.lookup_many(mailbox, [thread_id]).get(thread_id)
+
+    def lookup_many(self, mailbox: str, thread_ids: list[str]) -> dict[str, ThreadOwner]:
+        return {
+            doc["thread_id"]: ThreadOwner(doc["user_id"], doc["user_email"], doc["agent_email"])
+            for doc in self._threads.find({"_id": {"$in": [f"{mailbox}:{tid}" for tid in thread_ids]}})
+        }
+
+    def count(self) -> int:
+        return self._threads.count_documents({})
+
+    def get_meta(self, key: str) -> str | None:
+        doc = self._meta.find_one({"_id": key})
+        return doc["value"] if doc else None
+
+    def set_meta(self, key: str, value: str) -> None:
+        self._meta.update_one({"_id": key}, {"$set": {"value": value}}, upsert=True)
+
+
+# ---------------------------------------------------------------------------
+# Process-wide index
+# ---------------------------------------------------------------------------
+
+_index: SqliteThreadIndex | MongoThreadIndex | None = None
+_index_lock = threading.Lock()
+
+
+def get_index() -> SqliteThreadIndex | MongoThreadIndex:
+    """The index for the configured user store backend."""
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = MongoThreadIndex() if USER_STORE_BACKEND == "mongo" else SqliteThreadIndex(THREAD_INDEX_PATH)
+    return _index
+
+
+def register_thread(mailbox: str, thread_id: str, user_email: str | None, agent_email: str) -> None:
+    """
+    Record that ``thread_id`` on ``mailbox`` belongs to ``user_email``'s
+    enquiry to ``agent_email``. Never raises: the index is an optimisation,
+    and the per-thread poll still finds replies on threads it misses.
+    """
+    if not (thread_id and user_email):
+        return
+    try:
+        with span("thread_index.register"):
+            get_index().register(mailbox, thread_id, user_email, agent_email)
+    except Exception as exc:  # noqa: BLE001
+        print(f"LENAH thread index: couldn't register thread {thread_id}: {exc}")
+
+
+def rebuild() -> int:
+    """Re-register every user's agent threads. Returns the number of threads."""
+    rows: list[tuple[str, str, str, str]] = []
+    for email in iter_user_emails():
+        state = open_user_store(email).load()
+        mailbox = ensure_mailbox(state)
+        rows.extend((mailbox, tid, email, agent) for agent, tid in state["agent_threads"].items() if tid)
+    get_index().register_many(rows)
+    return len(rows)
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rebuild", action="store_true", help="re-register every user's threads")
+    args = parser.parse_args(argv)
+    if args.rebuild:
+        print(f"registered {rebuild()} threads")
+    print(f"{get_index().count()} threads in the index")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,290 @@
+from __future__ import annotations
+
+import contextvars
+import functools
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Callable, Protocol, TypeVar
+
+from src.config import TRACE_EXPORTERS, TRACE_JSONL_PATH, TRACE_PROMETHEUS_PORT
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+
+# ---------------------------------------------------------------------------
+# Spans
+# ---------------------------------------------------------------------------
+
+_ids = itertools.count(1)
+_current: contextvars.ContextVar["Span | None"] = contextvars.ContextVar("lenah_span", default=None)
+
+
+class Span:
+    """One timed operation. Nested spans share the root's trace_id."""
+
+    __slots__ = ("name", "attrs", "span_id", "parent_id", "trace_id", "start", "end", "_token")
+
+    def __init__(self, name: str, attrs: dict[str, Any], parent: "Span | None") -> None:
+        self.name = name
+        self.attrs = attrs
+        self.span_id = next(_ids)
+        self.parent_id = parent.span_id if parent else None
+        self.trace_id = parent.trace_id if parent else self.span_id
+        self.start = 0.0
+        self.end = 0.0
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+    def set(self, **attrs: Any) -> None:
+        self.attrs.update(attrs)
+
+    def incr(self, key: str, n: int = 1) -> None:
+        self.attrs[key] = self.attrs.get(key, 0) + n
+
+    def __enter__(self) -> "Span":
+        self._token = _current.set(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.end = time.perf_counter()
+        _current.reset(self._token)
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        for exporter in _exporters:
+            exporter.export(self)
+
+
+class _NoopSpan:
+    """Returned while tracing is disabled; every method is a no-op."""
+
+    __slots__ = ()
+
+    def set(self, **attrs: Any) -> None:
+        pass
+
+    def incr(self, key: str, n: int = 1) -> None:
+        pass
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        pass
+
+
+_NOOP = _NoopSpan()
+
+
+def span(name: str, **attrs: Any) -> Span | _NoopSpan:
+    """
+    Open a span as a context manager:
+
+        with span("gmail.threads.get", thread_id=tid) as s:
+            ...
+            s.set(bytes=n)
+    """
+    if not _exporters:
+        return _NOOP
+    return Span(name, attrs, _current.get())
+
+
+def current() -> Span | _NoopSpan:
+    """The innermost open span, for attaching attributes from deep helpers."""
+    return _current.get() or _NOOP
+
+
+def traced(name: str) -> Callable[[F], F]:
+    """Decorator form of :func:`span`."""
+    def wrap(fn: F) -> F:
+        @functools.wraps(fn)
+        def inner(*args: Any, **kwargs: Any) -> Any:
+            if not _exporters:
+                return fn(*args, **kwargs)
+            with Span(name, {}, _current.get()):
+                return fn(*args, **kwargs)
+        return inner  # type: ignore[return-value]
+    return wrap
+
+
+# ---------------------------------------------------------------------------
+# Exporters
+# ---------------------------------------------------------------------------
+
+class Exporter(Protocol):
+    def export(self, span: Span) -> None: ...
+
+
+class JsonLinesExporter:
+    """Appends one JSON object per finished span to a file."""
+
+    def __init__(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = path.open("a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def export(self, span: Span) -> None:
+        line = json.dumps(
+            {
+                "trace_id": span.trace_id,
+                "span_id": span.span_id,
+                "parent_id": span.parent_id,
+                "name": span.name,
+                "ts": time.time(),
+                "duration_ms": round(span.duration * 1000, 3),
+                "attrs": span.attrs,
+            },
+            default=str,
+            ensure_ascii=False,
+        )
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+
+_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class PrometheusExporter:
+    """
+    Aggregates span durations (histogram) and numeric attributes (counters)
+    by span name and renders them in the Prometheus text format. Pass a port
+    to also serve them at ``http://localhost:<port>/metrics``.
+    """
+
+    def __init__(self, port: int = 0) -> None:
+        self._lock = threading.Lock()
+        self._hist: dict[str, list[int]] = {}
+        self._sum: dict[str, float] = {}
+        self._count: dict[str, int] = {}
+        self._attrs: dict[tuple[str, str], float] = {}
+        if port:
+            self._serve(port)
+
+    def export(self, span: Span) -> None:
+        with self._lock:
+            buckets = self._hist.setdefault(span.name, [0] * len(_BUCKETS))
+            for i, bound in enumerate(_BUCKETS):
+                if span.duration <= bound:
+                    buckets[i] += 1
+            self._sum[span.name] = self._sum.get(span.name, 0.0) + span.duration
+            self._count[span.name] = self._count.get(span.name, 0) + 1
+            for key, value in span.attrs.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    self._attrs[(span.name, key)] = self._attrs.get((span.name, key), 0.0) + value
+
+    def render(self) -> str:
+        lines = [
+            "# TYPE lenah_span_duration_seconds histogram",
+        ]
+        with self._lock:
+            for name in sorted(self._hist):
+                for bound, n in zip(_BUCKETS, self._hist[name]):
+                    lines.append(f'lenah_span_duration_seconds_bucket{{span="{name}",le="{bound}"}} {n}')
+                lines.append(f'lenah_span_duration_seconds_bucket{{span="{name}",le="+Inf"}} {self._count[name]}')
+                lines.append(f'lenah_span_duration_seconds_sum{{span="{name}"}} {self._sum[name]:.6f}')
+                lines.append(f'lenah_span_duration_seconds_count{{span="{name}"}} {self._count[name]}')
+            lines.append("# TYPE lenah_span_attribute_total counter")
+            for (name, key), value in sorted(self._attrs.items()):
+                lines.append(f'lenah_span_attribute_total{{span="{name}",attr="{key}"}} {value:g}')
+        return "\n".join(lines) + "\n"
+
+    def _serve(self, port: int) -> None:
+        exporter = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:  # noqa: N802
+                if self.path.rstrip("/") != "/metrics":
+                    self.send_error(404)
+                    return
+                body = exporter.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args: Any) -> None:
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", port), _Handler)
+        threading.Thread(target=server.serve_forever, name="lenah-metrics", daemon=True).start()
+
+
+class OpenTelemetryExporter:
+    """Re-emits finished spans through the OpenTelemetry SDK, if installed."""
+
+    def __init__(self) -> None:
+        from opentelemetry import trace  # noqa: PLC0415
+
+        self._trace = trace
+        self._tracer = trace.get_tracer("lenah")
+        self._open: dict[int, Any] = {}
+        self._lock = threading.Lock()
+
+    def export(self, span: Span) -> None:
+        # Children finish before their parent, so buffer them until the
+        # root closes and then replay the tree with correct parentage.
+        with self._lock:
+            self._open.setdefault(span.trace_id, []).append(span)
+            if span.parent_id is not None:
+                return
+            spans = self._open.pop(span.trace_id)
+
+        offset_ns = time.time_ns() - int(time.perf_counter() * 1e9)
+        by_parent: dict[int | None, list[Span]] = {}
+        for s in spans:
+            by_parent.setdefault(s.parent_id, []).append(s)
+
+        def emit(s: Span, ctx: Any) -> None:
+            otel = self._tracer.start_span(
+                s.name,
+                context=ctx,
+                start_time=offset_ns + int(s.start * 1e9),
+                attributes={k: v if isinstance(v, (str, bool, int, float)) else str(v)
+                            for k, v in s.attrs.items() if v is not None},
+            )
+            child_ctx = self._trace.set_span_in_context(otel)
+            for child in by_parent.get(s.span_id, []):
+                emit(child, child_ctx)
+            otel.end(end_time=offset_ns + int(s.end * 1e9))
+
+        emit(span, None)
+
+
+# ---------------------------------------------------------------------------
+# Configuration
+# ---------------------------------------------------------------------------
+
+_exporters: list[Exporter] = []
+
+
+def configure(exporters: list[Exporter]) -> None:
+    """Replace the active exporters. An empty list disables tracing."""
+    _exporters[:] = exporters
+
+
+def _from_config() -> list[Exporter]:
+    built: list[Exporter] = []
+    for name in (n.strip().lower() for n in TRACE_EXPORTERS.split(",")):
+        if name == "jsonl":
+            built.append(JsonLinesExporter(TRACE_JSONL_PATH))
+        elif name == "prometheus":
+            built.append(PrometheusExporter(port=TRACE_PROMETHEUS_PORT))
+        elif name in ("otel", "opentelemetry"):
+            try:
+                built.append(OpenTelemetryExporter())
+            except ImportError:
+                print("LENAH tracing: opentelemetry is not installed; skipping 'otel' exporter.")
+    return built
+
+
+# Per-process: Streamlit re-imports app.py on every rerun but src modules stay
+# cached, so exporters (and the metrics port) are set up exactly once.
+configure(_from_config())
@@ -1,9 +1,33 @@
 from __future__ import annotations
 
+import contextlib
+import contextvars
 import re
+import time
+from typing import Iterator
 
 EMAIL_RE = re.compile(r"\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}\b")
 
+# Set while a turn is recorded or replayed (src/recorder.py, bench/replay.py),
+# so timestamps saved into user state come out the same both times.
+_frozen_at: contextvars.ContextVar[float | None] = contextvars.ContextVar("lenah_frozen_at", default=None)
+
+
+def now() -> float:
+    """Epoch seconds for values saved into user state."""
+    frozen = _frozen_at.get()
+    return time.time() if frozen is None else frozen
+
+
+@contextlib.contextmanager
+def frozen_clock(at: float) -> Iterator[None]:
+    """Make :func:`now` return ``at`` inside the block (and threads started with its context)."""
+    token = _frozen_at.set(at)
+    try:
+        yield
+    finally:
+        _frozen_at.reset(token)
+
 
 def extract_first_email(text: str | None) -> str | None:
     if not text:
@@ -12,6 +36,13 @@ def extract_first_email(text: str | None) -> str | None:
     return m.group(0) if m else None
 
 
+def extract_all_emails(text: str | None) -> list[str]:
+    """Every distinct address in ``text``, normalised, in order of appearance."""
+    if not text:
+        return []
+    return list(dict.fromkeys(normalise_email(m) for m in EMAIL_RE.findall(text)))
+
+
 def normalise_email(email: str) -> str:
     return email.strip().lower()
 